@@ -0,0 +1,18 @@
+"""Shared building blocks of the single-zone training scripts.
+
+The experiment folders (``single-zone/test_v1``, ``single-zone/test_v2`` and
+``single-zone-temperature/test_v1``) hold the scripts, their FMUs and results;
+everything they have in common lives here:
+
+* envs: :mod:`fmu_pool`, :mod:`vector_env`, :mod:`sim_service`,
+  :mod:`env_wrappers`, :mod:`reward`, :mod:`weather_cache`, :mod:`state_cache`,
+  :mod:`rollout_cache`, :mod:`surrogate`;
+* training: :mod:`replay`, :mod:`fused_update`, :mod:`apex`,
+  :mod:`multi_weight`, :mod:`checkpoint`, :mod:`convergence`;
+* evaluation and logs: :mod:`async_eval`, :mod:`eval_recorder`,
+  :mod:`event_log`;
+* tuning: :mod:`tuning`, :mod:`resources`.
+
+Install it with ``pip install -e .`` from the repository root, or put the root
+on ``PYTHONPATH`` as the SLURM and Docker scripts do.
+"""
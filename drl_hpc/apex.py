@@ -0,0 +1,249 @@
+"""Ape-X style decoupled actors and learner on one node.
+
+In ``offpolicy_trainer_1`` collection and learning take turns: the learner waits
+for the FMU and the FMU waits for the learner. :func:`apex_trainer` forks
+``n_actors`` actor processes instead. Each one owns a building env and a CPU copy
+of the policy with its own exploration rate, and streams chunks of transitions
+through a queue. The main process is the learner: it moves the chunks into a
+central replay buffer (one sub-buffer per actor, so n-step returns never
+cross actors), updates continuously and publishes its weights to shared memory
+every ``sync_every`` gradient steps. Actors pick up a new weight version before
+their next step.
+
+Only plain ``multiprocessing`` is used, so it runs inside a single udocker job.
+"""
+import copy
+import time
+import queue
+import multiprocessing as mp
+from collections import defaultdict
+
+import numpy as np
+import torch
+import tqdm
+from tianshou.data import Batch, to_numpy
+from tianshou.utils import MovAvg, tqdm_config
+
+from . import event_log
+from .eval_recorder import EvalRecorder
+from .replay import make_replay_buffer, anneal_beta
+
+
+class SharedWeights(object):
+    """Policy weights in shared memory with a version counter.
+
+    Created in the learner before the actors fork, so every actor sees the same
+    tensors.
+    """
+
+    def __init__(self, policy):
+        self.tensors = {k: v.detach().cpu().clone().share_memory_()
+                        for k, v in policy.state_dict().items()}
+        self.version = mp.Value('l', 0)
+
+    def publish(self, policy):
+        with self.version.get_lock():
+            for k, v in policy.state_dict().items():
+                self.tensors[k].copy_(v.detach())
+            self.version.value += 1
+
+    def pull(self, policy, version):
+        """Load the weights into ``policy`` if they are newer than ``version``."""
+        if self.version.value == version:
+            return version
+        with self.version.get_lock():
+            policy.load_state_dict(self.tensors)
+            return self.version.value
+
+
+def actor_eps(i, n_actors, base=0.4, alpha=7.):
+    """Exploration rate of actor ``i`` as in Ape-X, from ``base`` down to ``base**(1+alpha)``."""
+    if n_actors == 1:
+        return base
+    return base ** (1. + alpha * i / (n_actors - 1))
+
+
+def _actor(actor_id, policy, make_env, weights, transitions, stop, eps, chunk, seed):
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    for m in policy.modules():
+        if hasattr(m, 'device'):
+            m.device = 'cpu'
+    policy.eval()
+    if eps is not None:
+        policy.set_eps(eps)
+    env = make_env()
+    env.seed(seed)
+    version = -1
+    data = None
+    n = 0
+    ep_rew, ep_len = 0., 0
+    obs = env.reset()
+    try:
+        while not stop.is_set():
+            version = weights.pull(policy, version)
+            batch = Batch(obs=obs[None], info={})
+            with torch.no_grad():
+                act = to_numpy(policy(batch).act)
+            act = policy.exploration_noise(act, batch)[0]
+            obs_next, rew, done, info = env.step(act)
+            if data is None:
+                data = {'obs': np.zeros((chunk,) + np.shape(obs), dtype=np.asarray(obs).dtype),
+                        'act': np.zeros((chunk,) + np.shape(act), dtype=np.asarray(act).dtype),
+                        'rew': np.zeros(chunk), 'done': np.zeros(chunk, dtype=bool),
+                        'obs_next': np.zeros((chunk,) + np.shape(obs), dtype=np.asarray(obs).dtype)}
+            data['obs'][n] = obs
+            data['act'][n] = act
+            data['rew'][n] = rew
+            data['done'][n] = done
+            data['obs_next'][n] = obs_next
+            n += 1
+            ep_rew += rew
+            ep_len += 1
+            if n == chunk:
+                transitions.put(('chunk', actor_id, data))
+                data = None
+                n = 0
+            if done:
+                transitions.put(('episode', actor_id, (ep_rew, ep_len)))
+                ep_rew, ep_len = 0., 0
+                obs = env.reset()
+            else:
+                obs = obs_next
+    finally:
+        env.close()
+
+
+def apex_trainer(args, test_envs, policy, make_env, max_epoch, step_per_epoch, batch_size,
+                 n_actors, record_folder, update_per_step=1, sync_every=100, chunk=64, eps=None,
+                 save_fn=None, logger=None, test_buffer_kwargs=None,
+                 buffer_kwargs=None, monitor=None):
+    """Train ``policy`` with ``n_actors`` collector processes and one learner.
+
+    An epoch ends after ``step_per_epoch`` transitions have arrived from the
+    actors; then the policy is saved and tested as in ``offpolicy_trainer_1``.
+
+    :param make_env: ``make_env(actor_id)`` builds the env of one actor; it is
+        called inside the actor process.
+    :param str record_folder: where the test trajectories are recorded.
+    :param float update_per_step: the learner never runs ahead of this many
+        gradient steps per received transition.
+    :param int sync_every: gradient steps between two weight broadcasts.
+    :param int chunk: transitions sent together by an actor.
+    :param float eps: base exploration rate for the DQN policies, spread over the
+        actors with :func:`actor_eps`; None for policies without ``set_eps``.
+    :param dict test_buffer_kwargs: extra arguments of the test replay buffer.
+    :param dict buffer_kwargs: extra arguments of :func:`replay.make_replay_buffer`.
+    :param monitor: a :class:`convergence.ConvergenceMonitor` that may end the run early.
+    """
+    ctx = mp.get_context('fork')
+    weights = SharedWeights(policy)
+    transitions = ctx.Queue(maxsize=4 * n_actors)
+    stop = ctx.Event()
+    actor_policy = copy.deepcopy(policy).to('cpu')
+    actors = []
+    for i in range(n_actors):
+        p = ctx.Process(target=_actor, args=(
+            i, actor_policy, lambda i=i: make_env(i), weights, transitions, stop,
+            actor_eps(i, n_actors, eps) if eps is not None else None, chunk, args.seed + i))
+        p.start()
+        actors.append(p)
+
+    buffer = make_replay_buffer(args, n_actors, **(buffer_kwargs or {}))
+    recorder = EvalRecorder(policy, test_envs, step_per_epoch, max_epoch,
+                            folder=record_folder, buffer_kwargs=test_buffer_kwargs)
+    stat = defaultdict(MovAvg)
+    env_step, gradient_step = 0, 0
+    ep_rews = []
+    start_time = time.time()
+
+    def receive(block):
+        nonlocal env_step
+        try:
+            kind, actor_id, data = transitions.get(block=block, timeout=1. if block else None)
+        except queue.Empty:
+            return False
+        if kind == 'episode':
+            ep_rews.append(data[0])
+            return True
+        n = len(data['rew'])
+        # the manager adds repeated buffer ids one after the other
+        buffer.add(Batch(obs=data['obs'], act=data['act'], rew=data['rew'], done=data['done'],
+                         obs_next=data['obs_next']), buffer_ids=np.full(n, actor_id))
+        env_step += n
+        return True
+
+    def check_actors():
+        for i, p in enumerate(actors):
+            if not p.is_alive():
+                raise RuntimeError("apex actor {} exited with code {}".format(i, p.exitcode))
+
+    def record_test(epoch, step, result):
+        rew = result["rews"].mean()
+        recorder.add(recorder.trajectory(),
+                     epoch=epoch, env_step=step, n_ep=int(result["n/ep"]), rew=float(rew))
+        if monitor is not None:
+            monitor.update(epoch, step, result)
+        if result["n/ep"] > 0 and logger is not None:
+            logger.log_test_data(result, step)
+        event_log.record('test', step, rew, result["rews"].std(), result["n/ep"])
+        print(f'Mean reward (over {result["n/ep"]} episodes): {rew}')
+
+    try:
+        for epoch in range(1, 1 + max_epoch):
+            policy.train()
+            epoch_end = epoch * step_per_epoch
+            with tqdm.tqdm(total=step_per_epoch, desc=f"Epoch #{epoch}", **tqdm_config) as t:
+                while env_step < epoch_end:
+                    check_actors()
+                    last = env_step
+                    # take everything that is queued, wait only if the learner is ahead
+                    while receive(block=False):
+                        pass
+                    allowed = update_per_step * env_step - gradient_step
+                    if len(buffer) < batch_size or allowed < 1:
+                        receive(block=True)
+                    else:
+                        anneal_beta(buffer, args, env_step)
+                        losses = policy.update(batch_size, buffer)
+                        gradient_step += 1
+                        for k in losses.keys():
+                            stat[k].add(losses[k])
+                        if gradient_step % sync_every == 0:
+                            weights.publish(policy)
+                        if gradient_step % 100 == 0 and logger is not None:
+                            logger.log_update_data({k: stat[k].get() for k in stat}, gradient_step)
+                    t.update(min(env_step, epoch_end) - min(last, epoch_end))
+                    if ep_rews:
+                        t.set_postfix(rew=f"{ep_rews[-1]:.2f}", grad_step=str(gradient_step),
+                                      **{k: f"{stat[k].get():.3f}" for k in stat})
+            weights.publish(policy)
+
+            if save_fn:
+                save_fn(policy)
+            print("Testing agent ...")
+            policy.eval()
+            if hasattr(policy, 'set_eps'):
+                policy.set_eps(args.eps_test)
+            test_envs.seed(args.seed)
+            result = recorder.collect()
+            record_test(epoch, env_step, result)
+            if monitor is not None and monitor.stopped:
+                break
+    finally:
+        stop.set()
+        # actors may be blocked on a full queue
+        while any(p.is_alive() for p in actors):
+            try:
+                transitions.get(timeout=0.1)
+            except queue.Empty:
+                pass
+            for p in actors:
+                p.join(timeout=0.1)
+    if monitor is not None:
+        monitor.finish(env_step)
+    recorder.save(record_folder)
+    return {'duration': '{:.2f}s'.format(time.time() - start_time),
+            'env_step': env_step, 'gradient_step': gradient_step,
+            'train_rew': float(np.mean(ep_rews[-10:])) if ep_rews else 0.}
@@ -0,0 +1,138 @@
+"""End-of-epoch evaluation in a background process.
+
+The trainers run a full ``step_per_epoch`` test episode after every epoch, and
+training waits for it. :class:`AsyncEvaluator` forks an evaluation process that
+owns its own test envs and a CPU copy of the policy. At the end of an epoch the
+trainer sends it the current weights with :meth:`AsyncEvaluator.submit` and goes
+on training; finished evaluations (collect result plus the recorded act/obs/rew
+of the test episode) are picked up with :meth:`AsyncEvaluator.poll` at a later
+epoch end, and :meth:`AsyncEvaluator.drain` waits for the rest after training.
+
+A checkpoint keeps the evaluations that are still running
+(:meth:`AsyncEvaluator.pending_evals`); a resumed run hands them to
+:meth:`AsyncEvaluator.resubmit`, so every epoch still gets its test row.
+"""
+import copy
+import multiprocessing as mp
+
+import torch
+from tianshou.data import Collector, VectorReplayBuffer
+
+from .eval_recorder import KEYS
+
+
+def uses_async_eval(args):
+    """Whether the end-of-epoch tests of this run go to an :class:`AsyncEvaluator`.
+
+    Only the training run of the plain trainers does; the main process then needs
+    no test envs of its own.
+    """
+    return bool(getattr(args, 'async_eval', False)) and not getattr(args, 'test_only', False) \
+        and not getattr(args, 'watch', False) and getattr(args, 'apex_actors', 0) <= 0
+
+
+def _cpu_state_dict(policy):
+    return {k: v.detach().cpu() for k, v in policy.state_dict().items()}
+
+
+def _eval_worker(conn, policy, make_test_envs, n_step, seed, eps, buffer_kwargs):
+    # the parent keeps the GPU, the evaluation runs on CPU with one thread
+    torch.set_num_threads(1)
+    for m in policy.modules():
+        if hasattr(m, 'device'):
+            m.device = 'cpu'
+    test_envs = make_test_envs()
+    buffer = VectorReplayBuffer(n_step + 1, len(test_envs), **buffer_kwargs)
+    collector = Collector(policy, test_envs, buffer, exploration_noise=False)
+    try:
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                # the trainer is gone
+                break
+            if msg is None:
+                break
+            epoch, env_step, state_dict = msg
+            policy.load_state_dict(state_dict)
+            policy.eval()
+            if eps is not None:
+                policy.set_eps(eps)
+            test_envs.seed(seed)
+            buffer.reset()
+            collector.reset()
+            result = collector.collect(n_step=n_step)
+            traj = {k: getattr(buffer, k).copy() for k in KEYS}
+            conn.send((epoch, env_step, result, traj))
+    finally:
+        test_envs.close()
+        conn.close()
+
+
+class AsyncEvaluator(object):
+    """Evaluate policy weights in a forked process while training goes on.
+
+    :param policy: the policy being trained; the evaluation process gets a copy.
+    :param make_test_envs: builds the vector env of the evaluation process; it is
+        called inside that process.
+    :param int n_step: steps of one evaluation, as in the trainers' test collect.
+    :param int seed: the test envs are re-seeded with it before every evaluation.
+    :param float eps: exploration of the test policy, for the DQN policies.
+    :param int max_pending: :meth:`submit` blocks while this many evaluations are
+        still running, so a slow evaluation can not fall arbitrarily far behind.
+    :param dict buffer_kwargs: extra arguments of the test replay buffer.
+    """
+
+    def __init__(self, policy, make_test_envs, n_step, seed, eps=None, max_pending=2,
+                 buffer_kwargs=None):
+        # not a daemon, the test envs are subprocesses of the evaluation process
+        ctx = mp.get_context('fork')
+        self.conn, child_conn = ctx.Pipe()
+        eval_policy = copy.deepcopy(policy).to('cpu')
+        self.process = ctx.Process(
+            target=_eval_worker,
+            args=(child_conn, eval_policy, make_test_envs, n_step, seed, eps, buffer_kwargs or {}))
+        self.process.start()
+        child_conn.close()
+        self.max_pending = max_pending
+        # (epoch, env_step, state_dict) of the evaluations sent and not yet received
+        self.queued = []
+        self.done = []
+
+    def submit(self, epoch, env_step, policy):
+        """Queue an evaluation of the current weights of ``policy``."""
+        self.resubmit(epoch, env_step, _cpu_state_dict(policy))
+
+    def resubmit(self, epoch, env_step, state_dict):
+        """Queue an evaluation of saved weights, such as a checkpoint's pending ones."""
+        while len(self.queued) >= self.max_pending:
+            self._recv()
+        self.conn.send((epoch, env_step, state_dict))
+        self.queued.append((epoch, env_step, state_dict))
+
+    def pending_evals(self):
+        """The evaluations still running, as ``(epoch, env_step, state_dict)``."""
+        return list(self.queued)
+
+    def _recv(self):
+        self.done.append(self.conn.recv())
+        self.queued.pop(0)
+
+    def poll(self):
+        """Finished evaluations as ``(epoch, env_step, result, traj)``, oldest first."""
+        while self.queued and self.conn.poll():
+            self._recv()
+        done, self.done = self.done, []
+        return done
+
+    def drain(self):
+        """Wait for all queued evaluations and return them like :meth:`poll`."""
+        while self.queued:
+            self._recv()
+        return self.poll()
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(None)
+            self.process.join()
+        self.conn.close()
@@ -0,0 +1,274 @@
+"""Checkpoints of a whole training run, for jobs that hit the wall-clock limit.
+
+``save_fn`` only keeps ``policy.state_dict()``. :class:`Checkpointer` also keeps
+the optimizer and lr scheduler states, the plain attributes of the policy (DQN's
+``eps`` and target update counter, SAC's ``log_alpha``, ...), the epoch/env_step/
+gradient_step counters, the Python, NumPy and torch RNG states and the replay
+buffer. The same goes for the policies nested in the policy, such as the heads
+of a multi-weight policy.
+
+The buffer arrays are written in segments of ``segment`` rows, one ``.npy``
+file per segment, into a new generation directory ``<folder>/buffer/<n>``. A
+CRC32 of every segment is kept in the state file: only the segments whose CRC
+changed since the last checkpoint are written, the others are hard links to the
+files of the previous generation. No file is ever written twice, so the
+``os.replace`` that installs the new state file also switches the buffer to the
+new generation, and a job killed in the middle of a checkpoint leaves the last
+one intact. Older generations are removed afterwards.
+
+The background evaluations still running at the checkpoint are saved with their
+weights, see :meth:`Checkpointer.pending_evals`. The env workers are not: a
+resumed run starts new train envs, seeded with ``seed + epoch``, at the first
+step of an episode, so it is a statistically equivalent continuation of the
+run, not a bit-for-bit one.
+"""
+import os
+import pickle
+import random
+import shutil
+import zlib
+
+import numpy as np
+import torch
+from tianshou.data import Batch
+from tianshou.policy import BasePolicy
+
+STATE_FILE = 'state.pt'
+
+
+def _flatten(batch, prefix=''):
+    """``{'info.env_id': array, ...}`` from a possibly nested Batch."""
+    out = {}
+    for k, v in batch.items():
+        if isinstance(v, Batch):
+            out.update(_flatten(v, prefix + k + '.'))
+        elif isinstance(v, np.ndarray):
+            out[prefix + k] = v
+    return out
+
+
+def _unflatten(arrays):
+    nested = {}
+    for name, arr in arrays.items():
+        d = nested
+        parts = name.split('.')
+        for p in parts[:-1]:
+            d = d.setdefault(p, {})
+        d[parts[-1]] = arr
+    return Batch(nested)
+
+
+def link_or_copy(src, dst):
+    """Hard link ``src`` to ``dst``, copy it where links are not supported."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def link_tree(src, dst):
+    """Copy a checkpoint folder, its files are hard links into ``src``.
+
+    The checkpoint files are only ever replaced, never written in place, so the
+    copy does not change when ``src`` is checkpointed again.
+    """
+    shutil.copytree(src, dst, copy_function=link_or_copy)
+
+
+def _rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpointer(object):
+    """Save and restore everything a trainer needs to continue a run.
+
+    :param str folder: directory of the checkpoint.
+    :param policy: the policy being trained.
+    :param buffer: the training replay buffer, or None for the on-policy trainer.
+    :param int segment: buffer rows per incrementally written segment.
+    """
+
+    def __init__(self, folder, policy, buffer=None, segment=4096):
+        self.folder = folder
+        self.policy = policy
+        self.buffer = buffer
+        self.segment = segment
+        self.state = None
+        self.crc = {}
+        os.makedirs(os.path.join(folder, 'buffer'), exist_ok=True)
+        # never write into a generation an existing state file may point to
+        self.generation = max([int(g) for g in os.listdir(os.path.join(folder, 'buffer'))
+                               if g.isdigit()] or [0])
+
+    @property
+    def resumed(self):
+        return self.state is not None
+
+    def _policies(self):
+        """The policy and the policies nested in it, by module name."""
+        return [(name, m) for name, m in self.policy.named_modules() if isinstance(m, BasePolicy)]
+
+    def _policy_attrs(self):
+        optims, tensors, scalars = {}, {}, {}
+        for name, policy in self._policies():
+            prefix = name + '.' if name else ''
+            for k, v in vars(policy).items():
+                if isinstance(v, torch.optim.Optimizer):
+                    optims[prefix + k] = v.state_dict()
+                elif isinstance(v, torch.optim.lr_scheduler._LRScheduler):
+                    optims[prefix + k] = v.state_dict()
+                elif isinstance(v, torch.Tensor):
+                    tensors[prefix + k] = v.detach().cpu().clone()
+                elif isinstance(v, (bool, int, float, np.number)) and k != 'training':
+                    scalars[prefix + k] = v
+        return optims, tensors, scalars
+
+    def _owner(self, key):
+        """The (nested) policy and attribute name of a saved ``key``."""
+        name, _, attr = key.rpartition('.')
+        return dict(self._policies())[name], attr
+
+    def _generation_dir(self, generation):
+        return os.path.join(self.folder, 'buffer', str(generation))
+
+    def _save_buffer(self, generation):
+        """Write the buffer arrays into a new generation, return the buffer state."""
+        buf = self.buffer
+        prev = self._generation_dir(self.generation)
+        folder = self._generation_dir(generation)
+        # left over by a checkpoint that did not finish
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        crc_table = {}
+        for name, arr in _flatten(buf._meta).items():
+            old = self.crc.get(name, {})
+            if old.get('shape') != list(arr.shape) or old.get('dtype') != arr.dtype.str:
+                old = {}
+            segments = {}
+            for start in range(0, len(arr), self.segment):
+                seg = np.ascontiguousarray(arr[start:start + self.segment])
+                crc = zlib.crc32(seg.tobytes())
+                filename = '{}.{}.npy'.format(name, start)
+                if old.get('segments', {}).get(str(start)) == crc:
+                    link_or_copy(os.path.join(prev, filename), os.path.join(folder, filename))
+                else:
+                    np.save(os.path.join(folder, filename), seg)
+                segments[str(start)] = crc
+            crc_table[name] = {'shape': list(arr.shape), 'dtype': arr.dtype.str,
+                               'segments': segments}
+        # everything but the arrays: indices, sizes, offsets of the sub-buffers
+        meta = buf._meta
+        children = getattr(buf, 'buffers', [])
+        child_meta = [b._meta for b in children]
+        buf._meta = Batch()
+        for b in children:
+            b._meta = Batch()
+        try:
+            pointers = pickle.dumps(buf, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            buf._meta = meta
+            for b, m in zip(children, child_meta):
+                b._meta = m
+        return {'generation': generation, 'crc': crc_table, 'pointers': pointers}
+
+    def _remove_old_generations(self):
+        folder = os.path.join(self.folder, 'buffer')
+        for name in os.listdir(folder):
+            if name != str(self.generation):
+                shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+
+    def save(self, epoch, env_step, gradient_step, pending_evals=()):
+        """Checkpoint the run at the end of ``epoch``; usable as ``save_checkpoint_fn``.
+
+        :param pending_evals: ``(epoch, env_step, state_dict)`` of the background
+            evaluations that have not returned yet.
+        """
+        optims, tensors, scalars = self._policy_attrs()
+        buffer = None
+        if self.buffer is not None and len(self.buffer):
+            buffer = self._save_buffer(self.generation + 1)
+        state = {
+            'epoch': epoch, 'env_step': env_step, 'gradient_step': gradient_step,
+            'policy': self.policy.state_dict(), 'optims': optims,
+            'tensors': tensors, 'scalars': scalars, 'rng': _rng_state(), 'buffer': buffer,
+            'pending_evals': list(pending_evals),
+        }
+        path = os.path.join(self.folder, STATE_FILE)
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        if buffer is not None:
+            self.generation, self.crc = buffer['generation'], buffer['crc']
+        self._remove_old_generations()
+
+    def load(self):
+        """Restore the last checkpoint, if there is one. The RNG states are only
+        restored by :meth:`restore_rng`, right before the first resumed epoch."""
+        path = os.path.join(self.folder, STATE_FILE)
+        if not os.path.exists(path):
+            print("No checkpoint in {}, starting from scratch".format(self.folder))
+            return False
+        state = torch.load(path, map_location='cpu')
+        policy = self.policy
+        policy.load_state_dict(state['policy'])
+        for k, v in state['optims'].items():
+            owner, attr = self._owner(k)
+            getattr(owner, attr).load_state_dict(v)
+        for k, v in state['tensors'].items():
+            owner, attr = self._owner(k)
+            getattr(owner, attr).data.copy_(v)
+        for k, v in state['scalars'].items():
+            owner, attr = self._owner(k)
+            setattr(owner, attr, v)
+        if state['buffer'] is not None and self.buffer is not None:
+            self._load_buffer(state['buffer'])
+        self.state = state
+        print("Resuming from epoch {} (env step {}) of {}".format(
+            state['epoch'], state['env_step'], self.folder))
+        return True
+
+    def _load_buffer(self, state):
+        self.generation, self.crc = state['generation'], state['crc']
+        folder = self._generation_dir(self.generation)
+        arrays = {}
+        for name, table in self.crc.items():
+            arr = np.empty(table['shape'], dtype=np.dtype(table['dtype']))
+            for start in table['segments']:
+                seg = np.load(os.path.join(folder, '{}.{}.npy'.format(name, start)))
+                arr[int(start):int(start) + len(seg)] = seg
+            arrays[name] = arr
+        saved = pickle.loads(state['pointers'])
+        buf = self.buffer
+        buf.__dict__.update({k: v for k, v in saved.__dict__.items() if k not in ('_meta', 'buffers')})
+        for b, s in zip(getattr(buf, 'buffers', []), getattr(saved, 'buffers', [])):
+            b.__dict__.update({k: v for k, v in s.__dict__.items() if k != '_meta'})
+        buf._meta = _unflatten(arrays)
+        if hasattr(buf, '_set_batch_for_children'):
+            buf._set_batch_for_children()
+        if hasattr(buf, 'build_mirror'):
+            # the observation tensors of a device replay buffer
+            buf.build_mirror()
+
+    def counters(self):
+        return self.state['epoch'], self.state['env_step'], self.state['gradient_step']
+
+    def pending_evals(self):
+        """The evaluations the checkpointed run was still waiting for, to run again."""
+        if self.state is None:
+            return []
+        return self.state.get('pending_evals', [])
+
+    def restore_rng(self):
+        if self.state is not None:
+            _set_rng_state(self.state['rng'])
@@ -0,0 +1,145 @@
+"""Early stopping once the test reward has converged.
+
+The trainers hand every evaluation result to :class:`ConvergenceMonitor`, which
+stops the run at the first of these tests:
+
+* ``target``: the mean test reward reached ``target``;
+* ``plateau``: the moving average over ``window`` evaluations has not improved
+  by more than ``min_delta`` for ``patience`` evaluations;
+* ``ci``: the last ``window`` evaluations are not better than the ``window``
+  before them, by a one-sided z-test on the episode rewards of all test envs
+  (the evaluation zones and seeds) at ``ci_z`` standard errors.
+
+The weights of the best evaluation are kept in ``policy_best.pth`` and why the
+run ended is written to ``stop_reason.json``, also for runs that used all
+their epochs.
+"""
+import os
+import json
+import math
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+BEST_FILE = 'policy_best.pth'
+REASON_FILE = 'stop_reason.json'
+
+
+class ConvergenceMonitor(object):
+    """Track the test rewards of a run and decide when it has converged.
+
+    :param policy: the policy being trained.
+    :param str folder: where ``policy_best.pth`` and ``stop_reason.json`` go.
+    :param int window: evaluations in the moving average and in each half of
+        the confidence interval test.
+    :param int patience: evaluations without improvement of the moving average
+        before a plateau stop, 0 to disable.
+    :param float min_delta: smallest improvement of the moving average that counts.
+    :param float ci_z: z value of the confidence interval test, 0 to disable.
+    :param float target: stop once the mean test reward reaches it, None to disable.
+    :param int min_epochs: no plateau or confidence interval stop before this epoch.
+    """
+
+    def __init__(self, policy, folder, window=10, patience=0, min_delta=0., ci_z=0.,
+                 target=None, min_epochs=0):
+        self.policy = policy
+        self.folder = folder
+        self.window = window
+        self.patience = patience
+        self.min_delta = min_delta
+        self.ci_z = ci_z
+        self.target = target
+        self.min_epochs = min_epochs
+        self.history = []
+        self.best, self.best_epoch = -math.inf, None
+        self.best_avg, self.since_best_avg = -math.inf, 0
+        self.reason = None
+        self.weights = OrderedDict()
+        os.makedirs(folder, exist_ok=True)
+
+    @property
+    def stopped(self):
+        return self.reason is not None
+
+    def snapshot(self, epoch, policy):
+        """Keep the weights sent to a background evaluation of ``epoch``.
+
+        ``policy`` may also be a state dict, such as the weights of a pending
+        evaluation restored from a checkpoint.
+        """
+        state_dict = policy if isinstance(policy, dict) else policy.state_dict()
+        self.weights[epoch] = {k: v.detach().cpu().clone() for k, v in state_dict.items()}
+
+    def update(self, epoch, env_step, result):
+        """Add the test ``result`` of ``epoch``; return True once the run should stop."""
+        weights = self.weights.pop(epoch, None)
+        for e in [e for e in self.weights if e < epoch]:
+            del self.weights[e]
+        rews = np.asarray(result["rews"], dtype=np.float64).ravel()
+        if len(rews) == 0:
+            return self.stopped
+        mean = float(rews.mean())
+        self.history.append((epoch, env_step, mean, rews))
+        if mean > self.best:
+            self.best, self.best_epoch = mean, epoch
+            torch.save(weights if weights is not None else self.policy.state_dict(),
+                       os.path.join(self.folder, BEST_FILE))
+        if self.reason is None:
+            self.reason = self._check(epoch)
+            if self.reason is not None:
+                self._write(epoch, env_step)
+                print("Converged ({}) at epoch {}, best test reward {:.3f} at epoch {}".format(
+                    self.reason, epoch, self.best, self.best_epoch))
+        return self.stopped
+
+    def _check(self, epoch):
+        means = [h[2] for h in self.history]
+        if self.target is not None and means[-1] >= self.target:
+            return 'target'
+        if len(means) >= self.window:
+            avg = float(np.mean(means[-self.window:]))
+            if avg > self.best_avg + self.min_delta:
+                self.best_avg, self.since_best_avg = avg, 0
+            else:
+                self.since_best_avg += 1
+        if epoch < self.min_epochs:
+            return None
+        if self.patience and self.since_best_avg >= self.patience:
+            return 'plateau'
+        if self.ci_z and len(self.history) >= 2 * self.window:
+            new = np.concatenate([h[3] for h in self.history[-self.window:]])
+            old = np.concatenate([h[3] for h in self.history[-2 * self.window:-self.window]])
+            if len(new) > 1 and len(old) > 1:
+                se = math.sqrt(new.var(ddof=1) / len(new) + old.var(ddof=1) / len(old))
+                if new.mean() - old.mean() < self.ci_z * se:
+                    return 'ci'
+        return None
+
+    def _write(self, epoch, env_step):
+        means = [h[2] for h in self.history]
+        info = {
+            'reason': self.reason, 'epoch': epoch, 'env_step': env_step,
+            'best_epoch': self.best_epoch, 'best_reward': self.best,
+            'moving_avg': float(np.mean(means[-self.window:])),
+            'evaluations': len(self.history), 'time': time.time(),
+        }
+        with open(os.path.join(self.folder, REASON_FILE), 'w') as fp:
+            json.dump(info, fp, indent=2)
+
+    def finish(self, env_step):
+        """Record a run that ended without converging."""
+        if self.reason is None and self.history:
+            self.reason = 'max_epoch'
+            self._write(self.history[-1][0], env_step)
+
+
+def make_monitor(policy, folder, args):
+    """A :class:`ConvergenceMonitor` from the ``--stop-*`` args, or None if all are off."""
+    if not (args.stop_patience or args.stop_ci or args.stop_target is not None):
+        return None
+    return ConvergenceMonitor(policy, folder, window=args.stop_window,
+                              patience=args.stop_patience, min_delta=args.stop_min_delta,
+                              ci_z=args.stop_ci, target=args.stop_target,
+                              min_epochs=args.stop_min_epochs)
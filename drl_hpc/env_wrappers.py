@@ -0,0 +1,102 @@
+"""Wrappers around the building envs that change what one ``step`` means."""
+import gym
+import numpy as np
+
+
+def macro_steps(args):
+    """Agent steps in one episode of ``args.step_per_epoch`` co-simulation intervals.
+
+    The simulated horizon stays ``step_per_epoch * time_step`` whatever the
+    ``--action-repeat``, so an epoch, a test episode and an evaluation record take
+    ``step_per_epoch // action_repeat`` steps. A repeat that does not divide the
+    episode is rejected.
+    """
+    repeat = getattr(args, 'action_repeat', 1)
+    if repeat < 1 or args.step_per_epoch % repeat:
+        raise ValueError('--action-repeat {} does not divide the episode of {} intervals'.format(
+            repeat, args.step_per_epoch))
+    return args.step_per_epoch // repeat
+
+
+class ActionRepeatWrapper(gym.Wrapper):
+    """Hold every action for ``repeat`` co-simulation intervals (a macro step).
+
+    The intervals are simulated inside the worker, so one macro step costs one
+    pipe round trip and one policy forward instead of ``repeat``. The rewards of
+    the intervals are summed. The last observation is returned, and the data of
+    every interval goes in ``info['intervals']`` so it can be recorded or expanded
+    into single-interval transitions:
+
+    - ``n``: number of intervals simulated, less than ``repeat`` only when the
+      episode ends in the middle of the macro step
+    - ``obs``: (repeat, obs_dim) observations after each interval
+    - ``rew``: (repeat,) rewards
+    - ``cost``, ``penalty``: (repeat,) reward components, if ``reward_fn`` is given
+
+    The arrays are zero after the first ``n`` rows; their shape is fixed so the
+    info of several envs can be stacked into one Batch.
+
+    :param int repeat: number of intervals per macro step.
+    :param reward_fn: the :class:`reward.RewardEngine` the env reports to; its
+        last ``cost`` and ``penalty`` are read after every interval.
+    """
+
+    def __init__(self, env, repeat, reward_fn=None):
+        super().__init__(env)
+        self.repeat = repeat
+        self.reward_fn = reward_fn
+        obs_shape = env.observation_space.shape
+        self._obs = np.zeros((repeat,) + obs_shape, dtype=env.observation_space.dtype)
+        self._rew = np.zeros(repeat)
+        self._cost = np.zeros(repeat)
+        self._penalty = np.zeros(repeat)
+
+    def step(self, action):
+        total = 0.
+        self._obs[:] = 0
+        self._rew[:] = 0
+        self._cost[:] = 0
+        self._penalty[:] = 0
+        for i in range(self.repeat):
+            obs, rew, done, info = self.env.step(action)
+            self._obs[i] = obs
+            self._rew[i] = rew
+            if self.reward_fn is not None:
+                self._cost[i] = self.reward_fn.cost[0]
+                self._penalty[i] = self.reward_fn.penalty[0]
+            total += rew
+            if done:
+                break
+        intervals = {'n': i + 1, 'obs': self._obs.copy(), 'rew': self._rew.copy()}
+        if self.reward_fn is not None:
+            intervals['cost'] = self._cost.copy()
+            intervals['penalty'] = self._penalty.copy()
+        info = dict(info, intervals=intervals)
+        return obs, total, done, info
+
+
+class RewardComponentsWrapper(gym.Wrapper):
+    """Put the energy ``cost`` and temperature ``penalty`` of every step in its info.
+
+    The collectors store them next to the reward in the replay buffer, so the
+    reward can be recomputed for other weights (:func:`replay.relabel`). Around
+    an :class:`ActionRepeatWrapper` they are summed over the intervals of the
+    macro step, like the reward.
+
+    :param reward_fn: the :class:`reward.RewardEngine` the env reports to.
+    """
+
+    def __init__(self, env, reward_fn):
+        super().__init__(env)
+        self.reward_fn = reward_fn
+
+    def step(self, action):
+        obs, rew, done, info = self.env.step(action)
+        intervals = info.get('intervals')
+        if intervals is not None and 'cost' in intervals:
+            n = intervals['n']
+            cost, penalty = intervals['cost'][:n].sum(), intervals['penalty'][:n].sum()
+        else:
+            cost, penalty = self.reward_fn.cost[0], self.reward_fn.penalty[0]
+        info = dict(info, cost=float(cost), penalty=float(penalty))
+        return obs, rew, done, info
@@ -0,0 +1,206 @@
+"""Recorder of the end-of-epoch evaluation trajectories.
+
+The trainers used to build a new ``VectorReplayBuffer`` and ``Collector`` for every
+test episode, pull ``act``/``obs``/``rew`` out of ``buffer._meta`` and append them
+to Python lists that were only written to ``his_*.npy`` after the last epoch.
+:class:`EvalRecorder` keeps one test buffer and collector for the whole run and
+copies every episode into arrays of shape ``(epochs, buffer_size, ...)``.
+
+With a ``folder`` the arrays are the ``his_*.npy`` files themselves, opened as
+memory maps and flushed after every epoch, and one line per recorded epoch is
+appended to ``his_meta.jsonl``. Memory stays flat, a job killed at its wall-clock
+limit keeps all finished epochs, and :func:`load_trajectories` reads the epochs
+recorded so far while the job is still running. While the run goes on the files
+have a row for every epoch; :meth:`EvalRecorder.save` cuts them down to the
+recorded rows, so a run that stopped early leaves no rows of zeros behind.
+"""
+import os
+import json
+import time
+
+import numpy as np
+from tianshou.data import Collector, VectorReplayBuffer
+
+KEYS = ('act', 'obs', 'rew')
+META_FILE = 'his_meta.jsonl'
+
+
+def traj_path(folder, key, suffix=''):
+    return os.path.join(folder, 'his_{}{}.npy'.format(key, suffix))
+
+
+def resize(path, rows):
+    """Rewrite the ``.npy`` file at ``path`` with ``rows`` rows, keeping the rows it has."""
+    old = np.load(path, mmap_mode='r')
+    if len(old) == rows:
+        return
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    new = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=old.dtype,
+                                    shape=(rows,) + old.shape[1:])
+    n = min(rows, len(old))
+    new[:n] = old[:n]
+    new.flush()
+    del new, old
+    os.replace(tmp_path, path)
+
+
+class EvalRecorder(object):
+    """Collect test episodes and keep their trajectories, one row per epoch.
+
+    :param policy: the policy under test.
+    :param test_envs: the test vector env.
+    :param int steps: steps of one test episode.
+    :param int epochs: number of episodes that will be recorded.
+    :param str folder: if given, record into memory-mapped ``his_*.npy`` files
+        and ``his_meta.jsonl`` there; otherwise keep the arrays in memory.
+    :param dict buffer_kwargs: extra arguments of the test replay buffer.
+    :param int resume_epoch: continue the record in ``folder`` of a resumed run;
+        rows of later epochs are dropped.
+    :param rerun_epochs: epochs whose evaluations the resumed run repeats; their
+        rows are dropped as well.
+    """
+
+    def __init__(self, policy, test_envs, steps, epochs, folder=None, buffer_kwargs=None,
+                 resume_epoch=None, rerun_epochs=()):
+        self.policy = policy
+        self.test_envs = test_envs
+        self.steps = steps
+        self.epochs = epochs
+        self.folder = folder
+        self.buffer_kwargs = buffer_kwargs or {}
+        self.buffer = None
+        self.collector = None
+        self.data = {}
+        self.size = 0
+        if folder is None:
+            return
+        meta_path = os.path.join(folder, META_FILE)
+        meta = load_meta(folder) if resume_epoch is not None else None
+        if meta:
+            # the repeated evaluations are the last ones, the kept rows stay contiguous
+            meta = [m for m in meta if m.get('epoch', 0) <= resume_epoch
+                    and m.get('epoch') not in rerun_epochs]
+            with open(meta_path, 'w') as fp:
+                for m in meta:
+                    fp.write(json.dumps(m) + '\n')
+            for k in KEYS:
+                # the record of a finished run was cut down to its rows
+                resize(traj_path(folder, k), epochs)
+                self.data[k] = np.load(traj_path(folder, k), mmap_mode='r+')
+            self.size = len(meta)
+        elif os.path.exists(meta_path):
+            # a new run in the same folder starts a new record
+            os.remove(meta_path)
+
+    def collect(self):
+        """Run one test episode with the current policy."""
+        if self.collector is None:
+            self.buffer = VectorReplayBuffer(self.steps + 1, len(self.test_envs),
+                                             **self.buffer_kwargs)
+            self.collector = Collector(self.policy, self.test_envs, self.buffer,
+                                       exploration_noise=False)
+        self.collector.reset()
+        return self.collector.collect(n_step=self.steps)
+
+    def trajectory(self):
+        """The arrays of the last collected episode."""
+        return {k: getattr(self.buffer, k) for k in KEYS}
+
+    def _allocate(self, key, arr):
+        shape = (self.epochs,) + arr.shape
+        if self.folder is None:
+            return np.zeros(shape, dtype=arr.dtype)
+        return np.lib.format.open_memmap(traj_path(self.folder, key), mode='w+',
+                                         dtype=arr.dtype, shape=shape)
+
+    def add(self, traj, **meta):
+        """Record the arrays of one episode, with ``meta`` such as its epoch.
+
+        :param dict traj: ``act``, ``obs`` and ``rew`` of the episode.
+        """
+        if self.size >= self.epochs:
+            raise ValueError("EvalRecorder is full ({} epochs)".format(self.epochs))
+        for k in KEYS:
+            arr = np.asarray(traj[k])
+            if k not in self.data:
+                self.data[k] = self._allocate(k, arr)
+            self.data[k][self.size] = arr
+        if self.folder is not None:
+            for k in KEYS:
+                self.data[k].flush()
+            # the meta line is written last, a row only counts once its line exists
+            with open(os.path.join(self.folder, META_FILE), 'a') as fp:
+                fp.write(json.dumps(dict(meta, row=self.size, time=time.time())) + '\n')
+        self.size += 1
+
+    def get(self, key):
+        """The recorded ``key`` array of the epochs so far."""
+        return self.data[key][:self.size]
+
+    def save(self, folder, suffix=''):
+        """Write ``his_act``/``his_obs``/``his_rew`` in the format of the old trainers.
+
+        For a recorder with its own ``folder`` the files are already on disk; they
+        are flushed and cut down to the recorded epochs. Call it once, at the end
+        of the run.
+        """
+        if self.folder is not None and os.path.abspath(folder) == os.path.abspath(self.folder) \
+                and not suffix:
+            keys = list(self.data)
+            for k in keys:
+                self.data[k].flush()
+            self.data = {}
+            for k in keys:
+                resize(traj_path(self.folder, k), self.size)
+                self.data[k] = np.load(traj_path(self.folder, k), mmap_mode='r')
+            return
+        for k in KEYS:
+            if k in self.data:
+                np.save(traj_path(folder, k, suffix), self.get(k))
+
+
+def load_meta(folder):
+    """The meta records of ``his_meta.jsonl``, or None for runs without one."""
+    path = os.path.join(folder, META_FILE)
+    if not os.path.exists(path):
+        return None
+    meta = []
+    with open(path) as fp:
+        for line in fp:
+            try:
+                meta.append(json.loads(line))
+            except ValueError:
+                # a line cut short by a killed job
+                break
+    return meta
+
+
+def load_trajectories(folder, keys=KEYS, epochs=None, mmap=True):
+    """Read recorded trajectories, also of a run that is still going or was killed.
+
+    Only the rows listed in ``his_meta.jsonl`` are returned; files without meta
+    are returned whole. Missing files are left out.
+
+    :param tuple keys: which ``his_<key>.npy`` files to read.
+    :param epochs: only return the rows of these epochs.
+    :param bool mmap: map the files instead of reading them into memory.
+    :return: ``(data, meta)`` with ``data[key]`` of shape ``(rows, ...)``.
+    """
+    meta = load_meta(folder)
+    if meta is not None and epochs is not None:
+        epochs = set(epochs)
+        meta = [m for m in meta if m.get('epoch') in epochs]
+    data = {}
+    for k in keys:
+        path = traj_path(folder, k)
+        if not os.path.exists(path):
+            continue
+        arr = np.load(path, mmap_mode='r' if mmap else None)
+        if meta is not None:
+            rows = [m['row'] for m in meta]
+            if rows == list(range(len(rows))):
+                arr = arr[:len(rows)]
+            else:
+                arr = arr[rows]
+        data[k] = arr
+    return data, meta
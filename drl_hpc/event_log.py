@@ -0,0 +1,171 @@
+"""Structured event log kept in memory and flushed to a binary file in bulk.
+
+Printing a line per step from the reward function and ``train_fn`` fills the
+SLURM output files and costs a write syscall per line. Here every event is one
+fixed-size record (time, worker, epoch, step, kind, up to 8 float values) in a
+preallocated NumPy array of each process. The array is appended to
+``<log_dir>/events.<worker>.bin`` when it is full, when the epoch changes, when
+its oldest record is ``flush_interval`` seconds old, at :func:`flush` and at
+process exit. The env workers are often killed rather than left to exit, so at
+most the records of the last ``flush_interval`` seconds of the current epoch are
+lost with them. :func:`read_events` loads the files back and filters them by
+kind, worker, epoch and step.
+
+Usage::
+
+    event_log.configure(log_dir)        # in the main process, before the envs fork
+    event_log.record('eps', env_step, eps)
+    event_log.set_epoch(epoch)
+
+The kinds written by the trainers and envs:
+
+- ``reward``: cost, penalty and reward of every env step, from the env workers
+- ``eps``: the exploration epsilon set by ``train_fn``
+- ``train``: steps, finished episodes and their mean reward of every train collect
+- ``test``: mean and std of the test reward and the number of test episodes
+
+    python -m drl_hpc.event_log <log_dir> --kind reward --epoch 3
+"""
+import os
+import glob
+import time
+import argparse
+import multiprocessing as mp
+from multiprocessing.util import Finalize
+
+import numpy as np
+
+N_VALUES = 8
+RECORD_DTYPE = np.dtype([('time', 'f8'), ('worker', 'i4'), ('epoch', 'i4'), ('step', 'i8'),
+                         ('kind', 'u1'), ('values', 'f4', (N_VALUES,))])
+# the codes are stored in the files, only ever append to this tuple
+KINDS = ('reward', 'eps', 'train', 'test')
+
+_CONFIG = {'log_dir': None, 'capacity': 1 << 16, 'flush_interval': 30.}
+_EPOCH = None
+_LOGS = {}
+
+
+class EventLog(object):
+    """Ring buffer of event records of one process.
+
+    :param str path: binary file the records are appended to.
+    :param int worker: worker id stored in every record.
+    :param int capacity: number of records kept in memory between flushes.
+    :param float flush_interval: longest time in seconds a record stays in memory.
+    """
+
+    def __init__(self, path, worker, capacity, flush_interval=30.):
+        self.path = path
+        self.worker = worker
+        self.records = np.zeros(capacity, dtype=RECORD_DTYPE)
+        self.records['worker'] = worker
+        self.size = 0
+        self.flush_interval = flush_interval
+
+    def record(self, kind, step, *values):
+        now = time.time()
+        epoch = _EPOCH.value if _EPOCH is not None else -1
+        if self.size and (epoch != self.records['epoch'][0]
+                          or now - self.records['time'][0] > self.flush_interval):
+            self.flush()
+        i = self.size
+        records = self.records
+        records['time'][i] = now
+        records['epoch'][i] = epoch
+        records['step'][i] = step
+        records['kind'][i] = KINDS.index(kind)
+        records['values'][i, :len(values)] = values
+        records['values'][i, len(values):] = np.nan
+        self.size += 1
+        if self.size == len(self.records):
+            self.flush()
+
+    def flush(self):
+        if self.size == 0:
+            return
+        with open(self.path, 'ab') as f:
+            f.write(self.records[:self.size].tobytes())
+        self.size = 0
+
+
+def configure(log_dir, capacity=1 << 16, flush_interval=30.):
+    """Turn event logging on for this process and the workers it forks later."""
+    global _EPOCH
+    os.makedirs(log_dir, exist_ok=True)
+    _CONFIG['log_dir'] = log_dir
+    _CONFIG['capacity'] = capacity
+    _CONFIG['flush_interval'] = flush_interval
+    if _EPOCH is None:
+        # shared with the forked workers, so their records carry the current epoch
+        _EPOCH = mp.Value('i', 0, lock=False)
+
+
+def set_epoch(epoch):
+    if _EPOCH is not None:
+        _EPOCH.value = epoch
+
+
+def get_log():
+    """The event log of this process, or None if logging is not configured."""
+    if _CONFIG['log_dir'] is None:
+        return None
+    pid = os.getpid()
+    log = _LOGS.get(pid)
+    if log is None:
+        path = os.path.join(_CONFIG['log_dir'], 'events.{}.bin'.format(pid))
+        log = _LOGS[pid] = EventLog(path, pid, _CONFIG['capacity'], _CONFIG['flush_interval'])
+        # multiprocessing children skip atexit, but run finalizers with an exit priority
+        Finalize(log, log.flush, exitpriority=10)
+    return log
+
+
+def record(kind, step, *values):
+    log = get_log()
+    if log is not None:
+        log.record(kind, step, *values)
+
+
+def flush():
+    log = _LOGS.get(os.getpid())
+    if log is not None:
+        log.flush()
+
+
+def read_events(log_dir, kind=None, worker=None, epoch=None, steps=None):
+    """Load the records of all workers, sorted by time.
+
+    :param str kind: keep only this kind of events.
+    :param int worker: keep only this worker (process id).
+    :param epoch: an epoch or a list of epochs to keep.
+    :param tuple steps: ``(first, last)`` step range to keep, inclusive.
+    """
+    parts = [np.fromfile(p, dtype=RECORD_DTYPE)
+             for p in sorted(glob.glob(os.path.join(log_dir, 'events.*.bin')))]
+    events = np.concatenate(parts) if parts else np.zeros(0, dtype=RECORD_DTYPE)
+    mask = np.ones(len(events), dtype=bool)
+    if kind is not None:
+        mask &= events['kind'] == KINDS.index(kind)
+    if worker is not None:
+        mask &= events['worker'] == worker
+    if epoch is not None:
+        mask &= np.isin(events['epoch'], epoch)
+    if steps is not None:
+        mask &= (events['step'] >= steps[0]) & (events['step'] <= steps[1])
+    events = events[mask]
+    return events[np.argsort(events['time'], kind='stable')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print the events of a run')
+    parser.add_argument('log_dir', type=str)
+    parser.add_argument('--kind', type=str, default=None, choices=KINDS)
+    parser.add_argument('--worker', type=int, default=None)
+    parser.add_argument('--epoch', type=int, nargs='*', default=None)
+    parser.add_argument('--steps', type=int, nargs=2, default=None)
+    args = parser.parse_args()
+    for e in read_events(args.log_dir, args.kind, args.worker, args.epoch, args.steps):
+        values = e['values'][~np.isnan(e['values'])]
+        print('{:.3f} worker {} epoch {} step {} {} {}'.format(
+            e['time'], e['worker'], e['epoch'], e['step'], KINDS[e['kind']],
+            ' '.join('{:.6g}'.format(v) for v in values)))
@@ -0,0 +1,245 @@
+"""FMU instance pool and in-memory snapshots of the initialized simulator.
+
+``gym.make`` on the JModelica building envs loads the FMU from disk, and every
+``reset`` re-initializes the model at ``simulation_start_time``. Here each worker
+process builds its env once, keeps the FMU state right after the first reset
+(FMI 2.0 get/set FMU state) and restores that state in place on later resets.
+
+The envs are modelicagym-style: the pyfmi model lives in ``env.unwrapped.model``
+and the episode bookkeeping (current time window, done flag, last state) in
+plain attributes next to it. Both are captured in a :class:`FMUSnapshot`.
+"""
+import os
+import copy
+import pickle
+
+import gym
+import numpy as np
+
+# episode bookkeeping kept by the env next to the FMU itself
+EPISODE_ATTRS = ('start', 'stop', 'done', 'state', 'steps_beyond_done',
+                 'simulation_start_time', 'simulation_end_time')
+
+
+def get_fmu(env):
+    """Return the pyfmi model behind a (possibly wrapped) building env, or None."""
+    return getattr(env.unwrapped, 'model', None)
+
+
+def supports_fmu_state(fmu, serialize=False):
+    """Check the FMI capability flags needed for get/set (and serialize) FMU state."""
+    if fmu is None or not hasattr(fmu, 'get_capability_flags'):
+        return False
+    flags = fmu.get_capability_flags()
+    if not flags.get('canGetAndSetFMUstate', False):
+        return False
+    if serialize:
+        return flags.get('canSerializeFMUstate', False)
+    return True
+
+
+def _nbytes(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(o) for o in obj)
+    return 0
+
+
+class FMUSnapshot(object):
+    """FMU state plus the env attributes needed to resume simulating from it.
+
+    :param fmu_state: opaque state returned by ``fmu.get_fmu_state()``.
+    :param dict attrs: copies of the env bookkeeping attributes.
+    :param obs: the observation the env returned at this point.
+    """
+
+    def __init__(self, fmu_state, attrs, obs):
+        self.fmu_state = fmu_state
+        self.attrs = attrs
+        self.obs = obs
+
+    @classmethod
+    def take(cls, env, obs, attrs=EPISODE_ATTRS):
+        unwrapped = env.unwrapped
+        fmu_state = get_fmu(env).get_fmu_state()
+        saved = {k: copy.deepcopy(getattr(unwrapped, k))
+                 for k in attrs if hasattr(unwrapped, k)}
+        return cls(fmu_state, saved, np.array(obs, copy=True))
+
+    def restore(self, env):
+        """Put ``env`` back into this snapshot and return the snapshot observation."""
+        unwrapped = env.unwrapped
+        get_fmu(env).set_fmu_state(self.fmu_state)
+        for k, v in self.attrs.items():
+            setattr(unwrapped, k, copy.deepcopy(v))
+        return self.obs.copy()
+
+    def free(self, env):
+        fmu = get_fmu(env)
+        if fmu is not None and self.fmu_state is not None:
+            fmu.free_fmu_state(self.fmu_state)
+        self.fmu_state = None
+
+    def to_bytes(self, env):
+        """Serialize the snapshot so that it can be moved to another process or disk."""
+        serialized = get_fmu(env).serialize_fmu_state(self.fmu_state)
+        return pickle.dumps((serialized, self.attrs, self.obs),
+                            protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_bytes(cls, env, data):
+        serialized, attrs, obs = pickle.loads(data)
+        fmu_state = get_fmu(env).deserialize_fmu_state(serialized)
+        return cls(fmu_state, attrs, obs)
+
+    def nbytes(self, env):
+        """Size of the serialized FMU state, used for memory accounting."""
+        return _nbytes(get_fmu(env).serialize_fmu_state(self.fmu_state))
+
+
+class SnapshotResetWrapper(gym.Wrapper):
+    """Reset the building env by restoring the FMU state taken after its initialization.
+
+    With several ``start_times`` every reset picks one at random, and each start
+    time gets its own snapshot. Snapshots missing in memory are looked up in the
+    on-disk ``store`` (see :class:`state_cache.StartStateCache`) before the env is
+    initialized at that time, and newly taken snapshots are written to it.
+
+    Falls back to the env's own ``reset`` if the FMU can not get/set its state,
+    or if restoring fails for any reason.
+
+    :param list start_times: simulation start times in seconds. Default to the
+        env's own ``simulation_start_time``.
+    :param float episode_length: seconds from start to end of an episode, used to
+        move ``simulation_end_time`` along with the start time.
+    :param store: optional persistent snapshot store.
+    """
+
+    def __init__(self, env, attrs=EPISODE_ATTRS, start_times=None, episode_length=None,
+                 store=None, seed=None):
+        super().__init__(env)
+        self.attrs = attrs
+        self.enabled = supports_fmu_state(get_fmu(env))
+        self.start_times = start_times or [getattr(env.unwrapped, 'simulation_start_time', None)]
+        self.episode_length = episode_length
+        self.store = store if supports_fmu_state(get_fmu(env), serialize=True) else None
+        self.rng = np.random.RandomState(seed)
+        self.snapshots = {}
+        self.snapshot = None
+
+    def seed(self, seed=None):
+        self.rng.seed(seed)
+        return self.env.seed(seed)
+
+    def _set_episode(self, start_time):
+        unwrapped = self.env.unwrapped
+        if start_time is not None and hasattr(unwrapped, 'simulation_start_time'):
+            unwrapped.simulation_start_time = start_time
+            if self.episode_length is not None and hasattr(unwrapped, 'simulation_end_time'):
+                unwrapped.simulation_end_time = start_time + self.episode_length
+
+    def _initialize(self, start_time, **kwargs):
+        self._set_episode(start_time)
+        return self.env.reset(**kwargs)
+
+    def reset(self, **kwargs):
+        if len(self.start_times) > 1:
+            start_time = self.start_times[self.rng.randint(len(self.start_times))]
+        else:
+            start_time = self.start_times[0]
+        self.snapshot = self.snapshots.get(start_time)
+        if self.snapshot is None and self.store is not None:
+            self.snapshot = self.store.load(self.env, start_time)
+            if self.snapshot is not None:
+                self.snapshots[start_time] = self.snapshot
+        if self.snapshot is not None:
+            try:
+                obs = self.snapshot.restore(self.env)
+                # a stored snapshot may have been taken by a run with other episodes
+                self._set_episode(start_time)
+                return obs
+            except Exception as e:
+                print("FMU snapshot restore failed, re-initializing: {}".format(e))
+                self.drop_snapshots()
+        obs = self._initialize(start_time, **kwargs)
+        if self.enabled:
+            self.snapshot = FMUSnapshot.take(self.env, obs, self.attrs)
+            self.snapshots[start_time] = self.snapshot
+            if self.store is not None:
+                self.store.save(self.env, start_time, self.snapshot)
+        return obs
+
+    def drop_snapshots(self):
+        for snapshot in self.snapshots.values():
+            try:
+                snapshot.free(self.env)
+            except Exception:
+                pass
+        self.snapshots = {}
+        self.snapshot = None
+
+    def close(self):
+        self.drop_snapshots()
+        return self.env.close()
+
+
+class PooledEnv(gym.Wrapper):
+    """Env handed out by :func:`pooled_env`; ``close`` returns it to the pool."""
+
+    def __init__(self, env, key):
+        super().__init__(env)
+        self.pool_key = key
+
+    def close(self):
+        _POOL.setdefault(self.pool_key, []).append(self)
+
+
+# envs are only reused inside the process that built them, never across a fork
+_POOL = {}
+
+
+def pool_key(task, env_kwargs):
+    return (os.getpid(), task, repr(sorted(env_kwargs.items())))
+
+
+def pooled_env(task, env_kwargs, make_fn, **snapshot_kwargs):
+    """Get an initialized env for ``(task, env_kwargs)`` from this process' pool.
+
+    :param str task: gym id of the env.
+    :param dict env_kwargs: the keyword arguments that identify the env instance.
+    :param make_fn: builds a new env when the pool is empty.
+    :param snapshot_kwargs: passed on to :class:`SnapshotResetWrapper`.
+    """
+    key = pool_key(task, dict(env_kwargs, **snapshot_kwargs))
+    free = _POOL.get(key)
+    if free:
+        return free.pop()
+    return PooledEnv(SnapshotResetWrapper(make_fn(), **snapshot_kwargs), key)
+
+
+def close_pool():
+    """Really close every env kept in the pool of this process."""
+    for key in list(_POOL):
+        if key[0] != os.getpid():
+            continue
+        for env in _POOL.pop(key):
+            env.env.close()
+
+
+def trim_pool(max_idle):
+    """Really close the idle envs of this process beyond ``max_idle``, oldest pool keys first."""
+    idle = sum(len(envs) for key, envs in _POOL.items() if key[0] == os.getpid())
+    for key in list(_POOL):
+        if idle <= max_idle:
+            break
+        if key[0] != os.getpid():
+            continue
+        envs = _POOL[key]
+        while envs and idle > max_idle:
+            envs.pop(0).env.close()
+            idle -= 1
+        if not envs:
+            del _POOL[key]
@@ -0,0 +1,168 @@
+"""Fused gradient steps for the off-policy trainers.
+
+With ``step_per_collect=1`` and ``update_per_step=1``, ``offpolicy_trainer_1`` calls
+``policy.update`` once per env step and after each call formats the losses,
+updates the moving averages, logs and refreshes tqdm. :class:`FusedUpdater`
+instead gathers the gradient steps owed by ``fuse`` env steps, samples all
+their minibatch indices at once and runs them back to back. The losses are
+summed in place and handed to the logger and tqdm only every ``log_interval``
+gradient steps.
+
+The ``learn`` of tianshou's policies returns its losses as Python floats, which
+waits for the device after every gradient step. For ``DQNPolicy`` and
+``DiscreteSACPolicy`` the updater runs a copy of their ``learn`` that keeps the
+losses as detached tensors, so the host only syncs when they are logged. Other
+policies go through their own ``learn``.
+"""
+from collections import defaultdict
+
+import numpy as np
+import torch
+from tianshou.data import to_torch, to_torch_as
+from tianshou.policy import DiscreteSACPolicy, DQNPolicy
+from tianshou.utils import MovAvg
+
+
+def _dqn_learn(policy, batch):
+    """``DQNPolicy.learn`` of tianshou 0.4, returning the loss as a tensor."""
+    if policy._target and policy._iter % policy._freq == 0:
+        policy.sync_weight()
+    policy.optim.zero_grad()
+    weight = batch.pop("weight", 1.0)
+    q = policy(batch).logits
+    q = q[np.arange(len(q)), batch.act]
+    r = to_torch_as(batch.returns.flatten(), q)
+    td = r - q
+    loss = (td.pow(2) * weight).mean()
+    batch.weight = td  # prio-buffer
+    loss.backward()
+    policy.optim.step()
+    policy._iter += 1
+    return {"loss": loss.detach()}
+
+
+def _discrete_sac_learn(policy, batch):
+    """``DiscreteSACPolicy.learn`` of tianshou 0.4, returning the losses as tensors."""
+    weight = batch.pop("weight", 1.0)
+    target_q = batch.returns.flatten()
+    act = to_torch(batch.act[:, np.newaxis], device=target_q.device, dtype=torch.long)
+
+    current_q1 = policy.critic1(batch.obs).gather(1, act).flatten()
+    td1 = current_q1 - target_q
+    critic1_loss = (td1.pow(2) * weight).mean()
+    policy.critic1_optim.zero_grad()
+    critic1_loss.backward()
+    policy.critic1_optim.step()
+
+    current_q2 = policy.critic2(batch.obs).gather(1, act).flatten()
+    td2 = current_q2 - target_q
+    critic2_loss = (td2.pow(2) * weight).mean()
+    policy.critic2_optim.zero_grad()
+    critic2_loss.backward()
+    policy.critic2_optim.step()
+    batch.weight = (td1 + td2) / 2.0  # prio-buffer
+
+    dist = policy(batch).dist
+    entropy = dist.entropy()
+    with torch.no_grad():
+        q = torch.min(policy.critic1(batch.obs), policy.critic2(batch.obs))
+    actor_loss = -(policy._alpha * entropy + (dist.probs * q).sum(dim=-1)).mean()
+    policy.actor_optim.zero_grad()
+    actor_loss.backward()
+    policy.actor_optim.step()
+
+    result = {
+        "loss/actor": actor_loss.detach(),
+        "loss/critic1": critic1_loss.detach(),
+        "loss/critic2": critic2_loss.detach(),
+    }
+    if policy._is_auto_alpha:
+        log_prob = -entropy.detach() + policy._target_entropy
+        alpha_loss = -(policy._log_alpha * log_prob).mean()
+        policy._alpha_optim.zero_grad()
+        alpha_loss.backward()
+        policy._alpha_optim.step()
+        policy._alpha = policy._log_alpha.detach().exp()
+        result["loss/alpha"] = alpha_loss.detach()
+        result["alpha"] = policy._alpha
+
+    policy.sync_weight()
+    return result
+
+
+# exact types only, a subclass may have its own learn
+_TENSOR_LEARN = {DQNPolicy: _dqn_learn, DiscreteSACPolicy: _discrete_sac_learn}
+
+
+class FusedUpdater(object):
+    """Run the gradient steps of many env steps in one call.
+
+    :param policy: the policy being trained.
+    :param int batch_size: minibatch size of one gradient step.
+    :param int fuse: gradient steps gathered before they are run.
+    :param int log_interval: gradient steps between two logger/tqdm updates.
+    :param logger: the trainer's logger.
+    """
+
+    def __init__(self, policy, batch_size, fuse, log_interval, logger):
+        self.policy = policy
+        self.batch_size = batch_size
+        self.fuse = fuse
+        self.log_interval = log_interval
+        self.logger = logger
+        self.pending = 0
+        self.sums = defaultdict(float)
+        self.count = 0
+        self.stat = defaultdict(MovAvg)
+        self.learn = _TENSOR_LEARN.get(type(policy))
+
+    def step(self, n_updates, buffer, gradient_step):
+        """Owe ``n_updates`` more gradient steps, run them once ``fuse`` are owed.
+
+        :return: the new gradient step and the smoothed losses if they were
+            logged in this call, else None.
+        """
+        self.pending += n_updates
+        if self.pending < self.fuse:
+            return gradient_step, None
+        return self.flush(buffer, gradient_step)
+
+    def flush(self, buffer, gradient_step):
+        """Run all owed gradient steps now, e.g. at the end of an epoch."""
+        n, self.pending = self.pending, 0
+        if n == 0 or len(buffer) == 0:
+            return gradient_step, None
+        policy = self.policy
+        bs = self.batch_size
+        indices = buffer.sample_index(bs * n)
+        logged = None
+        policy.updating = True
+        try:
+            for i in range(n):
+                idx = indices[i * bs:(i + 1) * bs]
+                batch = policy.process_fn(buffer[idx], buffer, idx)
+                if self.learn is not None:
+                    losses = self.learn(policy, batch)
+                else:
+                    losses = policy.learn(batch)
+                policy.post_process_fn(batch, buffer, idx)
+                gradient_step += 1
+                for k, v in losses.items():
+                    # tensors stay on the device until they are logged
+                    self.sums[k] += v
+                self.count += 1
+                if self.count >= self.log_interval:
+                    logged = self._log(gradient_step)
+        finally:
+            policy.updating = False
+        return gradient_step, logged
+
+    def _log(self, gradient_step):
+        losses = {}
+        for k, v in self.sums.items():
+            self.stat[k].add(float(v) / self.count)
+            losses[k] = self.stat[k].get()
+        self.logger.log_update_data(losses, gradient_step)
+        self.sums = defaultdict(float)
+        self.count = 0
+        return losses
@@ -0,0 +1,150 @@
+"""Several reward weights trained from one stream of FMU rollouts.
+
+``weight_energy`` and ``weight_temp`` only change how the env adds up its
+energy ``cost`` and temperature ``penalty``; the simulated building is the
+same. With ``--multi-weight-energy`` the envs report both terms of every step
+(:class:`env_wrappers.RewardComponentsWrapper`), and :class:`MultiWeightPolicy`
+trains one DQN head per weight from the same replay buffer. Each head samples
+through a :class:`RelabeledBuffer`, which computes the rewards of its weights
+(:func:`replay.relabel`) for the sampled rows and the rows of their n-step
+returns only; the stored rewards are never changed. The weight values of the
+tuning grid then share one set of simulations instead of running one each.
+
+Head 0 has the weights of the env (``--weight-energy``, ``--weight-temp``) and
+is the one tested, recorded and reported every epoch. The other heads take
+turns with it in collecting the training data, one epoch each, and are tested
+under their own weights after training (:func:`evaluate_heads`).
+"""
+import os
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+from tianshou.data import Collector, VectorReplayBuffer
+from tianshou.policy import BasePolicy
+
+from .replay import relabel
+
+RESULT_FILE = 'multi_weight.json'
+
+
+class RelabeledBuffer(object):
+    """A view of ``buffer`` with the rewards of other weights, for one head's update.
+
+    :meth:`sample` computes the rewards of the sampled rows and of the rows
+    their n-step returns read; ``rew`` holds them at the buffer positions, its
+    other entries are not meaningful. Everything else goes to ``buffer``.
+
+    :param int n_step: the head's n-step return horizon.
+    :param numpy.ndarray rew: scratch array with one entry per buffer row.
+    """
+
+    def __init__(self, buffer, weight_energy, weight_temp, n_step, rew):
+        self.buffer = buffer
+        self.weights = (weight_energy, weight_temp)
+        self.n_step = n_step
+        self.rew = rew
+
+    def __getattr__(self, key):
+        return getattr(self.buffer, key)
+
+    def __getitem__(self, index):
+        return self.buffer[index]
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def sample(self, batch_size):
+        batch, indices = self.buffer.sample(batch_size)
+        rows = [indices]
+        for _ in range(self.n_step - 1):
+            rows.append(self.buffer.next(rows[-1]))
+        rows = np.unique(np.concatenate(rows))
+        self.rew[rows] = relabel(self.buffer, *self.weights, index=rows)
+        batch.rew = self.rew[indices]
+        return batch, indices
+
+
+class MultiWeightPolicy(BasePolicy):
+    """DQN heads of several reward weights that share the collected transitions.
+
+    In train mode the policy acts with head ``collecting``, in eval mode with
+    head 0.
+
+    :param list policies: one DQN policy per weight.
+    :param list weights: ``(weight_energy, weight_temp)`` of every head.
+    """
+
+    def __init__(self, policies, weights):
+        super().__init__()
+        if len(policies) != len(weights):
+            raise ValueError("need one weight pair per head")
+        self.heads = nn.ModuleList(policies)
+        self.weights = [(float(e), float(t)) for e, t in weights]
+        self.collecting = 0
+        self._rew = None
+
+    def set_eps(self, eps):
+        for head in self.heads:
+            head.set_eps(eps)
+
+    def _head(self):
+        return self.heads[self.collecting if self.training else 0]
+
+    def forward(self, batch, state=None, **kwargs):
+        return self._head()(batch, state, **kwargs)
+
+    def exploration_noise(self, act, batch):
+        return self._head().exploration_noise(act, batch)
+
+    def learn(self, batch, **kwargs):
+        raise NotImplementedError("the heads learn from their own relabeled samples, see update")
+
+    def update(self, sample_size, buffer, **kwargs):
+        """One gradient step of every head, each on its own relabeled minibatch."""
+        if self._rew is None or len(self._rew) != len(buffer.rew):
+            # shared by the heads, they update one after the other
+            self._rew = np.zeros(len(buffer.rew))
+        losses = {}
+        for i, (head, weights) in enumerate(zip(self.heads, self.weights)):
+            view = RelabeledBuffer(buffer, *weights, getattr(head, '_n_step', 1), self._rew)
+            for k, v in head.update(sample_size, view, **kwargs).items():
+                losses['{}/{}'.format(k, i)] = v
+        return losses
+
+
+def make_multi_weight_policy(make_head, args):
+    """Head 0 for ``--weight-energy``, one more per ``--multi-weight-energy`` value.
+
+    :param make_head: builds one DQN policy with its own network and optimizer.
+    """
+    energies = [args.weight_energy] + [w for w in args.multi_weight_energy if w != args.weight_energy]
+    weights = [(w, args.weight_temp) for w in energies]
+    return MultiWeightPolicy([make_head() for _ in weights], weights)
+
+
+def evaluate_heads(policy, test_envs, steps, seed, eps, folder):
+    """Test every head under its own weights and save its weights.
+
+    Writes ``policy_w<weight_energy>.pth`` per head and the test rewards to
+    ``multi_weight.json``; the rewards are recomputed from the ``cost`` and
+    ``penalty`` of the test episode.
+    """
+    results = []
+    for i, (head, (weight_energy, weight_temp)) in enumerate(zip(policy.heads, policy.weights)):
+        head.eval()
+        head.set_eps(eps)
+        test_envs.seed(seed)
+        buffer = VectorReplayBuffer(steps + 1, len(test_envs))
+        collector = Collector(head, test_envs, buffer, exploration_noise=False)
+        collector.collect(n_step=steps)
+        # rows that were never written have no cost or penalty, their reward is 0
+        rew = float(relabel(buffer, weight_energy, weight_temp).sum()) / len(test_envs)
+        torch.save(head.state_dict(), os.path.join(folder, 'policy_w{:g}.pth'.format(weight_energy)))
+        results.append({'head': i, 'weight_energy': weight_energy, 'weight_temp': weight_temp,
+                        'test_reward': rew})
+        print("Head {} (weight_energy {:g}): test reward {:.3f}".format(i, weight_energy, rew))
+    with open(os.path.join(folder, RESULT_FILE), 'w') as fp:
+        json.dump(results, fp, indent=2)
+    return results
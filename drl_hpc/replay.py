@@ -0,0 +1,314 @@
+"""Replay buffers of the off-policy trainers.
+
+The rewards are sparse and dominated by the comfort violation spikes, so most
+uniformly sampled transitions teach the agent very little. With
+``--prioritized-replay`` the trainers use tianshou's
+``PrioritizedVectorReplayBuffer`` instead: its sum tree is one flat numpy array,
+a whole minibatch is sampled and its priorities are updated with a single
+vectorized walk down the tree. ``DQNPolicy`` and ``DiscreteSACPolicy`` already
+scale their TD losses by ``batch.weight`` and write ``|td|`` back as the new
+priorities in ``post_process_fn``.
+
+With ``--compact-replay`` the transitions are stored in small dtypes: actions
+as uint8, rewards as float32 and observations as float16 or as uint16 scaled
+to the bounds of the observation space. Sampled batches are converted back in
+one vectorized step, so the policies see the usual dtypes. The done flags keep
+one byte per row: tianshou reads ``buffer.done`` as a whole bool array for the
+n-step returns and the episode walks of every sample, so packed bits would be
+unpacked in full each time, for a byte next to the two uint16 observations.
+
+With ``--device-replay`` the observations are also kept as torch tensors, and
+sampled batches carry tensors instead of arrays, so ``policy.update`` no longer
+allocates and copies a host batch for every minibatch:
+
+* ``mirror``: a copy of the observation storage on ``--device``, written once
+  per added transition and indexed (and dequantized) on the device;
+* ``pinned``: the storage itself lives in pinned host memory; a minibatch is
+  gathered into a pinned staging tensor and copied asynchronously.
+
+Without CUDA both modes become zero-copy CPU tensor views of the storage.
+
+:func:`relabel` computes the rewards of stored transitions for other reward
+weights, from the ``cost`` and ``penalty`` the envs put in the info of every
+transition.
+"""
+import numpy as np
+import torch
+from tianshou.data import Batch, PrioritizedReplayBuffer, PrioritizedVectorReplayBuffer, \
+    VectorReplayBuffer
+
+from .env_wrappers import macro_steps
+
+OBS_KEYS = ('obs', 'obs_next')
+
+
+class CompactStorageMixin(object):
+    """Keep the buffer arrays in small dtypes; list it before the buffer class.
+
+    The arrays are allocated by the buffer on the first ``add`` and converted
+    right after. ``done`` stays a bool array, see the module docstring.
+
+    :param observation_space: the Box observation space; its bounds give the
+        uint16 scales.
+    :param action_space: the Discrete action space; actions are stored as uint8
+        if there are at most 256 of them.
+    :param str obs_dtype: ``'uint16'`` or ``'float16'``.
+    """
+
+    def __init__(self, *args, observation_space=None, action_space=None, obs_dtype='uint16',
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self._compact = False
+        self._obs_dtype = np.dtype(obs_dtype)
+        self._act_dtype = None
+        if action_space is not None and getattr(action_space, 'n', 1 << 16) <= 256:
+            self._act_dtype = np.dtype(np.uint8)
+        self._obs_offset = self._obs_scale = None
+        if self._obs_dtype == np.uint16:
+            low = np.asarray(observation_space.low, dtype=np.float64)
+            high = np.asarray(observation_space.high, dtype=np.float64)
+            if not (np.isfinite(low).all() and np.isfinite(high).all()):
+                raise ValueError("uint16 observations need a bounded observation space, "
+                                 "use float16")
+            scale = (high - low) / 65535.
+            scale[scale == 0] = 1.
+            self._obs_offset = low.astype(np.float32)
+            self._obs_scale = scale.astype(np.float32)
+        elif self._obs_dtype != np.float16:
+            raise ValueError("obs_dtype must be 'uint16' or 'float16', not {}".format(obs_dtype))
+
+    def _encode_obs(self, obs):
+        if self._obs_scale is None:
+            return obs.astype(np.float16)
+        q = np.rint((obs - self._obs_offset) / self._obs_scale)
+        return np.clip(q, 0, 65535).astype(np.uint16)
+
+    def _decode_obs(self, obs):
+        if self._obs_scale is None:
+            return obs.astype(np.float32)
+        return obs.astype(np.float32) * self._obs_scale + self._obs_offset
+
+    def _convert_storage(self):
+        meta = self._meta
+        for key in OBS_KEYS:
+            if isinstance(meta.get(key), np.ndarray):
+                meta[key] = self._encode_obs(meta[key])
+        if self._act_dtype is not None:
+            meta.act = meta.act.astype(self._act_dtype)
+        meta.rew = meta.rew.astype(np.float32)
+        if hasattr(self, '_set_batch_for_children'):
+            self._set_batch_for_children()
+        self._compact = True
+
+    def add(self, batch, buffer_ids=None):
+        if not self._compact:
+            out = super().add(batch, buffer_ids)
+            self._convert_storage()
+            return out
+        if self._obs_scale is not None:
+            # a shallow copy, the collector keeps using its own batch
+            batch = Batch(batch)
+            for key in OBS_KEYS:
+                if isinstance(batch.get(key), np.ndarray):
+                    batch[key] = self._encode_obs(batch[key])
+        # float16 and the small ints are cast on assignment
+        return super().add(batch, buffer_ids)
+
+    def get(self, index, key, default_value=None, stack_num=None):
+        val = super().get(index, key, default_value, stack_num)
+        if self._compact and key in OBS_KEYS and isinstance(val, np.ndarray):
+            return self._decode_obs(val)
+        return val
+
+    def __getitem__(self, index):
+        batch = super().__getitem__(index)
+        if self._compact:
+            # uint8 indices would be taken as a mask by torch
+            batch.act = batch.act.astype(np.int64)
+        return batch
+
+
+def _to_torch(arr):
+    # torch has no uint16, the bits are kept as int16
+    return torch.from_numpy(arr.view(np.int16) if arr.dtype == np.uint16 else arr)
+
+
+class DeviceMirrorMixin(object):
+    """Serve the sampled observations as torch tensors; list it first in the bases.
+
+    :param device: the device of the policy.
+    :param str mode: ``'mirror'`` or ``'pinned'``.
+    """
+
+    def __init__(self, *args, device='cpu', mode='mirror', **kwargs):
+        super().__init__(*args, **kwargs)
+        if mode not in ('mirror', 'pinned'):
+            raise ValueError("mode must be 'mirror' or 'pinned', not {}".format(mode))
+        self._device = torch.device(device)
+        if self._device.type != 'cuda' or not torch.cuda.is_available():
+            self._device = torch.device('cpu')
+        self._mode = mode
+        self._mirror = None
+        self._staging = {}
+
+    def __getstate__(self):
+        # the tensors are rebuilt from the arrays, see build_mirror
+        state = dict(self.__dict__)
+        state['_mirror'] = None
+        state['_staging'] = {}
+        return state
+
+    def build_mirror(self):
+        """(Re)create the tensors of the current storage arrays."""
+        meta = self._meta
+        mirror = {}
+        for key in OBS_KEYS:
+            arr = meta.get(key)
+            if not isinstance(arr, np.ndarray):
+                continue
+            host = _to_torch(arr)
+            if self._device.type == 'cpu':
+                mirror[key] = host
+            elif self._mode == 'mirror':
+                mirror[key] = host.to(self._device)
+            else:
+                pinned = host.pin_memory()
+                pinned_arr = pinned.numpy()
+                meta[key] = pinned_arr.view(arr.dtype)
+                mirror[key] = pinned
+        if self._mode == 'pinned' and hasattr(self, '_set_batch_for_children'):
+            self._set_batch_for_children()
+        self._mirror = mirror
+        self._staging = {}
+
+    def add(self, batch, buffer_ids=None):
+        out = super().add(batch, buffer_ids)
+        if self._mirror is None:
+            self.build_mirror()
+        elif self._device.type == 'cuda' and self._mode == 'mirror':
+            ptr = out[0]
+            idx = torch.as_tensor(ptr, device=self._device)
+            for key, t in self._mirror.items():
+                t[idx] = _to_torch(np.ascontiguousarray(self._meta[key][ptr])).to(self._device)
+        return out
+
+    def _decode(self, t):
+        t = t.to(self._device, non_blocking=True)
+        if t.dtype == torch.int16:
+            t = t.to(torch.int32) & 0xFFFF
+        t = t.float()
+        scale = getattr(self, '_obs_scale', None)
+        if scale is not None:
+            t = t * torch.as_tensor(scale, device=self._device) \
+                + torch.as_tensor(self._obs_offset, device=self._device)
+        return t
+
+    def get(self, index, key, default_value=None, stack_num=None):
+        if self._mirror is None or key not in self._mirror or \
+                (stack_num or self.stack_num) != 1:
+            return super().get(index, key, default_value, stack_num)
+        src = self._mirror[key]
+        if self._device.type == 'cuda' and self._mode == 'pinned':
+            idx = torch.as_tensor(index).reshape(-1)
+            shape = (len(idx),) + tuple(src.shape[1:])
+            # two staging tensors per key, each reused only after its copy is done
+            slots = self._staging.setdefault(key, [])
+            out, event = slots.pop(0) if len(slots) >= 2 else (None, None)
+            if event is not None:
+                event.synchronize()
+            if out is None or tuple(out.shape) != shape:
+                out = torch.empty(shape, dtype=src.dtype).pin_memory()
+            torch.index_select(src, 0, idx, out=out)
+            t = self._decode(out)
+            event = torch.cuda.Event()
+            event.record()
+            slots.append((out, event))
+            return t.reshape(np.shape(index) + tuple(src.shape[1:]))
+        return self._decode(src[torch.as_tensor(index, device=src.device)])
+
+
+class CompactVectorReplayBuffer(CompactStorageMixin, VectorReplayBuffer):
+    pass
+
+
+class CompactPrioritizedVectorReplayBuffer(CompactStorageMixin, PrioritizedVectorReplayBuffer):
+    pass
+
+
+class DeviceVectorReplayBuffer(DeviceMirrorMixin, VectorReplayBuffer):
+    pass
+
+
+class DevicePrioritizedVectorReplayBuffer(DeviceMirrorMixin, PrioritizedVectorReplayBuffer):
+    pass
+
+
+class DeviceCompactVectorReplayBuffer(DeviceMirrorMixin, CompactStorageMixin, VectorReplayBuffer):
+    pass
+
+
+class DeviceCompactPrioritizedVectorReplayBuffer(DeviceMirrorMixin, CompactStorageMixin,
+                                                 PrioritizedVectorReplayBuffer):
+    pass
+
+
+BUFFER_CLASSES = {
+    # (device, compact, prioritized)
+    (False, False, False): VectorReplayBuffer,
+    (False, False, True): PrioritizedVectorReplayBuffer,
+    (False, True, False): CompactVectorReplayBuffer,
+    (False, True, True): CompactPrioritizedVectorReplayBuffer,
+    (True, False, False): DeviceVectorReplayBuffer,
+    (True, False, True): DevicePrioritizedVectorReplayBuffer,
+    (True, True, False): DeviceCompactVectorReplayBuffer,
+    (True, True, True): DeviceCompactPrioritizedVectorReplayBuffer,
+}
+
+
+def make_replay_buffer(args, buffer_num, observation_space=None, action_space=None, **kwargs):
+    """The training buffer of ``args.buffer_size`` transitions over ``buffer_num`` envs.
+
+    :param observation_space: needed for ``--compact-replay uint16``.
+    :param action_space: actions are only stored as uint8 if it is given.
+    :param kwargs: extra arguments of the buffer, e.g. ``ignore_obs_next``.
+    """
+    prioritized = getattr(args, 'prioritized_replay', False)
+    compact = getattr(args, 'compact_replay', None)
+    device_mode = getattr(args, 'device_replay', None)
+    if prioritized:
+        kwargs.update(alpha=args.prio_alpha, beta=args.prio_beta)
+    if compact:
+        kwargs.update(observation_space=observation_space, action_space=action_space,
+                      obs_dtype=compact)
+    if device_mode:
+        kwargs.update(device=args.device, mode=device_mode)
+    cls = BUFFER_CLASSES[bool(device_mode), bool(compact), bool(prioritized)]
+    return cls(args.buffer_size, buffer_num, **kwargs)
+
+
+def relabel(buffer, weight_energy, weight_temp, index=None):
+    """The rewards of the rows ``index`` of ``buffer`` (all rows if None) for other
+    reward weights; the stored rewards are left alone.
+
+    The transitions need ``info.cost`` and ``info.penalty``, see
+    :class:`env_wrappers.RewardComponentsWrapper`. Rows that were never written
+    get a reward of 0.
+    """
+    info = buffer._meta.get('info')
+    if info is None or 'cost' not in info or 'penalty' not in info:
+        raise ValueError("the buffer has no reward components, record them with "
+                         "RewardComponentsWrapper")
+    if index is None:
+        index = slice(None)
+    return weight_energy * info.cost[index] + weight_temp * info.penalty[index]
+
+
+def anneal_beta(buffer, args, env_step):
+    """Anneal the importance sampling exponent from ``args.prio_beta`` to 1 over the run.
+
+    Does nothing for uniform buffers.
+    """
+    if not isinstance(buffer, PrioritizedReplayBuffer):
+        return
+    frac = min(1., env_step / float(args.epoch * macro_steps(args)))
+    buffer.set_beta(args.prio_beta + frac * (1. - args.prio_beta))
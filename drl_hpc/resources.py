@@ -0,0 +1,205 @@
+"""Resource accounting and packing of the tuning trials.
+
+Tune asks for one CPU per trial by default, but a trial runs a learner with
+torch's intra-op threads plus one process per train and test env (and the
+evaluation process with ``--async-eval``), so 72 trials on a 72-CPU node fight
+over the cores. This module works out what a trial really uses:
+
+* :func:`trial_footprint` estimates it from the arguments: learner threads, env
+  processes and FMU memory;
+* :func:`calibrate` measures it from a short run: CPU time per wall-clock
+  second of the whole process tree, and its peak resident memory.
+
+:func:`plan` turns the footprint into the CPUs requested per trial (memory is
+folded in as a share of the node's CPUs), which bounds how many trials Ray
+starts at once. Inside a trial :func:`pin_trial` fixes torch's thread count and
+gives the trial's processes cores of their own with ``sched_setaffinity``; env
+workers forked later inherit the affinity.
+"""
+import os
+import json
+import math
+import time
+import fcntl
+import atexit
+import argparse
+import tempfile
+import resource
+import multiprocessing as mp
+
+import torch
+
+from .async_eval import uses_async_eval
+
+SLOT_FILE = '/dev/shm/drl_hpc_cpu_slots.json'
+# resident memory of one building env process and of the learner, in MB
+DEFAULT_FMU_MB = 300.
+LEARNER_MB = 1500.
+
+
+def learner_threads(args):
+    return args.torch_threads if args.torch_threads > 0 else 2
+
+
+def env_processes(args, num):
+    """Worker processes of a vector env of ``num`` building envs."""
+    if getattr(args, 'surrogate', None):
+        from . import surrogate
+
+        if surrogate.use_surrogate(args):
+            return 0
+    if args.vector_env == 'service':
+        # the envs run in the node's simulation service, see tuning.reserve_sim_service
+        return 0
+    if args.vector_env == 'multizone':
+        return int(math.ceil(num / float(args.envs_per_proc)))
+    return num
+
+
+def trial_footprint(args, fmu_mb=DEFAULT_FMU_MB):
+    """Estimate the CPUs and memory of one trial from its arguments."""
+    procs = env_processes(args, args.training_num)
+    if uses_async_eval(args):
+        # the test envs live in the evaluation process, not in the trainer
+        procs += 1 + env_processes(args, args.test_num)
+    else:
+        procs += env_processes(args, args.test_num)
+    procs += getattr(args, 'apex_actors', 0)
+    threads = learner_threads(args)
+    return {'cpus': float(threads + procs), 'learner_threads': threads,
+            'env_processes': procs, 'memory_mb': LEARNER_MB + procs * fmu_mb,
+            'calibrated': False}
+
+
+def _tree_rss(root):
+    """Resident bytes of ``root`` and all its descendants."""
+    page = os.sysconf('SC_PAGE_SIZE')
+    parents, rss = {}, {}
+    for d in os.listdir('/proc'):
+        if not d.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(d)) as fp:
+                stat = fp.read()
+        except IOError:
+            continue
+        # the command name may contain spaces, the fields start after its ')'
+        fields = stat[stat.rfind(')') + 2:].split()
+        parents[int(d)] = int(fields[1])
+        rss[int(d)] = int(fields[21]) * page
+    total = 0
+    for pid, n in rss.items():
+        p = pid
+        while p > 1 and p != root:
+            p = parents.get(p, 0)
+        if p == root:
+            total += n
+    return total
+
+
+def _calibration_run(run_fn, args):
+    run_fn(args)
+
+
+def calibrate(args, run_fn, steps=96):
+    """Measure one trial by running ``run_fn`` for a single epoch of ``steps`` steps.
+
+    The run is forked, so the CPU time of the learner and of every env worker
+    it started ends up in our ``RUSAGE_CHILDREN``; memory is sampled from
+    ``/proc`` while it runs.
+    """
+    cargs = argparse.Namespace(**vars(args))
+    cargs.epoch = 1
+    cargs.step_per_epoch = steps * getattr(args, 'action_repeat', 1)
+    cargs.logdir = tempfile.mkdtemp(prefix='calibrate_')
+    cargs.checkpoint = cargs.resume = False
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    p = mp.get_context('fork').Process(target=_calibration_run, args=(run_fn, cargs))
+    p.start()
+    peak = 0
+    while p.is_alive():
+        peak = max(peak, _tree_rss(p.pid))
+        p.join(0.5)
+    wall = time.time() - start
+    if p.exitcode != 0:
+        raise RuntimeError("calibration run failed with exit code {}".format(p.exitcode))
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+    footprint = trial_footprint(args)
+    footprint.update(cpus=max(1., cpu / wall), memory_mb=peak / 2. ** 20, calibrated=True,
+                     wall_s=wall)
+    return footprint
+
+
+def node_memory_mb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2. ** 20
+
+
+def plan(footprint, num_cpus, memory_mb=None):
+    """CPUs to request per trial and how many trials then run at once.
+
+    A trial that needs more than its CPU share of the memory asks for more CPUs.
+    """
+    memory_mb = memory_mb or node_memory_mb()
+    cpus = math.ceil(footprint['cpus'])
+    cpus = max(cpus, math.ceil(num_cpus * footprint['memory_mb'] / memory_mb))
+    cpus = min(cpus, num_cpus)
+    return cpus, num_cpus // cpus
+
+
+class CoreSlots(object):
+    """Node-wide allocation of cores to trials, kept in a small locked file.
+
+    Entries of processes that are gone are dropped on every claim, so a killed
+    trial does not leak its cores.
+    """
+
+    def __init__(self, path=SLOT_FILE):
+        self.path = path
+
+    def _update(self, fn):
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as fp:
+                    slots = json.load(fp)
+            except (IOError, ValueError):
+                slots = {}
+            for pid in list(slots):
+                try:
+                    os.kill(int(pid), 0)
+                except OSError:
+                    del slots[pid]
+            out = fn(slots)
+            with open(self.path + '.tmp', 'w') as fp:
+                json.dump(slots, fp)
+            os.replace(self.path + '.tmp', self.path)
+            return out
+
+    def claim(self, n):
+        """Reserve ``n`` free cores for this process, or none if too few are left."""
+        def take(slots):
+            used = set(c for cores in slots.values() for c in cores)
+            free = [c for c in sorted(os.sched_getaffinity(0)) if c not in used]
+            cores = free[:n] if len(free) >= n else []
+            slots[str(os.getpid())] = cores
+            return cores
+        return self._update(take)
+
+    def release(self):
+        self._update(lambda slots: slots.pop(str(os.getpid()), None))
+
+
+def pin_trial(n_cpus, threads):
+    """Pin this trial to ``n_cpus`` cores of its own and torch to ``threads`` threads.
+
+    :return: the cores, empty if the node had none left and the trial runs unpinned.
+    """
+    torch.set_num_threads(threads)
+    slots = CoreSlots()
+    cores = slots.claim(n_cpus)
+    if cores:
+        os.sched_setaffinity(0, cores)
+        atexit.register(slots.release)
+    return cores
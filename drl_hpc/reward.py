@@ -0,0 +1,99 @@
+"""Reward of the building envs: weighted energy cost plus temperature penalty.
+
+:class:`RewardEngine` replaces the ``rw_func`` closures that were defined in every
+``make_building_env``. An instance is passed to the env as ``rf`` and called once
+per step with the ``cost`` and ``penalty`` lists of that env, inside the worker
+that runs the env. Only the in-process :class:`~surrogate.SurrogateVectorEnv`
+sees the costs and penalties of all its envs together; it uses ``compute`` to
+evaluate their rewards at once on NumPy arrays. Running minima and maxima are
+kept in arrays instead of being printed every step, and with :mod:`event_log`
+configured every simulated step is recorded as a ``reward`` event.
+
+Steps served by :class:`~rollout_cache.RolloutCacheWrapper` never reach the
+env, so they are neither in the statistics nor in the event log, while the
+steps it re-simulates after restoring a snapshot are counted again.
+"""
+import numpy as np
+
+from . import event_log
+
+
+class RewardEngine(object):
+    """Reward ``weight_temp * penalty + weight_energy * cost``.
+
+    :param float weight_energy: weight of the energy cost term.
+    :param float weight_temp: weight of the temperature penalty term.
+    :param int num_envs: number of envs handled by :meth:`compute`. Default to 1.
+    :param bool return_components: if True, :meth:`compute` also returns the cost
+        and penalty arrays. Default to False.
+    """
+
+    def __init__(self, weight_energy, weight_temp, num_envs=1, return_components=False):
+        self.weight_energy = float(weight_energy)
+        self.weight_temp = float(weight_temp)
+        self.num_envs = num_envs
+        self.return_components = return_components
+        self.reward = np.zeros(num_envs)
+        self.cost = np.zeros(num_envs)
+        self.penalty = np.zeros(num_envs)
+        self._tmp = np.zeros(num_envs)
+        self.steps = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.cost_min = np.full(self.num_envs, np.inf)
+        self.cost_max = np.full(self.num_envs, -np.inf)
+        self.penalty_min = np.full(self.num_envs, np.inf)
+        self.penalty_max = np.full(self.num_envs, -np.inf)
+
+    def set_weights(self, weight_energy, weight_temp):
+        self.weight_energy = float(weight_energy)
+        self.weight_temp = float(weight_temp)
+
+    def __call__(self, cost, penalty):
+        """Env interface: ``cost`` and ``penalty`` are one-element lists of a single env."""
+        cost = float(cost[0])
+        penalty = float(penalty[0])
+        self.cost[0] = cost
+        self.penalty[0] = penalty
+        if cost < self.cost_min[0]:
+            self.cost_min[0] = cost
+        if cost > self.cost_max[0]:
+            self.cost_max[0] = cost
+        if penalty < self.penalty_min[0]:
+            self.penalty_min[0] = penalty
+        if penalty > self.penalty_max[0]:
+            self.penalty_max[0] = penalty
+        res = penalty * self.weight_temp + cost * self.weight_energy
+        self.reward[0] = res
+        event_log.record('reward', self.steps, cost, penalty, res)
+        self.steps += 1
+        return res
+
+    def compute(self, cost, penalty):
+        """Rewards of all envs from arrays of shape ``(num_envs,)``, for vector envs
+        that step their envs in one process.
+
+        The results are written into arrays owned by the engine, so no memory is
+        allocated per call; copy them if they have to outlive the next call.
+        """
+        cost = np.asarray(cost, dtype=np.float64).reshape(self.num_envs)
+        penalty = np.asarray(penalty, dtype=np.float64).reshape(self.num_envs)
+        self.cost[:] = cost
+        self.penalty[:] = penalty
+        np.minimum(self.cost_min, cost, out=self.cost_min)
+        np.maximum(self.cost_max, cost, out=self.cost_max)
+        np.minimum(self.penalty_min, penalty, out=self.penalty_min)
+        np.maximum(self.penalty_max, penalty, out=self.penalty_max)
+        np.multiply(cost, self.weight_energy, out=self.reward)
+        np.multiply(penalty, self.weight_temp, out=self._tmp)
+        self.reward += self._tmp
+        if self.return_components:
+            return self.reward, self.cost, self.penalty
+        return self.reward
+
+    def stats(self):
+        return {
+            'cost_min': self.cost_min.copy(), 'cost_max': self.cost_max.copy(),
+            'penalty_min': self.penalty_min.copy(), 'penalty_max': self.penalty_max.copy(),
+        }
@@ -0,0 +1,199 @@
+"""Action-prefix rollout cache for deterministic evaluation episodes.
+
+The evaluation after every epoch (and ``watch()``) runs a greedy policy from the
+same start state, and consecutive epochs often choose identical actions for long
+stretches. :class:`RolloutCacheWrapper` keeps a trie whose edges are actions.
+Every node stores the step output (obs, reward, done, info) reached by that
+action prefix, and every ``snapshot_interval`` steps the FMU state as well. While
+the actions follow a known prefix, the outputs come from the trie and the FMU is
+not touched. At the first new action, the FMU is restored from the deepest stored
+state on the path, re-simulates the few steps after it, and simulation continues
+from there.
+
+Memory is capped: when the stored snapshots and outputs exceed ``max_bytes``,
+the least recently used leaves (the deep ends of old rollouts) are evicted. The
+root of every start state, with its FMU snapshot, counts against the cap as well
+and is evicted once its whole tree is gone.
+
+Cache hits do not call the env, so its :class:`~reward.RewardEngine` neither
+updates its statistics nor records ``reward`` events for them; :meth:`stats`
+counts them instead.
+
+Only discrete actions repeat exactly, so the cache is disabled on envs with a
+continuous action space. The training scripts enable it with ``--eval-cache-mb``.
+"""
+import copy
+from collections import OrderedDict
+
+import gym
+import numpy as np
+
+from .fmu_pool import FMUSnapshot, get_fmu, supports_fmu_state
+
+# assumed size of one FMU state when the FMU can not serialize it for measuring
+DEFAULT_SNAPSHOT_NBYTES = 1 << 20
+
+
+class _Node(object):
+    __slots__ = ('parent', 'key', 'action', 'children', 'output', 'snapshot', 'nbytes')
+
+    def __init__(self, parent, action, output=None):
+        self.parent = parent
+        self.key = None if action is None else _action_key(action)
+        self.action = action
+        self.children = {}
+        self.output = output
+        self.snapshot = None
+        self.nbytes = 0
+
+
+def _action_key(action):
+    return np.asarray(action).tobytes()
+
+
+class RolloutCacheWrapper(gym.Wrapper):
+    """Serve repeated action prefixes of deterministic rollouts from a trie.
+
+    Only use it on envs whose transitions are fully determined by the actions,
+    i.e. the evaluation envs of a deterministic policy with discrete actions.
+
+    :param int max_bytes: memory cap of the cached outputs and FMU states.
+    :param int snapshot_interval: store the FMU state every this many steps.
+    """
+
+    def __init__(self, env, max_bytes, snapshot_interval=8):
+        super().__init__(env)
+        self.enabled = isinstance(env.action_space, gym.spaces.Discrete) \
+            and supports_fmu_state(get_fmu(env))
+        self.max_bytes = max_bytes
+        self.snapshot_interval = snapshot_interval
+        self.roots = {}
+        self.leaves = OrderedDict()
+        self.nbytes = 0
+        self.snapshot_nbytes = None
+        self.node = None
+        self.depth = 0
+        self.synced = True
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self, **kwargs):
+        obs = self.env.reset(**kwargs)
+        if not self.enabled:
+            return obs
+        key = np.asarray(obs).tobytes()
+        root = self.roots.get(key)
+        self.node = root
+        self.depth = 0
+        self.synced = True
+        if root is None:
+            root = _Node(None, None, (np.array(obs, copy=True), 0., False, {}))
+            root.key = key
+            root.snapshot = FMUSnapshot.take(self.env, obs)
+            root.nbytes = root.output[0].nbytes + 64 + self._snapshot_nbytes(root.snapshot)
+            self.roots[key] = root
+            self.node = root
+            self._add(root)
+        else:
+            self._touch(root)
+        return obs
+
+    def step(self, action):
+        if not self.enabled:
+            return self.env.step(action)
+        key = _action_key(action)
+        child = self.node.children.get(key)
+        if child is not None:
+            self.hits += 1
+            self.node = child
+            self.depth += 1
+            self.synced = False
+            self._touch(child)
+            obs, rew, done, info = child.output
+            return obs.copy(), rew, done, copy.deepcopy(info)
+
+        self.misses += 1
+        if not self.synced:
+            self._sync()
+        obs, rew, done, info = self.env.step(action)
+        child = _Node(self.node, np.array(action, copy=True), (np.array(obs, copy=True), rew, done, copy.deepcopy(info)))
+        child.nbytes = child.output[0].nbytes + 64
+        self.depth += 1
+        if self.depth % self.snapshot_interval == 0 and not done:
+            child.snapshot = FMUSnapshot.take(self.env, obs)
+            child.nbytes += self._snapshot_nbytes(child.snapshot)
+        self._add(child)
+        self.node = child
+        return obs, rew, done, info
+
+    def _sync(self):
+        """Bring the FMU to the state of the current node."""
+        path = []
+        node = self.node
+        while node.snapshot is None:
+            path.append(node.action)
+            node = node.parent
+        node.snapshot.restore(self.env)
+        for action in reversed(path):
+            self.env.step(action)
+        self.synced = True
+
+    def _snapshot_nbytes(self, snapshot):
+        # the FMU state of one model has a fixed size, measure it once
+        if self.snapshot_nbytes is None:
+            if supports_fmu_state(get_fmu(self.env), serialize=True):
+                self.snapshot_nbytes = snapshot.nbytes(self.env)
+            else:
+                self.snapshot_nbytes = DEFAULT_SNAPSHOT_NBYTES
+        return self.snapshot_nbytes
+
+    def _touch(self, node):
+        if id(node) in self.leaves:
+            self.leaves.move_to_end(id(node))
+
+    def _add(self, node):
+        parent = node.parent
+        if parent is not None:
+            parent.children[node.key] = node
+            self.leaves.pop(id(parent), None)
+        self.leaves[id(node)] = node
+        self.nbytes += node.nbytes
+        self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self.leaves:
+            _, node = self.leaves.popitem(last=False)
+            if node is self.node:
+                self.leaves[id(node)] = node
+                if len(self.leaves) == 1:
+                    break
+                continue
+            parent = node.parent
+            if parent is None:
+                del self.roots[node.key]
+            else:
+                del parent.children[node.key]
+            if node.snapshot is not None:
+                node.snapshot.free(self.env)
+            self.nbytes -= node.nbytes
+            if parent is not None and not parent.children:
+                # the parent is a leaf again, and older than anything just used
+                self.leaves[id(parent)] = parent
+                self.leaves.move_to_end(id(parent), last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'nbytes': self.nbytes,
+                'nodes': len(self.leaves)}
+
+    def close(self):
+        for root in self.roots.values():
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                if node.snapshot is not None:
+                    node.snapshot.free(self.env)
+                stack.extend(node.children.values())
+        self.roots = {}
+        self.leaves = OrderedDict()
+        self.nbytes = 0
+        return self.env.close()
@@ -0,0 +1,486 @@
+"""Node-wide simulation service shared by all training runs on a node.
+
+Every tuning trial used to start its own vector env with one process per
+building env, so a node running many trials held hundreds of mostly idle FMU
+processes, each with its own interpreter and runtime. The service replaces them
+with a fixed pool of ``workers`` processes. Each worker hosts the building envs
+of any number of runs and steps them on request. Trials use
+:class:`ServiceVectorEnv` (``--vector-env service``), a drop-in vector env
+client.
+
+* Control goes through one dispatcher process, which listens on a unix socket
+  (``--sim-address``). A client registers its envs, and the dispatcher assigns
+  each one to the worker that hosts the fewest envs.
+* Each worker has one queue per client. When a worker is free, it takes up to
+  ``max_batch`` env requests in one message, one env per client in turn. A run
+  with many envs can therefore not starve a run with one.
+* Observations, rewards and done flags do not go through the socket. Each client
+  keeps them in arrays in ``/dev/shm``, which the workers write in place, the
+  same way as in :class:`vector_env.FMUVectorEnv`. The files are unlinked as soon
+  as the workers have mapped them, so a killed trial leaves nothing behind.
+
+A worker that dies takes its envs with it. The clients that had envs or
+requests on it get an error, their envs on the other workers are closed, and
+a new worker takes its place.
+
+The number of processes is fixed by the pool size. The memory use is that of
+the FMU models alone. With ``--fmu-pool``, the closed envs of a finished trial
+stay in the worker and are reused by the next trial with the same env
+arguments, up to ``max_idle`` envs per worker.
+
+:func:`ensure_service` starts the service as a detached process the first time
+it is needed on a node. It shuts itself down after ``idle_timeout`` seconds
+without clients.
+"""
+import os
+import sys
+import stat
+import time
+import fcntl
+import queue
+import shutil
+import argparse
+import tempfile
+import threading
+import traceback
+import subprocess
+from collections import OrderedDict, deque
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Client, Listener, wait
+
+import cloudpickle
+import numpy as np
+
+from .vector_env import InProcessVectorEnv
+
+DEFAULT_ADDRESS = '/dev/shm/drl_hpc_sim.sock'
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+FILES = {'obs': 'obs.npy', 'rew': 'rew.npy', 'done': 'done.npy'}
+
+
+class _Error(object):
+    """An exception raised by an env, sent back instead of its result."""
+
+    def __init__(self, message):
+        self.message = message
+
+
+def _open_arrays(shm_dir):
+    return {k: np.load(os.path.join(shm_dir, f), mmap_mode='r+') for k, f in FILES.items()}
+
+
+def _sim_worker(parent, p, max_idle):
+    parent.close()
+    from . import fmu_pool
+
+    envs = {}
+    arrays = {}
+
+    def run(cid, cmd, idx, data):
+        if cmd == "make":
+            fn, shm_dir = data
+            if cid not in arrays:
+                arrays[cid] = _open_arrays(shm_dir)
+            env = cloudpickle.loads(fn)()
+            envs[cid, idx] = env
+            return env.observation_space, env.action_space
+        env = envs[cid, idx]
+        out = arrays[cid]
+        if cmd == "step":
+            obs, rew, done, info = env.step(data)
+            out['obs'][idx] = obs
+            out['rew'][idx] = rew
+            out['done'][idx] = done
+            return info
+        if cmd == "reset":
+            out['obs'][idx] = env.reset()
+            return None
+        if cmd == "seed":
+            return env.seed(data) if hasattr(env, "seed") else None
+        if cmd == "close":
+            del envs[cid, idx]
+            if not any(key[0] == cid for key in envs):
+                del arrays[cid]
+            res = env.close()
+            # pooled envs of finished runs stay for the next run, within limits
+            fmu_pool.trim_pool(max_idle)
+            return res
+        raise NotImplementedError(cmd)
+
+    try:
+        while True:
+            try:
+                tasks = p.recv()
+            except EOFError:  # the dispatcher is gone
+                break
+            results = []
+            for cid, cmd, idx, data in tasks:
+                try:
+                    res = run(cid, cmd, idx, data)
+                except Exception:
+                    # one broken env must not take down the runs of the others
+                    res = _Error(traceback.format_exc())
+                results.append((cid, idx, res))
+            p.send(results)
+    except KeyboardInterrupt:
+        pass
+    for env in envs.values():
+        try:
+            env.close()
+        except Exception:
+            pass
+    fmu_pool.close_pool()
+    p.close()
+
+
+class _ClientState(object):
+    def __init__(self, cid):
+        self.cid = cid
+        self.worker_of = {}
+        self.pending = 0
+        self.results = {}
+        self.order = []
+        # why the envs of the client are gone, see SimService._worker_died
+        self.broken = None
+
+
+class SimService(object):
+    """The dispatcher and its worker pool; :meth:`serve` runs until the service is idle.
+
+    :param str address: path of the unix socket.
+    :param int workers: number of simulation worker processes.
+    :param int max_batch: most env requests handed to a worker in one message.
+    :param int max_idle: closed pooled envs a worker keeps for later runs.
+    :param float idle_timeout: seconds without clients after which the service exits.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, workers=8, max_batch=8, max_idle=4,
+                 idle_timeout=600.):
+        self.address = address
+        self.max_batch = max_batch
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.conns = [None] * workers
+        self.processes = [None] * workers
+        self.worker_id = {}
+        for w in range(workers):
+            self._start_worker(w)
+        self.busy = [False] * workers
+        # the batch each busy worker is running
+        self.running = [[] for _ in range(workers)]
+        self.hosted = [0] * workers
+        # per worker: client id -> deque of (cmd, idx, data), in round-robin order
+        self.queues = [OrderedDict() for _ in range(workers)]
+        self.clients = {}
+        self.next_cid = 0
+        self._new = queue.Queue()
+
+    def _start_worker(self, w):
+        parent_remote, child_remote = Pipe()
+        process = Process(target=_sim_worker, args=(parent_remote, child_remote, self.max_idle),
+                          daemon=True)
+        process.start()
+        child_remote.close()
+        self.conns[w] = parent_remote
+        self.processes[w] = process
+        self.worker_id[parent_remote] = w
+
+    def _accept(self, listener):
+        while True:
+            try:
+                self._new.put(listener.accept())
+            except OSError:
+                break
+
+    def _enqueue(self, state, cmd, idx, data):
+        w = state.worker_of[idx]
+        self.queues[w].setdefault(state.cid, deque()).append((cmd, idx, data))
+        state.pending += 1
+
+    def _request(self, conn, state):
+        cmd, data = conn.recv()
+        if cmd == "ping":
+            conn.send(("ok", None))
+            return
+        if state.broken is not None:
+            conn.send(("ok", []) if cmd == "close" else ("error", state.broken))
+            return
+        if cmd == "make":
+            fns, shm_dir = data
+            for idx, fn in enumerate(fns):
+                w = int(np.argmin(self.hosted))
+                self.hosted[w] += 1
+                state.worker_of[idx] = w
+            items = [(idx, (fn, shm_dir)) for idx, fn in enumerate(fns)]
+        elif cmd in ("step", "seed"):
+            items = list(zip(*data))
+        elif cmd == "reset":
+            items = [(idx, None) for idx in data]
+        elif cmd == "close":
+            items = [(idx, None) for idx in sorted(state.worker_of)]
+        else:
+            conn.send(("error", "unknown request {}".format(cmd)))
+            return
+        state.order = [idx for idx, _ in items]
+        state.results = {}
+        for idx, d in items:
+            self._enqueue(state, cmd, idx, d)
+        if cmd == "close":
+            self._release(state)
+        if not items:
+            conn.send(("ok", []))
+
+    def _release(self, state):
+        for w in state.worker_of.values():
+            self.hosted[w] -= 1
+        state.worker_of = {}
+
+    def _close_envs(self, state):
+        for idx, w in sorted(state.worker_of.items()):
+            self.queues[w].setdefault(state.cid, deque()).append(("close", idx, None))
+        self._release(state)
+
+    def _drop(self, conn):
+        """Close the envs of a client that went away without closing them."""
+        state = self.clients.pop(conn)
+        for q in self.queues:
+            q.pop(state.cid, None)
+        self._close_envs(state)
+        conn.close()
+
+    def _worker_died(self, w):
+        """Fail the clients that lost envs or requests with worker ``w``, then replace it."""
+        process = self.processes[w]
+        process.join(1)
+        message = "simulation worker {} exited with code {}, its envs are lost".format(
+            w, process.exitcode)
+        print(message)
+        lost = {cid for cid, _, _, _ in self.running[w]} | set(self.queues[w])
+        for conn, state in self.clients.items():
+            if state.broken is not None:
+                continue
+            if state.cid not in lost and w not in state.worker_of.values():
+                continue
+            state.broken = message
+            state.worker_of = {idx: v for idx, v in state.worker_of.items() if v != w}
+            # the rest of its envs are useless without the lost ones
+            self._close_envs(state)
+            if state.pending:
+                state.pending = 0
+                try:
+                    conn.send(("error", message))
+                except (BrokenPipeError, EOFError, OSError):
+                    pass
+        self.queues[w].clear()
+        self.running[w] = []
+        self.busy[w] = False
+        self.hosted[w] = 0
+        del self.worker_id[self.conns[w]]
+        self.conns[w].close()
+        self._start_worker(w)
+
+    def _done(self, w, results):
+        self.busy[w] = False
+        self.running[w] = []
+        by_cid = {state.cid: (conn, state) for conn, state in self.clients.items()}
+        for cid, idx, res in results:
+            if cid not in by_cid or by_cid[cid][1].broken is not None:
+                continue
+            conn, state = by_cid[cid]
+            state.results[idx] = res
+            state.pending -= 1
+            if state.pending:
+                continue
+            out = [state.results[i] for i in state.order]
+            errors = [r.message for r in out if isinstance(r, _Error)]
+            try:
+                conn.send(("error", errors[0]) if errors else ("ok", out))
+            except (BrokenPipeError, EOFError, OSError):
+                pass
+
+    def _next_batch(self, w):
+        queues = self.queues[w]
+        batch = []
+        while queues and len(batch) < self.max_batch:
+            cid, q = next(iter(queues.items()))
+            cmd, idx, data = q.popleft()
+            batch.append((cid, cmd, idx, data))
+            # the client goes to the back, every client gets one env per turn
+            del queues[cid]
+            if q:
+                queues[cid] = q
+        return batch
+
+    def serve(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        listener = Listener(self.address, family='AF_UNIX')
+        # clients send code to run, only our own user may connect
+        os.chmod(self.address, stat.S_IRUSR | stat.S_IWUSR)
+        threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+        idle_since = time.time()
+        try:
+            while True:
+                while not self._new.empty():
+                    self.clients[self._new.get()] = _ClientState(self.next_cid)
+                    self.next_cid += 1
+                for conn in wait(list(self.clients) + self.conns, timeout=0.05):
+                    if conn in self.worker_id:
+                        w = self.worker_id[conn]
+                        try:
+                            results = conn.recv()
+                        except (EOFError, OSError):
+                            self._worker_died(w)
+                            continue
+                        self._done(w, results)
+                        continue
+                    try:
+                        self._request(conn, self.clients[conn])
+                    except (EOFError, OSError):
+                        self._drop(conn)
+                for w, conn in enumerate(self.conns):
+                    if not self.busy[w] and self.queues[w]:
+                        self.running[w] = self._next_batch(w)
+                        self.busy[w] = True
+                        try:
+                            conn.send(self.running[w])
+                        except (BrokenPipeError, OSError):
+                            self._worker_died(w)
+                if self.clients or any(self.busy) or any(self.hosted):
+                    idle_since = time.time()
+                elif time.time() - idle_since > self.idle_timeout:
+                    break
+        finally:
+            listener.close()
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            for conn, process in zip(self.conns, self.processes):
+                conn.close()
+                process.join(10)
+                process.terminate()
+
+
+def service_alive(address):
+    try:
+        conn = Client(address, family='AF_UNIX')
+    except (OSError, EOFError):
+        return False
+    try:
+        conn.send(("ping", None))
+        return conn.recv()[0] == "ok"
+    except (OSError, EOFError):
+        return False
+    finally:
+        conn.close()
+
+
+def ensure_service(address=DEFAULT_ADDRESS, workers=8, max_batch=8, pin=False, timeout=60.):
+    """Start the service at ``address`` unless one is already running there.
+
+    The service is a detached process, so it outlives the run that started it.
+    It runs in the current directory, where the env functions of the script
+    find their FMU and weather files.
+
+    :param bool pin: claim ``workers`` cores for the service, see
+        :class:`resources.CoreSlots`.
+    :return: True if the service was started by this call.
+    """
+    with open(address + '.lock', 'w') as lock:
+        # trials starting together would otherwise all start a service
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if service_alive(address):
+            return False
+        cmd = [sys.executable, '-m', 'drl_hpc.sim_service', '--address', address,
+               '--workers', str(workers), '--max-batch', str(max_batch)]
+        if pin:
+            cmd.append('--pin')
+        # the package is importable in the service also when it is not installed
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            p for p in (root, os.getcwd(), os.environ.get('PYTHONPATH')) if p))
+        subprocess.Popen(cmd, env=env, stdin=subprocess.DEVNULL, start_new_session=True)
+        start = time.time()
+        while not service_alive(address):
+            if time.time() - start > timeout:
+                raise RuntimeError("simulation service at {} did not start".format(address))
+            time.sleep(0.2)
+    print("Started the simulation service at {} with {} workers".format(address, workers))
+    return True
+
+
+class ServiceVectorEnv(InProcessVectorEnv):
+    """Vector env whose building envs run in the node's simulation service.
+
+    :param env_fns: a list of callables that build the envs, run in the service.
+    :param observation_space: the (common) observation space of the envs.
+    :param str address: the unix socket of the service.
+    """
+
+    def __init__(self, env_fns, observation_space, address=DEFAULT_ADDRESS):
+        num = len(env_fns)
+        self.conn = Client(address, family='AF_UNIX')
+        try:
+            shm_dir = tempfile.mkdtemp(prefix='drl_hpc_sim_', dir=SHM_DIR)
+            try:
+                shapes = {'obs': ((num,) + observation_space.shape, observation_space.dtype),
+                          'rew': ((num,), np.float64), 'done': ((num,), np.bool_)}
+                self.arrays = {k: np.lib.format.open_memmap(os.path.join(shm_dir, FILES[k]),
+                                                            mode='w+', dtype=dtype, shape=shape)
+                               for k, (shape, dtype) in shapes.items()}
+                spaces = self._request("make", ([cloudpickle.dumps(fn) for fn in env_fns], shm_dir))
+            finally:
+                # the workers have mapped the files by now
+                shutil.rmtree(shm_dir, ignore_errors=True)
+        except BaseException:
+            # the service closes the envs that were made when the client goes away
+            self.conn.close()
+            raise
+        super().__init__(num, observation_space, spaces[0][1])
+
+    def _request(self, cmd, data):
+        self.conn.send((cmd, data))
+        status, res = self.conn.recv()
+        if status != "ok":
+            raise RuntimeError("simulation service: {}".format(res))
+        return res
+
+    def _reset(self, ids):
+        self._request("reset", ids.tolist())
+        return np.array(self.arrays['obs'][ids])
+
+    def _step(self, action, ids):
+        info = self._request("step", (ids.tolist(), list(action)))
+        return (np.array(self.arrays['obs'][ids]), np.array(self.arrays['rew'][ids]),
+                np.array(self.arrays['done'][ids]), info)
+
+    def _seed(self, seeds):
+        self._request("seed", (list(range(self.env_num)), seeds))
+
+    def _close(self):
+        try:
+            res = self._request("close", None)
+        except (BrokenPipeError, EOFError, OSError, RuntimeError):
+            # the service or the worker of some envs is gone, and the envs with it
+            res = []
+        self.conn.close()
+        return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='node-wide simulation service of the building envs')
+    parser.add_argument('--address', type=str, default=DEFAULT_ADDRESS)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--max-idle', type=int, default=4)
+    parser.add_argument('--idle-timeout', type=float, default=600.)
+    parser.add_argument('--pin', default=False, action='store_true',
+                        help='give the workers cores of their own, shared with the pinned tuning trials')
+    args = parser.parse_args()
+    if args.pin:
+        from . import resources
+
+        cores = resources.CoreSlots().claim(args.workers)
+        if cores:
+            os.sched_setaffinity(0, cores)
+    SimService(args.address, args.workers, args.max_batch, args.max_idle,
+               args.idle_timeout).serve()
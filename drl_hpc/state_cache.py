@@ -0,0 +1,124 @@
+"""Persistent on-disk cache of initialized simulator states.
+
+Every run starts its episodes at a fixed ``simulation_start_time`` and has to
+initialize the FMU there first. :class:`StartStateCache` stores the serialized
+FMU state right after that initialization, keyed by the env id, the FMU file
+hash, the start time, the weather file and the env settings that shape the
+episode (``mass_flow_nor``, time step, forecast steps and episode length), so
+that later runs (and other workers) restore it instead. With several cached start days, training can draw
+the start date of each episode at random for the price of one restore.
+"""
+import os
+import json
+import hashlib
+
+from .fmu_pool import FMUSnapshot
+from .weather_cache import find_epw
+
+_FILE_HASHES = {}
+
+
+def file_hash(path):
+    """sha256 of a file, memoized per process and file modification time."""
+    key = (path, os.path.getmtime(path))
+    if key not in _FILE_HASHES:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _FILE_HASHES[key] = h.hexdigest()
+    return _FILE_HASHES[key]
+
+
+class StartStateCache(object):
+    """Directory of serialized FMU states at the start of an episode.
+
+    :param str cache_dir: where the states are kept.
+    :param str fmu_path: the FMU file the env simulates; if it does not exist, the
+        env's own ``model_path`` is used. Without a hashable FMU nothing is cached.
+    :param str weather_file: the EPW file of the env; if it is found neither as given
+        nor next to the env module, the key uses its file name instead of its hash.
+    :param mass_flow_nor: the ``mass_flow_nor`` setting of the env.
+    :param float time_step: the control time step of the env.
+    :param float episode_length: seconds from start to end of an episode.
+    :param int npre_step: forecast steps in the observation of the env.
+    :param str task: gym id of the env.
+    """
+
+    def __init__(self, cache_dir, fmu_path, weather_file, mass_flow_nor, time_step,
+                 episode_length=None, npre_step=None, task=None):
+        self.cache_dir = cache_dir
+        self.fmu_path = fmu_path
+        self.weather_file = weather_file
+        self.mass_flow_nor = list(mass_flow_nor)
+        self.time_step = float(time_step)
+        self.episode_length = None if episode_length is None else float(episode_length)
+        self.npre_step = npre_step
+        self.task = task
+        self._fmu_hash = None
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return 'StartStateCache({!r}, {!r}, {!r}, {!r}, {!r}, {!r}, {!r}, {!r})'.format(
+            self.cache_dir, self.fmu_path, self.weather_file, self.mass_flow_nor, self.time_step,
+            self.episode_length, self.npre_step, self.task)
+
+    def fmu_hash(self, env):
+        if self._fmu_hash is None:
+            path = self.fmu_path
+            if not path or not os.path.exists(path):
+                path = getattr(env.unwrapped, 'model_path', None)
+            if not path or not os.path.exists(path):
+                print("Start state cache disabled: FMU file of the env not found")
+                self._fmu_hash = ''
+            else:
+                self._fmu_hash = file_hash(path)
+        return self._fmu_hash
+
+    def weather_hash(self, env):
+        path = find_epw(self.weather_file, type(env.unwrapped))
+        if path is None:
+            return os.path.basename(self.weather_file)
+        return file_hash(path)
+
+    def key(self, env, start_time):
+        fmu_hash = self.fmu_hash(env)
+        if not fmu_hash:
+            return None
+        desc = {
+            'fmu': fmu_hash,
+            'start_time': float(start_time),
+            'weather': self.weather_hash(env),
+            'mass_flow_nor': self.mass_flow_nor,
+            'time_step': self.time_step,
+            'episode_length': self.episode_length,
+            'npre_step': self.npre_step,
+            'task': self.task,
+        }
+        return hashlib.sha1(json.dumps(desc, sort_keys=True).encode()).hexdigest(), desc
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.state')
+
+    def load(self, env, start_time):
+        """The cached snapshot at ``start_time`` or None."""
+        key = self.key(env, start_time)
+        if key is None or not os.path.exists(self.path(key[0])):
+            return None
+        with open(self.path(key[0]), 'rb') as f:
+            snapshot = FMUSnapshot.from_bytes(env, f.read())
+        print("Loaded start state at {:.0f} s from {}".format(start_time, self.path(key[0])))
+        return snapshot
+
+    def save(self, env, start_time, snapshot):
+        key = self.key(env, start_time)
+        if key is None:
+            return
+        path = self.path(key[0])
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(snapshot.to_bytes(env))
+        os.replace(tmp_path, path)
+        with open(os.path.join(self.cache_dir, key[0] + '.json'), 'w') as fp:
+            json.dump(key[1], fp)
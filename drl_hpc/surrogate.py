@@ -0,0 +1,343 @@
+"""Learned surrogate of the building FMU for fast pretraining.
+
+A small torch MLP is fitted to the transitions the trainers already record
+(``his_obs.npy``, ``his_act.npy`` and ``his_rew.npy``). It predicts the change of
+the observation and the reward of a step. If ``his_cost.npy`` and
+``his_penalty.npy`` are recorded as well, it predicts the cost and penalty
+instead and the reward comes from the same :class:`~reward.RewardEngine` as in
+the FMU env. :class:`SurrogateBuildingEnv` and :class:`SurrogateVectorEnv` have
+the observation and action spaces of the FMU env and end an episode after the
+same number of steps.
+
+Typical use from a training script::
+
+    python test_dqn_tianshou.py --surrogate surrogate.pt --surrogate-fit    # fit on recorded runs
+    python test_dqn_tianshou.py --surrogate surrogate.pt                    # pretrain on the surrogate
+    python test_dqn_tianshou.py --surrogate surrogate.pt --surrogate-check --resume-path policy.pth
+"""
+import os
+import json
+import argparse
+
+import gym
+import numpy as np
+import torch
+from torch import nn
+
+from .reward import RewardEngine
+from .vector_env import InProcessVectorEnv
+from .eval_recorder import load_trajectories
+
+
+def use_surrogate(args):
+    """Whether the envs of this run should be surrogates instead of FMUs."""
+    return bool(getattr(args, 'surrogate', None)) and not getattr(args, 'surrogate_fit', False)
+
+
+def fmu_args(args):
+    """Copy of ``args`` that builds the FMU env even if a surrogate is configured."""
+    return argparse.Namespace(**dict(vars(args), surrogate=None))
+
+
+def _space_to_dict(space):
+    if isinstance(space, gym.spaces.Discrete):
+        return {'type': 'discrete', 'n': int(space.n)}
+    return {'type': 'box', 'low': np.asarray(space.low).tolist(),
+            'high': np.asarray(space.high).tolist(), 'dtype': str(space.dtype)}
+
+
+def _space_from_dict(d):
+    if d['type'] == 'discrete':
+        return gym.spaces.Discrete(d['n'])
+    return gym.spaces.Box(np.array(d['low']), np.array(d['high']), dtype=np.dtype(d['dtype']))
+
+
+def action_features(act, action_space):
+    """One-hot discrete actions, scale continuous actions to [-1, 1]."""
+    act = np.asarray(act)
+    if isinstance(action_space, gym.spaces.Discrete):
+        feat = np.zeros((len(act), action_space.n), dtype=np.float32)
+        feat[np.arange(len(act)), act.astype(np.int64).reshape(-1)] = 1.
+        return feat
+    low, high = action_space.low, action_space.high
+    act = act.reshape(len(act), -1)
+    return (2. * (act - low) / (high - low) - 1.).astype(np.float32)
+
+
+class SurrogateModel(nn.Module):
+    """MLP from (obs, action features) to (normalized obs change, outputs)."""
+
+    def __init__(self, obs_dim, act_dim, out_dim, hidden_sizes=(256, 256)):
+        super().__init__()
+        sizes = [obs_dim + act_dim] + list(hidden_sizes)
+        layers = []
+        for i in range(len(sizes) - 1):
+            layers += [nn.Linear(sizes[i], sizes[i + 1]), nn.ReLU(inplace=True)]
+        layers.append(nn.Linear(sizes[-1], obs_dim + out_dim))
+        self.model = nn.Sequential(*layers)
+        self.obs_dim = obs_dim
+        for name, dim in [('obs', obs_dim), ('delta', obs_dim), ('out', out_dim)]:
+            self.register_buffer(name + '_mean', torch.zeros(dim))
+            self.register_buffer(name + '_std', torch.ones(dim))
+
+    def forward(self, obs, act_feat):
+        x = torch.cat([(obs - self.obs_mean) / self.obs_std, act_feat], dim=-1)
+        return self.model(x)
+
+    def predict(self, obs, act_feat):
+        y = self(obs, act_feat)
+        delta = y[:, :self.obs_dim] * self.delta_std + self.delta_mean
+        out = y[:, self.obs_dim:] * self.out_std + self.out_mean
+        return obs + delta, out
+
+
+def load_transitions(folder, buffer_num=1, map_action=None):
+    """Transitions ``(obs, act, out, next_obs, first_obs)`` from recorded evaluation runs.
+
+    Every epoch in ``his_*.npy`` holds ``buffer_num`` sub-buffers of one episode each,
+    with one unused slot at the end of every sub-buffer. ``his_act`` holds the actions
+    as the policy returned them; pass the policy's ``map_action`` to get the actions
+    the env was stepped with, as for PPO's scaled and bounded continuous actions.
+    """
+    # only the epochs finished so far, if the run is still going
+    data, _ = load_trajectories(folder, ('obs', 'act', 'rew', 'cost', 'penalty'), mmap=False)
+    obs, act, rew = data['obs'], data['act'], data['rew']
+    if rew.ndim != obs.ndim - 1:
+        raise ValueError("{}/his_rew.npy does not hold rewards".format(folder))
+    if 'cost' in data and 'penalty' in data:
+        out = np.stack([data['cost'], data['penalty']], axis=-1)
+    else:
+        out = rew[..., None]
+
+    def split(x):
+        # (epochs, buffer_num * L, ...) -> (epochs * buffer_num, L, ...)
+        x = x.reshape((x.shape[0], buffer_num, x.shape[1] // buffer_num) + x.shape[2:])
+        return x.reshape((-1,) + x.shape[2:])
+
+    obs, act, out = split(obs), split(act), split(out)
+    steps = obs.shape[1] - 1
+    s = obs[:, :steps - 1].reshape(-1, obs.shape[-1])
+    s_next = obs[:, 1:steps].reshape(-1, obs.shape[-1])
+    a = act[:, :steps - 1].reshape((-1,) + act.shape[2:])
+    o = out[:, :steps - 1].reshape(-1, out.shape[-1])
+    if map_action is not None:
+        a = np.asarray(map_action(a))
+    return s, a, o, s_next, obs[:, 0]
+
+
+def fit(obs, act, out, next_obs, first_obs, observation_space, action_space, max_steps,
+        hidden_sizes=(256, 256), epochs=200, batch_size=1024, lr=1e-3, device='cpu'):
+    """Fit a :class:`SurrogateModel` and return it with its metadata."""
+    act_feat = action_features(act, action_space)
+    delta = next_obs - obs
+    model = SurrogateModel(obs.shape[1], act_feat.shape[1], out.shape[1], hidden_sizes).to(device)
+    for name, x in [('obs', obs), ('delta', delta), ('out', out)]:
+        getattr(model, name + '_mean').copy_(torch.as_tensor(x.mean(0), dtype=torch.float))
+        getattr(model, name + '_std').copy_(torch.as_tensor(x.std(0) + 1e-6, dtype=torch.float))
+
+    obs_t = torch.as_tensor(obs, dtype=torch.float, device=device)
+    act_t = torch.as_tensor(act_feat, dtype=torch.float, device=device)
+    target = torch.cat([(torch.as_tensor(delta, dtype=torch.float, device=device) - model.delta_mean) / model.delta_std,
+                        (torch.as_tensor(out, dtype=torch.float, device=device) - model.out_mean) / model.out_std], dim=-1)
+    optim = torch.optim.Adam(model.parameters(), lr=lr)
+    n = len(obs_t)
+    for epoch in range(epochs):
+        perm = torch.randperm(n, device=device)
+        total = 0.
+        for i in range(0, n, batch_size):
+            idx = perm[i:i + batch_size]
+            loss = ((model(obs_t[idx], act_t[idx]) - target[idx]) ** 2).mean()
+            optim.zero_grad()
+            loss.backward()
+            optim.step()
+            total += loss.item() * len(idx)
+        if (epoch + 1) % 50 == 0:
+            print("surrogate epoch {}: mse {:.5f}".format(epoch + 1, total / n))
+
+    meta = {
+        'observation_space': _space_to_dict(observation_space),
+        'action_space': _space_to_dict(action_space),
+        'max_steps': int(max_steps),
+        'outputs': 'components' if out.shape[1] == 2 else 'reward',
+        'hidden_sizes': list(hidden_sizes),
+        'act_dim': int(act_feat.shape[1]),
+        'out_dim': int(out.shape[1]),
+    }
+    return model.cpu(), meta, np.asarray(first_obs, dtype=np.float32)
+
+
+def save(path, model, meta, first_obs):
+    torch.save({'state_dict': model.state_dict(), 'meta': meta, 'first_obs': first_obs}, path)
+
+
+def fit_from_files(folder, observation_space, action_space, max_steps, path, buffer_num=1,
+                   map_action=None, **kwargs):
+    """Fit a surrogate on the runs recorded in ``folder`` and save it to ``path``."""
+    transitions = load_transitions(folder, buffer_num, map_action)
+    print("Fitting surrogate on {} transitions from {}".format(len(transitions[0]), folder))
+    model, meta, first_obs = fit(*transitions, observation_space=observation_space,
+                                 action_space=action_space, max_steps=max_steps, **kwargs)
+    save(path, model, meta, first_obs)
+    print("Saved surrogate to", path)
+    return path
+
+
+class SurrogateSimulator(object):
+    """Batched surrogate dynamics of ``num`` independent buildings."""
+
+    def __init__(self, model, meta, first_obs, num, weight_energy=None, weight_temp=None, seed=None):
+        self.model = model.eval()
+        self.meta = meta
+        self.first_obs = first_obs
+        self.num = num
+        self.observation_space = _space_from_dict(meta['observation_space'])
+        self.action_space = _space_from_dict(meta['action_space'])
+        self.max_steps = meta['max_steps']
+        self.obs = np.zeros((num, first_obs.shape[1]), dtype=np.float32)
+        self.t = np.zeros(num, dtype=np.int64)
+        self.rng = np.random.RandomState(seed)
+        self.engine = None
+        if meta['outputs'] == 'components':
+            self.engine = RewardEngine(weight_energy, weight_temp, num_envs=num)
+            self.cost = np.zeros(num)
+            self.penalty = np.zeros(num)
+
+    @classmethod
+    def load(cls, path, num, args=None):
+        data = torch.load(path, map_location='cpu')
+        meta = data['meta']
+        model = SurrogateModel(data['first_obs'].shape[1], meta['act_dim'], meta['out_dim'],
+                               meta['hidden_sizes'])
+        model.load_state_dict(data['state_dict'])
+        weights = {}
+        if args is not None:
+            weights = dict(weight_energy=args.weight_energy, weight_temp=args.weight_temp,
+                           seed=args.seed)
+        return cls(model, meta, data['first_obs'], num, **weights)
+
+    def seed(self, seed):
+        self.rng = np.random.RandomState(seed)
+
+    def reset(self, ids):
+        self.obs[ids] = self.first_obs[self.rng.randint(len(self.first_obs), size=len(ids))]
+        self.t[ids] = 0
+        return self.obs[ids].copy()
+
+    def step(self, act, ids):
+        with torch.no_grad():
+            next_obs, out = self.model.predict(
+                torch.as_tensor(self.obs[ids]),
+                torch.as_tensor(action_features(act, self.action_space)))
+        next_obs = np.clip(next_obs.numpy(), self.observation_space.low, self.observation_space.high)
+        out = out.numpy().astype(np.float64)
+        if self.engine is None:
+            rew = out[:, 0]
+        else:
+            # envs that are not stepped keep their last components
+            self.cost[ids], self.penalty[ids] = out[:, 0], out[:, 1]
+            rew = self.engine.compute(self.cost, self.penalty)[ids].copy()
+        self.obs[ids] = next_obs
+        self.t[ids] += 1
+        done = self.t[ids] >= self.max_steps
+        return next_obs.copy(), rew, done, [{} for _ in ids]
+
+
+class SurrogateVectorEnv(InProcessVectorEnv):
+    """``num`` surrogate buildings stepped with one batched forward pass."""
+
+    def __init__(self, simulator):
+        super().__init__(simulator.num, simulator.observation_space, simulator.action_space)
+        self.simulator = simulator
+
+    @classmethod
+    def load(cls, path, num, args=None):
+        return cls(SurrogateSimulator.load(path, num, args))
+
+    def _seed(self, seeds):
+        self.simulator.seed(seeds[0])
+
+    def _reset(self, ids):
+        return self.simulator.reset(ids)
+
+    def _step(self, action, ids):
+        return self.simulator.step(action, ids)
+
+
+class SurrogateBuildingEnv(gym.Env):
+    """Single surrogate building with the interface of the FMU env."""
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.observation_space = simulator.observation_space
+        self.action_space = simulator.action_space
+        self._ids = np.zeros(1, dtype=np.int64)
+
+    @classmethod
+    def load(cls, path, args=None):
+        return cls(SurrogateSimulator.load(path, 1, args))
+
+    def seed(self, seed=None):
+        self.simulator.seed(seed)
+        return [seed]
+
+    def reset(self):
+        return self.simulator.reset(self._ids)[0]
+
+    def step(self, action):
+        obs, rew, done, info = self.simulator.step(np.asarray([action]), self._ids)
+        return obs[0], float(rew[0]), bool(done[0]), info[0]
+
+
+def _policy_action(policy, obs):
+    from tianshou.data import Batch, to_numpy
+
+    with torch.no_grad():
+        result = policy(Batch(obs=np.asarray(obs)[None], info={}))
+    return policy.map_action(to_numpy(result.act))[0]
+
+
+def fidelity_check(policy, fmu_env, surrogate_env, n_steps):
+    """Run ``policy`` for ``n_steps`` on the FMU and the surrogate and report the divergence.
+
+    The closed-loop part lets the policy act on each env's own observations. The
+    open-loop part feeds the FMU's actions to the surrogate, starting from the FMU's
+    first observation, which isolates the model error from the policy's reaction to it.
+    """
+    def rollout(env, actions=None, first_obs=None):
+        obs = env.reset()
+        if first_obs is not None:
+            env.simulator.obs[0] = first_obs
+            obs = np.array(first_obs, copy=True)
+        obss, acts, rews = [obs], [], []
+        for t in range(n_steps):
+            act = _policy_action(policy, obs) if actions is None else actions[t]
+            obs, rew, done, info = env.step(act)
+            obss.append(obs)
+            acts.append(act)
+            rews.append(rew)
+            if done:
+                break
+        return np.array(obss), np.array(acts), np.array(rews)
+
+    fmu_obs, fmu_act, fmu_rew = rollout(fmu_env)
+    sur_obs, sur_act, sur_rew = rollout(surrogate_env)
+    ol_obs, _, ol_rew = rollout(surrogate_env, actions=fmu_act, first_obs=fmu_obs[0])
+
+    def rmse(a, b):
+        n = min(len(a), len(b))
+        return np.sqrt(((a[:n] - b[:n]) ** 2).mean(axis=0))
+
+    n = min(len(fmu_act), len(sur_act))
+    report = {
+        'steps': int(len(fmu_rew)),
+        'fmu_return': float(fmu_rew.sum()),
+        'surrogate_return': float(sur_rew.sum()),
+        'closed_loop_obs_rmse': rmse(fmu_obs, sur_obs).tolist(),
+        'closed_loop_rew_mae': float(np.abs(fmu_rew[:n] - sur_rew[:n]).mean()),
+        'action_agreement': float(np.mean(np.all(
+            np.isclose(fmu_act[:n].reshape(n, -1), sur_act[:n].reshape(n, -1)), axis=1))),
+        'open_loop_obs_rmse': rmse(fmu_obs[1:], ol_obs[1:]).tolist(),
+        'open_loop_rew_mae': float(np.abs(fmu_rew[:len(ol_rew)] - ol_rew[:len(fmu_rew)]).mean()),
+    }
+    print(json.dumps(report, indent=2))
+    return report
@@ -0,0 +1,136 @@
+"""Ray Tune plumbing shared by the training scripts.
+
+A trial gets a private copy of the script's args (:func:`trial_args`), logs and
+records into its own trial directory, reports the latest test reward to Tune
+after every epoch and checkpoints its whole run with the ``Checkpointer``. A
+Tune checkpoint is a copy of that folder whose files are hard links, taken
+every ``--tune-checkpoint-freq`` epochs, only after the last one by default
+(:func:`run_trial`).
+
+:func:`run_pbt` trains a population with Ray's ``PopulationBasedTraining``
+instead of a grid of independent runs. Every ``--pbt-interval`` epochs the
+bottom quarter of the population restores the Tune checkpoint of a member of
+the top quarter, so it continues with that member's weights, optimizer states
+and replay buffer, and perturbs the learning rates and the reward weights. The
+checkpoint copies stay on the node, in ``--tune-dir`` (``/dev/shm`` keeps them
+in shared memory).
+
+With ``--vector-env service`` the trials run their building envs in the node's
+simulation service (:mod:`sim_service`) instead of worker processes of their
+own; :func:`reserve_sim_service` starts it and takes its workers off the CPUs
+of the trials.
+"""
+import os
+import shutil
+import argparse
+
+import torch
+
+from . import resources
+from .checkpoint import link_tree
+
+
+def trial_args(base_args, config):
+    """A copy of ``base_args`` with the tuned values of ``config``."""
+    args = argparse.Namespace(**vars(base_args))
+    for k, v in config.items():
+        if not hasattr(args, k):
+            # a typo would otherwise tune nothing
+            raise ValueError("unknown tuning parameter {}".format(k))
+        setattr(args, k, v)
+    return args
+
+
+def run_trial(args, run_fn, checkpoint_dir, ckpt_subdir):
+    """Run one Tune trial of ``run_fn(args, report_fn=...)``.
+
+    :param checkpoint_dir: the Tune checkpoint to continue from, or None.
+    :param str ckpt_subdir: the ``Checkpointer`` folder of ``run_fn``, relative
+        to ``args.logdir``.
+    """
+    from ray import tune
+    # the cores Ray accounted for, torch and the env workers stay on them
+    cores = resources.pin_trial(args.trial_cpus, resources.learner_threads(args))
+    print("Trial pinned to cores {}".format(cores or "none (node full)"))
+    # every trial logs and records into its own directory
+    args.logdir = tune.get_trial_dir()
+    if hasattr(args, 'save_buffer_name'):
+        args.save_buffer_name = args.logdir
+    ckpt_folder = os.path.join(args.logdir, ckpt_subdir)
+    # the Ape-X learner does not checkpoint, its trials are not restored
+    freq = args.tune_checkpoint_freq if getattr(args, 'apex_actors', 0) <= 0 else -1
+    if freq >= 0:
+        args.checkpoint = True
+    if checkpoint_dir is not None:
+        # restored by Tune, after a node failure or from a better PBT member
+        shutil.rmtree(ckpt_folder, ignore_errors=True)
+        link_tree(os.path.join(checkpoint_dir, 'checkpoint'), ckpt_folder)
+        args.resume = True
+
+    def report_fn(epoch, env_step, gradient_step, test):
+        if freq >= 0 and (epoch == args.epoch or (freq > 0 and epoch % freq == 0)):
+            with tune.checkpoint_dir(step=epoch) as d:
+                link_tree(ckpt_folder, os.path.join(d, 'checkpoint'))
+        # a trial stopped by the scheduler does not return from here
+        tune.report(test_reward=test['rew'], test_epoch=test['epoch'], epoch=epoch,
+                    timesteps_total=env_step, gradient_step=gradient_step)
+
+    run_fn(args, report_fn=report_fn)
+
+
+def reserve_sim_service(args):
+    """Start the simulation service for ``--vector-env service`` and keep ``--sim-workers`` CPUs for it."""
+    if args.vector_env != 'service':
+        return
+    from . import sim_service
+
+    sim_service.ensure_service(args.sim_address, args.sim_workers, args.sim_batch, pin=True)
+    args.tune_cpus = max(1, args.tune_cpus - args.sim_workers)
+
+
+def trial_resources(args, run_fn):
+    """Measure or estimate one trial and return its ``resources_per_trial``.
+
+    Sets ``args.trial_cpus``, the cores a trial pins itself to.
+    """
+    reserve_sim_service(args)
+    if args.tune_calibrate > 0:
+        footprint = resources.calibrate(args, run_fn, steps=args.tune_calibrate)
+    else:
+        footprint = resources.trial_footprint(args)
+    args.trial_cpus, max_trials = resources.plan(footprint, args.tune_cpus)
+    print("Trial footprint: {}".format(footprint))
+    print("Requesting {} CPUs per trial, {} trials at once".format(args.trial_cpus, max_trials))
+    trial_resources = {'cpu': args.trial_cpus}
+    if args.device.startswith('cuda') and torch.cuda.is_available():
+        trial_resources['gpu'] = min(1., torch.cuda.device_count() / float(max_trials))
+    return trial_resources
+
+
+def run_pbt(args, trainable, run_fn, name, mutations):
+    """Train ``args.pbt_population`` members with population based training.
+
+    :param trainable: the script's Tune trainable, ``f(config, checkpoint_dir, base_args)``.
+    :param run_fn: the script's training function, for the calibration run.
+    :param dict mutations: ``{arg name: (low, high)}``, sampled and perturbed
+        log-uniformly.
+    """
+    import ray
+    from ray import tune
+    from ray.tune.schedulers import PopulationBasedTraining
+
+    if getattr(args, 'apex_actors', 0) > 0:
+        raise ValueError("--pbt-population copies checkpoints, which --apex-actors does not write")
+    # a member can only be copied from an epoch it checkpointed
+    args.tune_checkpoint_freq = args.pbt_interval
+    trial_res = trial_resources(args, run_fn)
+    ray.init(num_cpus=args.tune_cpus)
+    space = {k: tune.loguniform(low, high) for k, (low, high) in mutations.items()}
+    scheduler = PopulationBasedTraining(time_attr='epoch', perturbation_interval=args.pbt_interval,
+                                        hyperparam_mutations=space, quantile_fraction=0.25,
+                                        resample_probability=0.25)
+    return tune.run(tune.with_parameters(trainable, base_args=args),
+                    name=name, config=dict(space), num_samples=args.pbt_population,
+                    scheduler=scheduler, metric='test_reward', mode='max',
+                    resources_per_trial=trial_res, local_dir=args.tune_dir,
+                    resume=bool(args.resume))
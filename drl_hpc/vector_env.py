@@ -0,0 +1,369 @@
+"""Vector envs for the JModelica building envs.
+
+``SubprocVectorEnv`` pickles every observation, reward and done flag through a
+pipe. :class:`FMUVectorEnv` keeps them in shared memory that is allocated once per
+worker, so the pipe only carries the (small) info dict that signals the step is
+done. Combined with ``wait_num`` the collector can go on with the first
+``wait_num`` workers whose FMU finished its step instead of the slowest one.
+
+:class:`MultiZoneVectorEnv` goes the other way: every worker process hosts several
+independent building models (:class:`BatchedBuildingEnv`) and steps them in
+lockstep, so the interpreter, torch and JModelica runtime are paid per process
+rather than per zone.
+
+:class:`sim_service.ServiceVectorEnv` runs the envs in the worker pool of a
+simulation service that all runs on the node share.
+"""
+import ctypes
+from functools import partial
+from multiprocessing import Array, Pipe, Process
+
+import numpy as np
+from tianshou.env import BaseVectorEnv, SubprocVectorEnv
+from tianshou.env.utils import CloudpickleWrapper
+from tianshou.env.worker import EnvWorker, SubprocEnvWorker
+
+
+def _shared_array(dtype, shape):
+    size = int(np.prod(shape)) if len(shape) else 1
+    return Array(np.ctypeslib.as_ctypes_type(np.dtype(dtype)), size, lock=False)
+
+
+def _fmu_worker(parent, p, env_fn_wrapper, obs_buf, rew_buf, done_buf, obs_dtype, obs_shape):
+    parent.close()
+    env = env_fn_wrapper.data()
+    obs_arr = np.frombuffer(obs_buf, dtype=obs_dtype).reshape(obs_shape)
+    rew_arr = np.frombuffer(rew_buf, dtype=np.float64)
+    done_arr = np.frombuffer(done_buf, dtype=np.bool_)
+    try:
+        while True:
+            try:
+                cmd, data = p.recv()
+            except EOFError:  # the pipe has been closed
+                p.close()
+                break
+            if cmd == "step":
+                obs, rew, done, info = env.step(data)
+                obs_arr[:] = obs
+                rew_arr[0] = rew
+                done_arr[0] = done
+                p.send(info)
+            elif cmd == "reset":
+                obs_arr[:] = env.reset()
+                p.send(None)
+            elif cmd == "close":
+                p.send(env.close())
+                p.close()
+                break
+            elif cmd == "render":
+                p.send(env.render(**data) if hasattr(env, "render") else None)
+            elif cmd == "seed":
+                p.send(env.seed(data) if hasattr(env, "seed") else None)
+            elif cmd == "getattr":
+                p.send(getattr(env, data) if hasattr(env, data) else None)
+            else:
+                p.close()
+                raise NotImplementedError
+    except KeyboardInterrupt:
+        p.close()
+
+
+class FMUEnvWorker(SubprocEnvWorker):
+    """Subprocess worker that returns obs, rew and done through shared memory.
+
+    The observation space is passed in, so no dummy env (and no extra FMU) has to
+    be built in the main process to size the buffers.
+    """
+
+    def __init__(self, env_fn, observation_space):
+        self.parent_remote, self.child_remote = Pipe()
+        self.share_memory = True
+        self.obs_dtype = observation_space.dtype
+        self.obs_shape = observation_space.shape
+        self.obs_buf = _shared_array(self.obs_dtype, self.obs_shape)
+        self.rew_buf = Array(ctypes.c_double, 1, lock=False)
+        self.done_buf = Array(ctypes.c_bool, 1, lock=False)
+        self.obs_arr = np.frombuffer(self.obs_buf, dtype=self.obs_dtype).reshape(self.obs_shape)
+        self.rew_arr = np.frombuffer(self.rew_buf, dtype=np.float64)
+        self.done_arr = np.frombuffer(self.done_buf, dtype=np.bool_)
+        args = (self.parent_remote, self.child_remote, CloudpickleWrapper(env_fn),
+                self.obs_buf, self.rew_buf, self.done_buf, self.obs_dtype, self.obs_shape)
+        self.process = Process(target=_fmu_worker, args=args, daemon=True)
+        self.process.start()
+        self.child_remote.close()
+        EnvWorker.__init__(self, env_fn)
+
+    def reset(self):
+        self.parent_remote.send(["reset", None])
+        self.parent_remote.recv()
+        return self.obs_arr.copy()
+
+    def get_result(self):
+        info = self.parent_remote.recv()
+        return self.obs_arr.copy(), self.rew_arr[0], bool(self.done_arr[0]), info
+
+
+class FMUVectorEnv(BaseVectorEnv):
+    """Shared-memory vector env for the building envs.
+
+    :param env_fns: a list of callables that build the envs.
+    :param observation_space: the (common) observation space of the envs.
+    :param int wait_num: return after this many envs finished their step. Default
+        to None, i.e. wait for all of them.
+    :param float timeout: return after this many seconds even if fewer than
+        ``wait_num`` envs are ready. Default to None.
+    """
+
+    def __init__(self, env_fns, observation_space, wait_num=None, timeout=None):
+        def worker_fn(fn):
+            return FMUEnvWorker(fn, observation_space)
+
+        super().__init__(env_fns, worker_fn, wait_num=wait_num, timeout=timeout)
+
+
+class InProcessVectorEnv(BaseVectorEnv):
+    """Base class of vector envs that step all their envs inside one process.
+
+    Subclasses work on whole batches and implement ``_reset(ids)`` and
+    ``_step(action, ids)``; no worker processes or pipes are involved.
+    """
+
+    def __init__(self, env_num, observation_space, action_space):
+        self.env_num = env_num
+        self.workers = []
+        self.is_async = False
+        self.wait_num = env_num
+        self.timeout = None
+        self.waiting_conn = []
+        self.waiting_id = []
+        self.ready_id = list(range(env_num))
+        self.is_closed = False
+        self._spaces = {'observation_space': observation_space,
+                        'action_space': action_space}
+
+    def __getattr__(self, key):
+        if key in ('observation_space', 'action_space'):
+            return [self._spaces[key]] * self.env_num
+        if key in ('metadata', 'reward_range', 'spec'):
+            return [None] * self.env_num
+        raise AttributeError(key)
+
+    def reset(self, id=None):
+        self._assert_is_not_closed()
+        return self._reset(np.asarray(self._wrap_id(id)))
+
+    def step(self, action, id=None):
+        self._assert_is_not_closed()
+        id = np.asarray(self._wrap_id(id))
+        assert len(action) == len(id)
+        obs, rew, done, info = self._step(np.asarray(action), id)
+        for env_id, i in zip(id, info):
+            i["env_id"] = env_id
+        return obs, rew, done, np.array(info, dtype=object)
+
+    def seed(self, seed=None):
+        self._assert_is_not_closed()
+        if seed is None:
+            return [None] * self.env_num
+        seeds = [seed + i for i in range(self.env_num)] if np.isscalar(seed) else list(seed)
+        self._seed(seeds)
+        return seeds
+
+    def render(self, **kwargs):
+        return [None] * self.env_num
+
+    def close(self):
+        if self.is_closed:
+            return []
+        self.is_closed = True
+        return self._close()
+
+    def _seed(self, seeds):
+        pass
+
+    def _close(self):
+        return []
+
+    def _reset(self, ids):
+        raise NotImplementedError
+
+    def _step(self, action, ids):
+        raise NotImplementedError
+
+
+class BatchedBuildingEnv(object):
+    """Several independent building envs stepped in lockstep inside one process.
+
+    :param env_fns: a list of callables that build the envs.
+    """
+
+    def __init__(self, env_fns):
+        self.envs = [fn() for fn in env_fns]
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+
+    def __len__(self):
+        return len(self.envs)
+
+    def reset(self, ids):
+        return np.stack([self.envs[i].reset() for i in ids])
+
+    def step(self, action, ids):
+        """Step the envs ``ids``; returns arrays of shape ``(len(ids), ...)``."""
+        obs, rew, done, info = zip(*[self.envs[i].step(a) for i, a in zip(ids, action)])
+        return np.stack(obs), np.array(rew), np.array(done), list(info)
+
+    def seed(self, seeds):
+        return [env.seed(s) for env, s in zip(self.envs, seeds)]
+
+    def close(self):
+        return [env.close() for env in self.envs]
+
+
+def _multizone_worker(parent, p, env_fns_wrapper):
+    parent.close()
+    envs = BatchedBuildingEnv(env_fns_wrapper.data)
+    try:
+        while True:
+            try:
+                cmd, data = p.recv()
+            except EOFError:  # the pipe has been closed
+                p.close()
+                break
+            if cmd == "step":
+                p.send(envs.step(*data))
+            elif cmd == "reset":
+                p.send(envs.reset(data))
+            elif cmd == "seed":
+                p.send(envs.seed(data))
+            elif cmd == "spaces":
+                p.send((envs.observation_space, envs.action_space))
+            elif cmd == "close":
+                p.send(envs.close())
+                p.close()
+                break
+            else:
+                p.close()
+                raise NotImplementedError
+    except KeyboardInterrupt:
+        p.close()
+
+
+class MultiZoneVectorEnv(InProcessVectorEnv):
+    """Vector env of N building envs hosted ``envs_per_proc`` at a time per process.
+
+    Tianshou sees ``len(env_fns)`` envs. A step sends one message with the actions
+    of all its zones to every process, the processes run in parallel, and each
+    returns the stacked ``(n_zones, obs_dim)`` results of its zones.
+
+    :param env_fns: a list of callables that build the envs.
+    :param int envs_per_proc: how many envs share one worker process.
+    """
+
+    def __init__(self, env_fns, envs_per_proc):
+        self.groups = []
+        self.conns = []
+        self.processes = []
+        for start in range(0, len(env_fns), envs_per_proc):
+            fns = env_fns[start:start + envs_per_proc]
+            parent_remote, child_remote = Pipe()
+            process = Process(target=_multizone_worker, daemon=True,
+                              args=(parent_remote, child_remote, CloudpickleWrapper(fns)))
+            process.start()
+            child_remote.close()
+            self.groups.append(np.arange(start, start + len(fns)))
+            self.conns.append(parent_remote)
+            self.processes.append(process)
+        self.conns[0].send(["spaces", None])
+        observation_space, action_space = self.conns[0].recv()
+        super().__init__(len(env_fns), observation_space, action_space)
+        self.envs_per_proc = envs_per_proc
+
+    def _scatter(self, ids):
+        """Split global env ids into (group, positions in ids, local ids) per process."""
+        group_of = ids // self.envs_per_proc
+        for g in np.unique(group_of):
+            pos = np.where(group_of == g)[0]
+            yield g, pos, ids[pos] - self.groups[g][0]
+
+    def _reset(self, ids):
+        parts = list(self._scatter(ids))
+        for g, pos, local in parts:
+            self.conns[g].send(["reset", local])
+        obs = [None] * len(ids)
+        for g, pos, local in parts:
+            for p, o in zip(pos, self.conns[g].recv()):
+                obs[p] = o
+        return np.stack(obs)
+
+    def _step(self, action, ids):
+        parts = list(self._scatter(ids))
+        for g, pos, local in parts:
+            self.conns[g].send(["step", (action[pos], local)])
+        obs, rew, done, info = [None] * len(ids), np.zeros(len(ids)), np.zeros(len(ids), dtype=bool), [None] * len(ids)
+        for g, pos, local in parts:
+            g_obs, g_rew, g_done, g_info = self.conns[g].recv()
+            rew[pos] = g_rew
+            done[pos] = g_done
+            for j, p in enumerate(pos):
+                obs[p] = g_obs[j]
+                info[p] = g_info[j]
+        return np.stack(obs), rew, done, info
+
+    def _seed(self, seeds):
+        for g, conn in enumerate(self.conns):
+            conn.send(["seed", [seeds[i] for i in self.groups[g]]])
+        for conn in self.conns:
+            conn.recv()
+
+    def _close(self):
+        res = []
+        for conn, process in zip(self.conns, self.processes):
+            try:
+                conn.send(["close", None])
+                res += conn.recv()
+                process.join()
+            except (BrokenPipeError, EOFError):
+                pass
+            process.terminate()
+        return res
+
+
+def zone_configs(args, num):
+    """Per-env ``make_building_env`` overrides, cycling through the ``--zone-*`` lists."""
+    options = [('weather_file', getattr(args, 'zone_weather_files', None)),
+               ('start_day', getattr(args, 'zone_start_days', None)),
+               ('mass_flow_nor', getattr(args, 'zone_mass_flow', None))]
+    configs = []
+    for i in range(num):
+        configs.append({key: values[i % len(values)] for key, values in options if values})
+    return configs
+
+
+def make_vector_env(make_fn, num, args, observation_space, wait_num=None):
+    """Build ``num`` building envs in the vector env selected by ``args.vector_env``.
+
+    ``make_fn`` takes the per-env overrides of :func:`zone_configs` as keyword
+    arguments. ``wait_num`` only applies to the training envs; evaluation needs
+    all envs. The service vector env always waits for all envs.
+    """
+    if getattr(args, 'surrogate', None):
+        from . import surrogate
+
+        if surrogate.use_surrogate(args):
+            return surrogate.SurrogateVectorEnv.load(args.surrogate, num, args)
+    env_fns = [partial(make_fn, **cfg) for cfg in zone_configs(args, num)]
+    if args.vector_env == 'service':
+        from . import sim_service
+
+        # the envs run in the worker pool shared by every run on the node
+        sim_service.ensure_service(args.sim_address, args.sim_workers, args.sim_batch)
+        return sim_service.ServiceVectorEnv(env_fns, observation_space, args.sim_address)
+    if args.vector_env == 'multizone':
+        return MultiZoneVectorEnv(env_fns, args.envs_per_proc)
+    if wait_num is not None and wait_num >= num:
+        wait_num = None
+    if args.vector_env == 'fmu':
+        return FMUVectorEnv(env_fns, observation_space, wait_num=wait_num,
+                            timeout=args.env_timeout)
+    return SubprocVectorEnv(env_fns, wait_num=wait_num, timeout=args.env_timeout)
@@ -0,0 +1,226 @@
+"""Pre-parsed, memory-mapped weather data shared by all env workers.
+
+The building envs use the EPW file as an ideal weather predictor: each env parses
+the text file (``read_temperature_solar``) and looks up the next ``npre_step``
+values of outdoor temperature and solar radiation (``predictor``). Here the EPW is
+compiled once into a ``.npy`` array on the simulation time grid, next to the
+EPW file. Every process opens it with ``mmap_mode='r'``, so all workers and tuning
+trials on a node share one read-only copy through the page cache, and a forecast
+window is just a slice of that array. :func:`make_env` patches the env class while
+the env is constructed, so the EPW text is not parsed in ``__init__`` either.
+
+One-time compilation from the command line::
+
+    python -m drl_hpc.weather_cache USA_CA_Riverside.Muni.AP.722869_TMY3.epw --time-step 900
+"""
+import os
+import json
+import inspect
+import argparse
+import importlib
+import contextlib
+
+import numpy as np
+
+# EPW data columns kept in the cache, named as in pvlib.iotools.read_epw
+FIELDS = {
+    'temp_air': 6,
+    'relative_humidity': 8,
+    'ghi': 13,
+    'dni': 14,
+    'dhi': 15,
+    'wind_speed': 21,
+}
+EPW_HEADER_LINES = 8
+
+
+def cache_path(epw_path, time_step):
+    root, _ = os.path.splitext(epw_path)
+    return '{}_{}s.npy'.format(root, int(time_step))
+
+
+def read_epw_hourly(epw_path):
+    """Parse the hourly data rows of an EPW file into an array of ``FIELDS``."""
+    rows = []
+    with open(epw_path, 'r') as f:
+        for i, line in enumerate(f):
+            if i < EPW_HEADER_LINES or not line.strip():
+                continue
+            cols = line.split(',')
+            rows.append([float(cols[c]) for c in FIELDS.values()])
+    return np.array(rows, dtype=np.float64)
+
+
+def compile_epw(epw_path, time_step, out_path=None):
+    """Compile ``epw_path`` into a ``(n_steps, 1 + len(FIELDS))`` array.
+
+    Column 0 is the simulation time in seconds from the start of the year, with the
+    first hourly row at 0 s as in the env, and the data is linearly interpolated
+    onto a ``time_step`` grid. The array is written atomically, so concurrent
+    workers never read a half-written file.
+    """
+    out_path = out_path or cache_path(epw_path, time_step)
+    hourly = read_epw_hourly(epw_path)
+    time_h = np.arange(len(hourly)) * 3600.
+    time_step_grid = np.arange(0., 3600. * len(hourly), time_step)
+    data = np.empty((len(time_step_grid), 1 + len(FIELDS)), dtype=np.float64)
+    data[:, 0] = time_step_grid
+    for j in range(len(FIELDS)):
+        data[:, j + 1] = np.interp(time_step_grid, time_h, hourly[:, j])
+
+    tmp_path = '{}.{}.tmp'.format(out_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp_path, out_path)
+    with open(os.path.splitext(out_path)[0] + '.json', 'w') as fp:
+        json.dump({'epw': os.path.basename(epw_path), 'time_step': time_step,
+                   'fields': ['time'] + list(FIELDS)}, fp)
+    return out_path
+
+
+class WeatherCache(object):
+    """Read-only view on a compiled weather array.
+
+    :param str path: the ``.npy`` file written by :func:`compile_epw`.
+    :param float time_step: the time step the file was compiled with.
+    """
+
+    def __init__(self, path, time_step):
+        self.path = path
+        self.time_step = float(time_step)
+        self.data = np.load(path, mmap_mode='r')
+        self.columns = {name: j + 1 for j, name in enumerate(FIELDS)}
+
+    def __len__(self):
+        return len(self.data)
+
+    def index(self, t):
+        return int(round(t / self.time_step))
+
+    def column(self, name):
+        return self.data[:, self.columns[name]]
+
+    def forecast(self, t, n, name):
+        """Values of ``name`` at ``t + time_step, ..., t + n * time_step`` (clipped at year end)."""
+        i = self.index(t)
+        return self.data[i + 1:i + 1 + n, self.columns[name]]
+
+    def frame(self, names=('temp_air', 'ghi')):
+        """Columns as a DataFrame indexed by simulation time, like ``read_temperature_solar``."""
+        import pandas as pd
+
+        return pd.DataFrame({name: self.column(name) for name in names},
+                            index=self.data[:, 0])
+
+
+_CACHES = {}
+
+
+def open_cache(epw_path, time_step):
+    """Open the compiled cache of ``epw_path``, compiling it first if it is missing or stale."""
+    path = cache_path(epw_path, time_step)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(epw_path):
+        compile_epw(epw_path, time_step, path)
+    key = (os.getpid(), path)
+    if key not in _CACHES:
+        _CACHES[key] = WeatherCache(path, time_step)
+    return _CACHES[key]
+
+
+def env_class(task):
+    """The env class registered for ``task``, without constructing an env."""
+    import gym
+
+    entry_point = gym.spec(task).entry_point
+    if callable(entry_point):
+        return entry_point
+    module, name = entry_point.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def find_epw(epw_path, env_cls=None):
+    """``epw_path`` as given, else next to the module of ``env_cls``; None if neither exists."""
+    candidates = [epw_path]
+    if env_cls is not None and not os.path.isabs(epw_path):
+        candidates.append(os.path.join(os.path.dirname(inspect.getfile(env_cls)), epw_path))
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+@contextlib.contextmanager
+def patched(env_cls, cache):
+    """Envs of ``env_cls`` constructed inside the block read the weather from ``cache``."""
+    tem_sol_step = cache.frame()
+
+    def read_temperature_solar(self):
+        return tem_sol_step
+
+    def predictor(self, n):
+        t = self.start
+        return (list(cache.forecast(t, n, 'temp_air')),
+                list(cache.forecast(t, n, 'ghi')))
+
+    methods = {'read_temperature_solar': read_temperature_solar, 'predictor': predictor}
+    methods = {name: fn for name, fn in methods.items() if hasattr(env_cls, name)}
+    saved = {name: env_cls.__dict__[name] for name in methods if name in env_cls.__dict__}
+    for name, fn in methods.items():
+        setattr(env_cls, name, fn)
+    try:
+        yield env_cls
+    finally:
+        for name in methods:
+            if name in saved:
+                setattr(env_cls, name, saved[name])
+            else:
+                delattr(env_cls, name)
+
+
+def make_env(task, epw_path, time_step, **kwargs):
+    """``gym.make(task, **kwargs)`` with the env reading its weather from the cache of ``epw_path``.
+
+    If the EPW file is found neither as given nor next to the env module, the env is
+    built as is and reads the weather itself.
+    """
+    import gym
+
+    env_cls = env_class(task)
+    path = find_epw(epw_path, env_cls)
+    if path is None:
+        print("Weather cache disabled: {} not found".format(epw_path))
+        return gym.make(task, **kwargs)
+    cache = open_cache(path, time_step)
+    with patched(env_cls, cache):
+        env = gym.make(task, **kwargs)
+    # the class is restored after construction, the instance keeps reading the cache
+    return attach(env, cache)
+
+
+def attach(env, cache):
+    """Make the env read its weather and forecasts from ``cache`` instead of the EPW file."""
+    unwrapped = env.unwrapped
+    if abs(getattr(unwrapped, 'tau', cache.time_step) - cache.time_step) > 1e-6:
+        raise ValueError('weather cache time step {} does not match the env time step {}'.format(
+            cache.time_step, unwrapped.tau))
+
+    if hasattr(unwrapped, 'read_temperature_solar'):
+        tem_sol_step = cache.frame()
+        unwrapped.read_temperature_solar = lambda: tem_sol_step
+
+    if hasattr(unwrapped, 'predictor'):
+        def predictor(n):
+            t = unwrapped.start
+            return (list(cache.forecast(t, n, 'temp_air')),
+                    list(cache.forecast(t, n, 'ghi')))
+        unwrapped.predictor = predictor
+    return env
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compile EPW files into memory-mapped weather caches')
+    parser.add_argument('epw', type=str, nargs='+')
+    parser.add_argument('--time-step', type=float, default=15*60.0)
+    args = parser.parse_args()
+    for epw in args.epw:
+        print("Compiled", epw, "->", compile_epw(epw, args.time_step))
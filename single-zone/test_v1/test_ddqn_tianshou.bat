@@ -5,6 +5,7 @@ docker run^
 	  -v /tmp/.X11-unix:/tmp/.X11-unix:rw^
 	  --rm^
 	  -v %CD%:/mnt/shared^
+	  -v %CD%\..\..\drl_hpc:/mnt/drl_hpc/drl_hpc^
 	  -i^
       -t^
-	  mpcdrl /bin/bash -c "source activate base && export PYTHONPATH=$PYFMI_PY3_CONDA_PATH:$PYTHONPATH && cd /mnt/shared && python /mnt/shared/test_ddqn_tianshou.py"  
\ No newline at end of file
+	  mpcdrl /bin/bash -c "source activate base && export PYTHONPATH=$PYFMI_PY3_CONDA_PATH:$PYTHONPATH && export PYTHONPATH=/mnt/drl_hpc:$PYTHONPATH && cd /mnt/shared && python /mnt/shared/test_ddqn_tianshou.py"  
\ No newline at end of file
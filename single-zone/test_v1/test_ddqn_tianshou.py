@@ -10,53 +10,96 @@ from tianshou.policy import DQNPolicy
 from tianshou.utils import BasicLogger
 from tianshou.env import SubprocVectorEnv
 from tianshou.trainer import offpolicy_trainer
-from tianshou.data import Collector, VectorReplayBuffer
+from tianshou.data import AsyncCollector, Collector, VectorReplayBuffer
 import torch.nn as nn
 import gym
-
-def make_building_env(args):
+from drl_hpc import fmu_pool
+from drl_hpc.vector_env import make_vector_env, zone_configs
+from drl_hpc.state_cache import StartStateCache
+from drl_hpc.rollout_cache import RolloutCacheWrapper
+from drl_hpc.env_wrappers import ActionRepeatWrapper, RewardComponentsWrapper, macro_steps
+from drl_hpc import event_log
+from drl_hpc.async_eval import AsyncEvaluator, uses_async_eval
+from drl_hpc.eval_recorder import EvalRecorder
+from drl_hpc.checkpoint import Checkpointer
+from drl_hpc.convergence import ConvergenceMonitor, make_monitor
+from drl_hpc.replay import make_replay_buffer, anneal_beta
+from drl_hpc.fused_update import FusedUpdater
+from drl_hpc.multi_weight import make_multi_weight_policy, evaluate_heads
+from drl_hpc.apex import apex_trainer
+from drl_hpc import tuning
+from drl_hpc import weather_cache
+from drl_hpc.reward import RewardEngine
+from drl_hpc import surrogate
+
+def make_building_env(args, weather_file=None, start_day=None, mass_flow_nor=None, eval_cache=False):
+    if surrogate.use_surrogate(args):
+        return surrogate.SurrogateBuildingEnv.load(args.surrogate, args)
     import gym_singlezone_jmodelica
 
-    weather_file_path = "USA_IL_Chicago-OHare.Intl.AP.725300_TMY3.epw"
-    mass_flow_nor = [0.55]
+    fmu_file = "SingleZoneVAV.fmu"
+    weather_file_path = weather_file or "USA_IL_Chicago-OHare.Intl.AP.725300_TMY3.epw"
+    mass_flow_nor = [mass_flow_nor if mass_flow_nor is not None else 0.55]
     npre_step = 3
     simulation_start_time = 201*24*3600.0
+    start_days = [start_day] if start_day is not None else args.start_days
+    if start_days:
+        simulation_start_time = start_days[0]*24*3600.0
+    start_times = [d*24*3600.0 for d in start_days] if start_days else [simulation_start_time]
     simulation_end_time = simulation_start_time + args.step_per_epoch*args.time_step
-    log_level = 7
+    log_level = args.log_level
     alpha = 1
     nActions = 51
     weight_energy = args.weight_energy #5.e4
     weight_temp = args.weight_temp #500.
 
-    def rw_func(cost, penalty):
-        if ( not hasattr(rw_func,'x')  ):
-            rw_func.x = 0
-            rw_func.y = 0
-
-        cost = cost[0]
-        penalty = penalty[0]
-
-        if rw_func.x > cost:
-            rw_func.x = cost
-        if rw_func.y > penalty:
-            rw_func.y = penalty
-
-        print("rw_func-cost-min=", rw_func.x, ". penalty-min=", rw_func.y)
-        res = penalty * weight_temp + cost*weight_energy
-        
-        return res
-
-    env = gym.make(args.task,
-                   mass_flow_nor = mass_flow_nor,
-                   weather_file = weather_file_path,
-                   npre_step = npre_step,
-                   simulation_start_time = simulation_start_time,
-                   simulation_end_time = simulation_end_time,
-                   time_step = args.time_step,
-                   log_level = log_level,
-                   alpha = alpha,
-                   nActions = nActions,
-                   rf = rw_func)
+    # reward = weight_temp * penalty + weight_energy * cost, min/max kept in rw_func.stats()
+    rw_func = RewardEngine(weight_energy, weight_temp)
+
+    env_kwargs = dict(mass_flow_nor = mass_flow_nor,
+                      weather_file = weather_file_path,
+                      npre_step = npre_step,
+                      simulation_start_time = simulation_start_time,
+                      simulation_end_time = simulation_end_time,
+                      time_step = args.time_step,
+                      log_level = log_level,
+                      alpha = alpha,
+                      nActions = nActions)
+    # rw_func depends on the reward weights, so they are part of the pool key
+    reward_components = bool(args.multi_weight_energy)
+    pool_kwargs = dict(env_kwargs, weight_energy = weight_energy, weight_temp = weight_temp,
+                       action_repeat = args.action_repeat, reward_components = reward_components)
+
+    def make_env():
+        if args.weather_cache:
+            # forecasts become slices of the memory-mapped weather array shared by all workers
+            env = weather_cache.make_env(args.task, weather_file_path, args.time_step,
+                                         rf = rw_func, **env_kwargs)
+        else:
+            env = gym.make(args.task, rf = rw_func, **env_kwargs)
+        if args.action_repeat > 1:
+            # one step of the wrapper simulates action_repeat intervals inside the worker
+            env = ActionRepeatWrapper(env, args.action_repeat, rw_func)
+        if reward_components:
+            # cost and penalty go to the replay buffer, the reward can be recomputed for other weights
+            env = RewardComponentsWrapper(env, rw_func)
+        return env
+
+    if not args.fmu_pool:
+        env = make_env()
+    else:
+        # one initialized FMU per worker, resets restore the snapshot of their start day in place
+        snapshot_kwargs = dict(start_times = start_times,
+                               episode_length = args.step_per_epoch*args.time_step)
+        if args.state_cache:
+            snapshot_kwargs['store'] = StartStateCache(args.state_cache, fmu_file, weather_file_path,
+                                                       mass_flow_nor, args.time_step,
+                                                       snapshot_kwargs['episode_length'],
+                                                       npre_step, args.task)
+        env = fmu_pool.pooled_env(args.task, pool_kwargs, make_env, **snapshot_kwargs)
+    if eval_cache and args.eval_cache_mb > 0:
+        # evaluation replays mostly the same actions every epoch, known prefixes are served from memory
+        env = RolloutCacheWrapper(env, int(args.eval_cache_mb*2**20))
     return env
 
 class Net(nn.Module):
@@ -74,7 +117,7 @@ class Net(nn.Module):
 
     def forward(self, obs, state=None, info={}):
         if not isinstance(obs, torch.Tensor):
-            obs = torch.tensor(obs, dtype=torch.float).to(self.device)
+            obs = torch.as_tensor(obs, dtype=torch.float, device=self.device)
         batch = obs.shape[0]
         
         logits = self.model(obs.view(batch, -1))
@@ -112,6 +155,11 @@ def offpolicy_trainer_1(
     logger: BaseLogger = LazyLogger(),
     verbose: bool = True,
     test_in_train: bool = True,
+    evaluator: Optional[AsyncEvaluator] = None,
+    updater: Optional[FusedUpdater] = None,
+    checkpointer: Optional[Checkpointer] = None,
+    monitor: Optional[ConvergenceMonitor] = None,
+    report_fn: Optional[Callable[[int, int, int, Dict], None]] = None,
 ) -> Dict[str, Union[float, str]]:
 
     if save_fn:
@@ -121,17 +169,53 @@ def offpolicy_trainer_1(
     start_epoch, env_step, gradient_step = 0, 0, 0
     if resume_from_log:
         start_epoch, env_step, gradient_step = logger.restore_data()
+    if checkpointer is not None and checkpointer.resumed:
+        start_epoch, env_step, gradient_step = checkpointer.counters()
+    # background evaluations the checkpointed run was still waiting for, run again
+    rerun = checkpointer.pending_evals() if checkpointer is not None and evaluator is not None else []
     last_rew, last_len = 0.0, 0
     stat: Dict[str, MovAvg] = defaultdict(MovAvg)
     start_time = time.time()
     train_collector.reset_stat()
-    test_collector.reset_stat()
-    test_in_train = test_in_train and train_collector.policy == policy
+    if test_collector is not None:
+        test_collector.reset_stat()
+    test_in_train = test_in_train and test_collector is not None \
+        and train_collector.policy == policy
+
+    # test trajectories of every epoch, streamed to the his_*.npy files
+    recorder = EvalRecorder(policy, test_envs, macro_steps(args), max_epoch,
+                            folder=os.path.join(args.logdir, args.task),
+                            resume_epoch=start_epoch if start_epoch else None,
+                            rerun_epochs=[e for e, _, _ in rerun],
+                            buffer_kwargs=dict(ignore_obs_next=True, save_only_last_obs=False,
+                                               stack_num=args.frames_stack))
+
+    # latest test result, handed to report_fn at the end of every epoch
+    last_test = {}
+
+    def record_test(epoch, step, result, traj=None):
+        rew = result["rews"].mean()
+        recorder.add(traj if traj is not None else recorder.trajectory(),
+                     epoch=epoch, env_step=step, n_ep=int(result["n/ep"]), rew=float(rew))
+        last_test.update(epoch=epoch, env_step=step, rew=float(rew))
+        if monitor is not None:
+            monitor.update(epoch, step, result)
+        if result["n/ep"] > 0:
+            logger.log_test_data(result, step)
+        event_log.record('test', step, rew, result["rews"].std(), result["n/ep"])
+        print(f'Mean reward (over {result["n/ep"]} episodes): {rew}')
 
-    acts = []
-    obss = []
-    rews = []
+    if checkpointer is not None and checkpointer.resumed:
+        # the envs of the interrupted run are gone, seed the new ones for the resumed epoch
+        train_collector.env.seed(args.seed + start_epoch)
+        checkpointer.restore_rng()
+        for eval_epoch, eval_step, state_dict in rerun:
+            if monitor is not None:
+                monitor.snapshot(eval_epoch, state_dict)
+            evaluator.resubmit(eval_epoch, eval_step, state_dict)
     for epoch in range(1 + start_epoch, 1 + max_epoch):
+        event_log.flush()
+        event_log.set_epoch(epoch)
         # train
         policy.train()
         train_collector.reset_env()
@@ -141,6 +225,7 @@ def offpolicy_trainer_1(
             while t.n < t.total:
                 if train_fn:
                     train_fn(epoch, env_step)
+                anneal_beta(train_collector.buffer, args, env_step)
                 result = train_collector.collect(n_step=step_per_collect)
                 #print(result)
                 if result["n/ep"] > 0 and reward_metric:
@@ -148,6 +233,8 @@ def offpolicy_trainer_1(
                 env_step += int(result["n/st"])
                 t.update(result["n/st"])
                 logger.log_train_data(result, env_step)
+                event_log.record('train', env_step, result["n/st"], result["n/ep"],
+                                 result["rews"].mean() if result["n/ep"] > 0 else np.nan)
                 last_rew = result['rew'] if 'rew' in result else last_rew
                 #print("last_rew:    ", train_collector.buffer)
                 last_len = result['len'] if 'len' in result else last_len
@@ -160,7 +247,17 @@ def offpolicy_trainer_1(
                 }
 
 
-                for i in range(round(update_per_step * result["n/st"])):
+                n_updates = round(update_per_step * result["n/st"])
+                if updater is not None:
+                    # gradient steps of several env steps at once, logged every few steps
+                    gradient_step, losses = updater.step(
+                        n_updates, train_collector.buffer, gradient_step)
+                    if losses:
+                        for k in losses.keys():
+                            data[k] = f"{losses[k]:.3f}"
+                        t.set_postfix(**data)
+                    continue
+                for i in range(n_updates):
                     gradient_step += 1
                     losses = policy.update(batch_size, train_collector.buffer)
                     for k in losses.keys():
@@ -171,46 +268,66 @@ def offpolicy_trainer_1(
                     t.set_postfix(**data)
             if t.n <= t.total:
                 t.update()
+        if updater is not None:
+            gradient_step, _ = updater.flush(train_collector.buffer, gradient_step)
 
         if save_fn:
             save_fn(policy) 
 
-        # watch for each episode to save data
-        print("Setup test envs ...")
-        policy.eval()
-        policy.set_eps(args.eps_test)
-        test_envs.seed(args.seed)
-
-        print("Testing agent ...")
-        buffer = VectorReplayBuffer(
-            args.step_per_epoch+1, buffer_num=len(test_envs),
-            ignore_obs_next=True, save_only_last_obs=False,
-            stack_num=args.frames_stack)
-        collector = Collector(policy, test_envs, buffer,
-                              exploration_noise=False)
-        result = collector.collect(n_step=args.step_per_epoch)
-        #buffer.save_hdf5(args.save_buffer_name)
-        act = buffer._meta.__dict__['act']
-        obs = buffer._meta.__dict__['obs']
-        rew = buffer._meta.__dict__['rew']
-        acts.append(act)
-        obss.append(obs)
-        rews.append(rew)
-        #print(buffer._meta.__dict__.keys())
-        rew = result["rews"].mean()
-        print(f'Mean reward (over {result["n/ep"]} episodes): {rew}')
-
-    np.save(os.path.join(args.logdir, args.task, 'his_act.npy'), np.array(acts))
-    np.save(os.path.join(args.logdir, args.task, 'his_obs.npy'), np.array(obss))
-    np.save(os.path.join(args.logdir, args.task, 'his_rew.npy'), np.array(obss))
+        if evaluator is not None:
+            # the test episode runs in the evaluation process while the next epoch trains
+            if monitor is not None:
+                # the best weights are saved when the result comes back
+                monitor.snapshot(epoch, policy)
+            evaluator.submit(epoch, env_step, policy)
+            for eval_epoch, eval_step, result, traj in evaluator.poll():
+                record_test(eval_epoch, eval_step, result, traj)
+        else:
+            # watch for each episode to save data
+            print("Setup test envs ...")
+            policy.eval()
+            policy.set_eps(args.eps_test)
+            test_envs.seed(args.seed)
+
+            print("Testing agent ...")
+            result = recorder.collect()
+            record_test(epoch, env_step, result)
+
+        if checkpointer is not None:
+            # with the pending evaluations, their rows are not lost on a resume
+            checkpointer.save(epoch, env_step, gradient_step,
+                              evaluator.pending_evals() if evaluator is not None else ())
+        if report_fn is not None and last_test:
+            report_fn(epoch, env_step, gradient_step, dict(last_test))
+        if monitor is not None and monitor.stopped:
+            break
+
+    if evaluator is not None:
+        for eval_epoch, eval_step, result, traj in evaluator.drain():
+            record_test(eval_epoch, eval_step, result, traj)
+
+    if monitor is not None:
+        monitor.finish(env_step)
+
+    recorder.save(os.path.join(args.logdir, args.task))
 
     return 1
 
-def test_dqn(args):
+def test_dqn(args, report_fn=None):
+    # agent steps of one episode of step_per_epoch intervals, action_repeat intervals per step
+    episode_steps = macro_steps(args)
     tim_env = 0.0
     tim_ctl = 0.0
     tim_learn = 0.0
     
+    if args.apex_actors > 0 and not args.test_only and (args.checkpoint or args.resume):
+        # apex_trainer neither saves nor restores a Checkpointer
+        raise ValueError("--checkpoint and --resume do not work with --apex-actors")
+    if args.event_log:
+        # per-worker binary event records instead of prints on every step
+        event_log.configure(args.event_log)
+    if args.torch_threads > 0:
+        torch.set_num_threads(args.torch_threads)
     env = make_building_env(args)
 
     args.state_shape = env.observation_space.shape or env.observation_space.n
@@ -219,36 +336,74 @@ def test_dqn(args):
     print("Observations shape:", args.state_shape)
     print("Actions shape:", args.action_shape)
 
+    if args.surrogate_fit:
+        surrogate.fit_from_files(os.path.join(args.logdir, args.task), env.observation_space, env.action_space,
+                                 episode_steps, args.surrogate, buffer_num=args.test_num,
+                                 epochs=args.surrogate_epochs, device=args.device)
+        return
+    # hand the probe env back to the pool so repeated tuning runs in this process reuse it
+    env.close()
+
     # make environments
-    train_envs = SubprocVectorEnv([lambda: make_building_env(args)
-                                   for _ in range(args.training_num)])
-    test_envs = SubprocVectorEnv([lambda: make_building_env(args)
-                                  for _ in range(args.test_num)])
+    train_envs = make_vector_env(lambda **zone: make_building_env(args, **zone), args.training_num, args,
+                                 env.observation_space, wait_num=args.wait_num)
+    def make_test_envs():
+        return make_vector_env(lambda **zone: make_building_env(args, eval_cache=True, **zone), args.test_num, args,
+                               env.observation_space)
+    # with --async-eval the test episodes run in the evaluation process and its own test envs
+    async_eval = uses_async_eval(args)
+    test_envs = None if async_eval else make_test_envs()
     # seed
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     train_envs.seed(args.seed)
-    test_envs.seed(args.seed)
+    if test_envs is not None:
+        test_envs.seed(args.seed)
 
     # define model
     print(args.state_shape)
-    net = Net(args.state_shape, args.action_shape, args.n_hidden_layers, args.device).to(args.device)
-    optim = torch.optim.Adam(net.parameters(), lr=args.lr)
-    
+    def make_policy():
+        net = Net(args.state_shape, args.action_shape, args.n_hidden_layers, args.device).to(args.device)
+        optim = torch.optim.Adam(net.parameters(), lr=args.lr)
+        return DQNPolicy(net, optim, args.gamma, args.n_step,
+                         target_update_freq=args.target_update_freq, reward_normalization = False, is_double=True)
+
     # define policy
-    policy = DQNPolicy(net, optim, args.gamma, args.n_step,
-                       target_update_freq=args.target_update_freq, reward_normalization = False, is_double=True)
+    if args.multi_weight_energy:
+        if args.apex_actors > 0 or args.fused_updates > 1:
+            raise ValueError("--multi-weight-energy runs with the plain trainer, "
+                             "without --apex-actors and --fused-updates")
+        # one head per weight_energy value, all trained from the same collected transitions
+        policy = make_multi_weight_policy(make_policy, args)
+    else:
+        policy = make_policy()
+
+    if args.surrogate_check:
+        policy.load_state_dict(torch.load(args.resume_path, map_location=args.device))
+        policy.eval()
+        policy.set_eps(args.eps_test)
+        report = surrogate.fidelity_check(policy, make_building_env(surrogate.fmu_args(args)),
+                                          make_building_env(args), episode_steps)
+        with open(os.path.join(os.path.join(args.logdir, args.task), 'surrogate_check.json'), 'w') as fp:
+            json.dump(report, fp)
+        train_envs.close()
+        if test_envs is not None:
+            test_envs.close()
+        return
+
     # load a previous policy
-    buffer = VectorReplayBuffer(
-        args.buffer_size, buffer_num=len(train_envs), ignore_obs_next=True)
+    buffer = make_replay_buffer(args, len(train_envs), ignore_obs_next=True,
+                                observation_space=env.observation_space, action_space=env.action_space)
 
     # collector
-    train_collector = Collector(policy, train_envs, buffer, exploration_noise=False)
+    train_collector_cls = AsyncCollector if train_envs.is_async else Collector
+    train_collector = train_collector_cls(policy, train_envs, buffer, exploration_noise=False)
 
-    buffer_test = VectorReplayBuffer(
-        args.step_per_epoch+100, buffer_num=len(test_envs), ignore_obs_next=True)
-    
-    test_collector = Collector(policy, test_envs, buffer_test, exploration_noise=False)
+    test_collector = None
+    if test_envs is not None:
+        buffer_test = VectorReplayBuffer(
+            episode_steps+100, buffer_num=len(test_envs), ignore_obs_next=True)
+        test_collector = Collector(policy, test_envs, buffer_test, exploration_noise=False)
 
     # log
     log_path = os.path.join(args.logdir, args.task)
@@ -261,7 +416,7 @@ def test_dqn(args):
 
     def train_fn(epoch, env_step):
         # nature DQN setting, linear decay in the first 1M steps
-        max_eps_steps = int(args.epoch * args.step_per_epoch * 0.9)
+        max_eps_steps = int(args.epoch * episode_steps * 0.9)
 
         #print("observe eps:  max_eps_steps, total_epoch_pass ", max_eps_steps, total_epoch_pass)
         if env_step <= max_eps_steps:
@@ -269,8 +424,10 @@ def test_dqn(args):
         else:
             eps = args.eps_train_final
         policy.set_eps(eps)
-        print('train/eps', env_step, eps)
-        print("=========================")
+        if args.multi_weight_energy:
+            # the heads take turns in collecting, one epoch each
+            policy.collecting = (epoch - 1) % len(policy.heads)
+        event_log.record('eps', env_step, eps)
         #logger.write('train/eps', env_step, eps)
 
     def test_fn(epoch, env_step):
@@ -285,32 +442,75 @@ def test_dqn(args):
 
         print("Testing agent ...")
         buffer = VectorReplayBuffer(
-                args.step_per_epoch+1, buffer_num=len(test_envs),
+                episode_steps+1, buffer_num=len(test_envs),
                 ignore_obs_next=True, save_only_last_obs=False,
                 stack_num=args.frames_stack)
         collector = Collector(policy, test_envs, buffer, exploration_noise=False)
-        result = collector.collect(n_step=args.step_per_epoch)
+        result = collector.collect(n_step=episode_steps)
         #buffer.save_hdf5(args.save_buffer_name)
         
-        np.save(os.path.join(args.logdir, args.task,'his_act.npy'), buffer._meta.__dict__['act'])
-        np.save(os.path.join(args.logdir, args.task,'his_obs.npy'), buffer._meta.__dict__['obs'])
-        np.save(os.path.join(args.logdir, args.task,'his_rew.npy'), buffer._meta.__dict__['rew'])
+        # his_*.npy and his_meta.jsonl are the per-epoch record of the trainer
+        np.save(os.path.join(args.logdir, args.task,'his_act_final.npy'), buffer._meta.__dict__['act'])
+        np.save(os.path.join(args.logdir, args.task,'his_obs_final.npy'), buffer._meta.__dict__['obs'])
+        np.save(os.path.join(args.logdir, args.task,'his_rew_final.npy'), buffer._meta.__dict__['rew'])
         #print(buffer._meta.__dict__.keys())
         rew = result["rews"].mean()
         print(f'Mean reward (over {result["n/ep"]} episodes): {rew}')
     
 
-    if not args.test_only:
-        # test train_collector and start filling replay buffer
-        train_collector.collect(n_step=args.batch_size * args.training_num)
+    if not args.test_only and args.apex_actors > 0:
+        # collector processes feed a central buffer, the learner never waits for the FMU
+        result = apex_trainer(args, test_envs, policy,
+                              lambda i: make_building_env(args, **zone_configs(args, args.apex_actors)[i]),
+                              args.epoch, episode_steps, args.batch_size, args.apex_actors,
+                              os.path.join(args.logdir, args.task),
+                              update_per_step=args.update_per_step, sync_every=args.apex_sync,
+                              eps=args.apex_eps,
+                              test_buffer_kwargs=dict(ignore_obs_next=True, save_only_last_obs=False,
+                                                      stack_num=args.frames_stack),
+                              save_fn=save_fn, logger=logger,
+                              buffer_kwargs=dict(observation_space=env.observation_space,
+                                                 action_space=env.action_space),
+                              monitor=make_monitor(policy, log_path, args))
+    elif not args.test_only:
+        checkpointer = None
+        if args.checkpoint or args.resume:
+            checkpointer = Checkpointer(os.path.join(args.logdir, args.task, 'checkpoint'), policy, train_collector.buffer)
+            if args.resume and checkpointer.load():
+                # a PBT member keeps its own, perturbed learning rate
+                for head in getattr(policy, 'heads', [policy]):
+                    for g in head.optim.param_groups:
+                        g['lr'] = args.lr
+        if checkpointer is None or not checkpointer.resumed:
+            # test train_collector and start filling replay buffer
+            train_collector.collect(n_step=args.batch_size * args.training_num)
         # trainer
+        evaluator = None
+        if async_eval:
+            # test episodes run in a background process with its own test envs
+            evaluator = AsyncEvaluator(
+                policy, make_test_envs, episode_steps, args.seed, eps=args.eps_test,
+                buffer_kwargs=dict(ignore_obs_next=True, save_only_last_obs=False,
+                                   stack_num=args.frames_stack))
+        updater = None
+        if args.fused_updates > 1:
+            updater = FusedUpdater(policy, args.batch_size, args.fused_updates,
+                                   args.update_log_interval, logger)
         result = offpolicy_trainer_1(args=args, test_envs=test_envs,
                                      policy=policy, train_collector=train_collector, test_collector=test_collector, max_epoch=args.epoch,
-                                     step_per_epoch=args.step_per_epoch, step_per_collect=args.step_per_collect, episode_per_test=args.test_num,
+                                     step_per_epoch=episode_steps, step_per_collect=args.step_per_collect, episode_per_test=args.test_num,
                                      batch_size=args.batch_size, train_fn=train_fn, test_fn=test_fn,
                                      #stop_fn=stop_fn,
                                      save_fn=save_fn, logger=logger,
-                                     update_per_step=args.update_per_step, test_in_train=False)
+                                     update_per_step=args.update_per_step, test_in_train=False, evaluator=evaluator,
+                                     updater=updater, checkpointer=checkpointer,
+                                     monitor=make_monitor(policy, log_path, args), report_fn=report_fn)
+        if evaluator is not None:
+            evaluator.close()
+        if args.multi_weight_energy:
+            if test_envs is None:
+                test_envs = make_test_envs()
+            evaluate_heads(policy, test_envs, episode_steps, args.seed, args.eps_test, log_path)
 
         # watch()
     
@@ -319,19 +519,16 @@ def test_dqn(args):
         print("Loaded agent from: ", os.path.join(log_path, 'policy.pth'))
         watch()
 
+    # the workers exit cleanly and flush their event logs
+    train_envs.close()
+    if test_envs is not None:
+        test_envs.close()
+
 # added hyperparameter tuning scripting using Ray.tune
-def trainable_function(config, reporter):
-    while True:
-        args.epoch = config['epoch']
-        args.weight_energy = config['weight_energy']
-        args.lr=  config['lr']
-        args.batch_size = config['batch_size']
-        args.n_hidden_layer = config['n_hidden_layer']
-        args.buffer_size = config['buffer_size']
-        test_dqn(args)
-
-        # a fake traing score to stop current simulation based on searched parameters
-        reporter(timesteps_total=args.step_per_epoch)
+def trainable_function(config, checkpoint_dir=None, base_args=None):
+    """One Tune trial: train with ``config`` and report the test reward every epoch."""
+    tuning.run_trial(tuning.trial_args(base_args, config), test_dqn, checkpoint_dir,
+                     os.path.join(base_args.task, 'checkpoint'))
 
 if __name__ == '__main__':
     import ray 
@@ -370,6 +567,108 @@ if __name__ == '__main__':
     parser.add_argument('--watch', default=False, action='store_true',
                         help='watch the play of pre-trained policy only')
     parser.add_argument('--test-only', type=bool, default=False)
+    parser.add_argument('--fmu-pool', type=int, default=True,
+                        help='reuse one initialized FMU per worker and restore its snapshot on reset')
+    parser.add_argument('--vector-env', type=str, default='subproc', choices=['subproc', 'fmu', 'multizone', 'service'],
+                        help="'fmu' returns obs/rew/done of the workers through shared memory, "
+                             "'multizone' hosts --envs-per-proc building models per worker process, "
+                             "'service' runs them in the simulation service shared by all runs on the node")
+    parser.add_argument('--envs-per-proc', type=int, default=4)
+    parser.add_argument('--zone-weather-files', type=str, nargs='*', default=None,
+                        help='weather files of the vector env members, cycled over the envs')
+    parser.add_argument('--zone-start-days', type=int, nargs='*', default=None)
+    parser.add_argument('--zone-mass-flow', type=float, nargs='*', default=None)
+    parser.add_argument('--wait-num', type=int, default=None,
+                        help='collect with the first wait-num ready training envs (async)')
+    parser.add_argument('--env-timeout', type=float, default=None)
+    parser.add_argument('--sim-address', type=str, default='/dev/shm/drl_hpc_sim.sock',
+                        help='unix socket of the simulation service of --vector-env service')
+    parser.add_argument('--sim-workers', type=int, default=32,
+                        help='worker processes of the simulation service, if this run starts it')
+    parser.add_argument('--sim-batch', type=int, default=8,
+                        help='env requests the simulation service hands to a worker at once')
+    parser.add_argument('--weather-cache', type=int, default=False,
+                        help='read weather forecasts from a pre-compiled, memory-mapped EPW cache')
+    parser.add_argument('--surrogate', type=str, default=None,
+                        help='path of a fitted surrogate model; train on it instead of the FMU')
+    parser.add_argument('--surrogate-fit', default=False, action='store_true',
+                        help='fit the --surrogate model on the recorded his_*.npy and exit')
+    parser.add_argument('--surrogate-check', default=False, action='store_true',
+                        help='run the --resume-path policy on the surrogate and the FMU, report the divergence and exit')
+    parser.add_argument('--surrogate-epochs', type=int, default=200)
+    parser.add_argument('--start-days', type=int, nargs='*', default=None,
+                        help='days of year to start episodes at, drawn at random on every reset')
+    parser.add_argument('--state-cache', type=str, default=None,
+                        help='directory of cached post-initialization FMU states')
+    parser.add_argument('--eval-cache-mb', type=float, default=0.,
+                        help='memory of the rollout cache of every test env in MB, 0 to disable')
+    parser.add_argument('--action-repeat', type=int, default=1,
+                        help='co-simulation intervals per env step, the action is held over all of them')
+    parser.add_argument('--async-eval', type=int, default=False,
+                        help='run the end-of-epoch test episode in a background process')
+    parser.add_argument('--fused-updates', type=int, default=0,
+                        help='run the gradient steps of this many env steps in one batch, 0 to update every step')
+    parser.add_argument('--update-log-interval', type=int, default=100,
+                        help='gradient steps between loss logs with --fused-updates')
+    parser.add_argument('--apex-actors', type=int, default=0,
+                        help='train with this many collector processes and a central learner, 0 to use the trainer')
+    parser.add_argument('--apex-sync', type=int, default=100,
+                        help='gradient steps between two weight broadcasts to the collectors')
+    parser.add_argument('--apex-eps', type=float, default=0.4,
+                        help='base exploration rate, spread over the collectors as in Ape-X')
+    parser.add_argument('--checkpoint', type=int, default=False,
+                        help='checkpoint the whole run (buffer, optimizers, RNG) after every epoch')
+    parser.add_argument('--resume', type=int, default=False,
+                        help='continue from the last checkpoint of the run, if there is one')
+    parser.add_argument('--prioritized-replay', type=int, default=False,
+                        help='sample the training buffer by TD error instead of uniformly')
+    parser.add_argument('--prio-alpha', type=float, default=0.6,
+                        help='priority exponent of the prioritized replay')
+    parser.add_argument('--prio-beta', type=float, default=0.4,
+                        help='initial importance sampling exponent, annealed to 1 over the run')
+    parser.add_argument('--compact-replay', type=str, default=None,
+                        help="store the training buffer with 'uint16' (scaled to the observation bounds) "
+                             "or 'float16' observations and uint8 actions")
+    parser.add_argument('--device-replay', type=str, default=None,
+                        help="'mirror' keeps the buffer observations as tensors on --device, "
+                             "'pinned' in pinned host memory with async copies")
+    parser.add_argument('--stop-window', type=int, default=10,
+                        help='evaluations in the moving average of the convergence tests')
+    parser.add_argument('--stop-patience', type=int, default=0,
+                        help='stop after this many evaluations without improvement, 0 to disable')
+    parser.add_argument('--stop-min-delta', type=float, default=0.,
+                        help='smallest improvement of the moving average that resets the patience')
+    parser.add_argument('--stop-ci', type=float, default=0.,
+                        help='stop when the last window is not better than the one before at this z value, 0 to disable')
+    parser.add_argument('--stop-target', type=float, default=None,
+                        help='stop once the mean test reward reaches this value')
+    parser.add_argument('--stop-min-epochs', type=int, default=0,
+                        help='no plateau or confidence interval stop before this epoch')
+    parser.add_argument('--tune-scheduler', type=str, default='asha',
+                        help="early termination of poor trials: 'asha', 'median' or 'none'")
+    parser.add_argument('--tune-grace-period', type=int, default=5,
+                        help='epochs every trial runs before it can be stopped')
+    parser.add_argument('--tune-checkpoint-freq', type=int, default=0,
+                        help='epochs between two Tune checkpoints of a trial, 0 for the last epoch only, '
+                             '-1 to disable; PBT uses --pbt-interval')
+    parser.add_argument('--torch-threads', type=int, default=0,
+                        help='intra-op threads of the learner, 0 for the torch default (2 in tuning trials)')
+    parser.add_argument('--tune-cpus', type=int, default=72,
+                        help='CPUs of the node that Ray may hand to the trials')
+    parser.add_argument('--tune-calibrate', type=int, default=96,
+                        help='steps of the calibration run that measures a trial, 0 to estimate from the args')
+    parser.add_argument('--tune-dir', type=str, default='/mnt/shared',
+                        help='directory of the Tune trials and their checkpoints, /dev/shm keeps them in memory')
+    parser.add_argument('--pbt-population', type=int, default=0,
+                        help='train a population of this size with population based training instead of the grid')
+    parser.add_argument('--pbt-interval', type=int, default=5,
+                        help='epochs between two exploit/explore steps of the population')
+    parser.add_argument('--multi-weight-energy', type=float, nargs='*', default=None,
+                        help='also train a DQN head for each of these weight_energy values from the same rollouts')
+    parser.add_argument('--log-level', type=int, default=7,
+                        help='log level of the building env')
+    parser.add_argument('--event-log', type=str, default=None,
+                        help='directory of the binary event records, read them with python -m drl_hpc.event_log')
 
     # tunable parameters
     parser.add_argument('--weight-energy', type=float, default= 100.)   
@@ -382,23 +681,40 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    # Define Ray tuning experiments
-    tune.register_trainable("ddqn", trainable_function)
-    ray.init(num_cpus=72)
-
-    # Run tuning
-    tune.run_experiments({
-            'ddqn_tuning':{
-                "run": "ddqn",
-                "stop": {"timesteps_total":args.step_per_epoch},
-                "config":{
-                    "epoch": tune.grid_search([200]),
-                    "weight_energy": tune.grid_search([0.1, 1, 10., 100., 1000., 10000.]),
-                    "lr": tune.grid_search([1e-04, 3e-04, 1e-03]),
-                    "batch_size": tune.grid_search([32, 64, 128]),
-                    "n_hidden_layer": tune.grid_search([3, 4]),
-                    "buffer_size":tune.grid_search([20000, 50000, 100000])
-                    },
-                "local_dir":"/mnt/shared",
+    if args.pbt_population > 0:
+        # one population that copies its best members instead of a grid of full runs
+        tuning.run_pbt(args, trainable_function, test_dqn, 'ddqn_pbt',
+                       {'lr': (1e-5, 1e-2), 'weight_energy': (0.1, 1e4), 'weight_temp': (0.1, 1e3)})
+    else:
+        # real footprint of one trial: env processes, learner threads and FMU memory
+        trial_resources = tuning.trial_resources(args, test_dqn)
+
+        # Define Ray tuning experiments
+        ray.init(num_cpus=args.tune_cpus)
+        config = {
+            "epoch": tune.grid_search([200]),
+            "weight_energy": tune.grid_search([0.1, 1, 10., 100., 1000., 10000.]),
+            "lr": tune.grid_search([1e-04, 3e-04, 1e-03]),
+            "batch_size": tune.grid_search([32, 64, 128]),
+            "n_hidden_layers": tune.grid_search([3, 4]),
+            "buffer_size":tune.grid_search([20000, 50000, 100000])
             }
-    })
+        if args.multi_weight_energy:
+            # every trial trains all weight_energy values at once
+            del config["weight_energy"]
+        # poor configurations are stopped after a few epochs instead of a full run
+        scheduler = None
+        if args.tune_scheduler == 'asha':
+            from ray.tune.schedulers import ASHAScheduler
+            scheduler = ASHAScheduler(time_attr='epoch', max_t=max(config['epoch']['grid_search']),
+                                      grace_period=args.tune_grace_period, reduction_factor=3)
+        elif args.tune_scheduler == 'median':
+            from ray.tune.schedulers import MedianStoppingRule
+            scheduler = MedianStoppingRule(time_attr='epoch', grace_period=args.tune_grace_period,
+                                           min_samples_required=3)
+
+        # Run tuning
+        tune.run(tune.with_parameters(trainable_function, base_args=args),
+                 name='ddqn_tuning', config=config, scheduler=scheduler,
+                 metric='test_reward', mode='max', resources_per_trial=trial_resources,
+                 local_dir=args.tune_dir, resume=bool(args.resume))
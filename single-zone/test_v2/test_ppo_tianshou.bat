@@ -5,7 +5,8 @@ docker run^
 	  -v /tmp/.X11-unix:/tmp/.X11-unix^
 	  --rm^
 	  -v %CD%:/mnt/shared^
+	  -v %CD%\..\..\drl_hpc:/mnt/drl_hpc/drl_hpc^
 	  -i^
       -t^
-	  mpcdrl /bin/bash -c "cd /mnt/shared && python /mnt/shared/test_ppo_tianshou.py"
+	  mpcdrl /bin/bash -c "export PYTHONPATH=/mnt/drl_hpc:$PYTHONPATH && cd /mnt/shared && python /mnt/shared/test_ppo_tianshou.py"
 
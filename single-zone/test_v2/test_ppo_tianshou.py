@@ -1,5 +1,17 @@
 import os
 import gym_singlezone_jmodelica
+from drl_hpc import fmu_pool
+from drl_hpc.vector_env import make_vector_env
+from drl_hpc.state_cache import StartStateCache
+from drl_hpc.env_wrappers import ActionRepeatWrapper, macro_steps
+from drl_hpc import event_log
+from drl_hpc.async_eval import AsyncEvaluator, uses_async_eval
+from drl_hpc.eval_recorder import EvalRecorder
+from drl_hpc.checkpoint import Checkpointer
+from drl_hpc.convergence import ConvergenceMonitor, make_monitor
+from drl_hpc import weather_cache
+from drl_hpc.reward import RewardEngine
+from drl_hpc import surrogate
 import gym
 import torch
 import pprint
@@ -19,7 +31,7 @@ from tianshou.env import SubprocVectorEnv
 from tianshou.utils.net.common import Net
 from tianshou.trainer import onpolicy_trainer
 from tianshou.utils.net.continuous import ActorProb, Critic
-from tianshou.data import Collector, ReplayBuffer, VectorReplayBuffer
+from tianshou.data import AsyncCollector, Collector, ReplayBuffer, VectorReplayBuffer
 
 
 def get_args(folder):
@@ -66,46 +78,117 @@ def get_args(folder):
     parser.add_argument('--watch', default=False, action='store_true',
                         help='watch the play of pre-trained policy only')
     parser.add_argument('--save-buffer-name', type=str, default=folder)
+    parser.add_argument('--fmu-pool', type=int, default=True,
+                        help='reuse one initialized FMU per worker and restore its snapshot on reset')
+    parser.add_argument('--vector-env', type=str, default='subproc', choices=['subproc', 'fmu', 'multizone'],
+                        help="'fmu' returns obs/rew/done of the workers through shared memory, "
+                             "'multizone' hosts --envs-per-proc building models per worker process")
+    parser.add_argument('--envs-per-proc', type=int, default=4)
+    parser.add_argument('--zone-weather-files', type=str, nargs='*', default=None,
+                        help='weather files of the vector env members, cycled over the envs')
+    parser.add_argument('--zone-start-days', type=int, nargs='*', default=None)
+    parser.add_argument('--zone-mass-flow', type=float, nargs='*', default=None)
+    parser.add_argument('--wait-num', type=int, default=None,
+                        help='collect with the first wait-num ready training envs (async)')
+    parser.add_argument('--env-timeout', type=float, default=None)
+    parser.add_argument('--weather-cache', type=int, default=False,
+                        help='read weather forecasts from a pre-compiled, memory-mapped EPW cache')
+    parser.add_argument('--weight-energy', type=float, default=5e4)
+    parser.add_argument('--weight-temp', type=float, default=500.)
+    parser.add_argument('--surrogate', type=str, default=None,
+                        help='path of a fitted surrogate model; train on it instead of the FMU')
+    parser.add_argument('--surrogate-fit', default=False, action='store_true',
+                        help='fit the --surrogate model on the recorded his_*.npy and exit')
+    parser.add_argument('--surrogate-check', default=False, action='store_true',
+                        help='run the --resume-path policy on the surrogate and the FMU, report the divergence and exit')
+    parser.add_argument('--surrogate-epochs', type=int, default=200)
+    parser.add_argument('--start-days', type=int, nargs='*', default=None,
+                        help='days of year to start episodes at, drawn at random on every reset')
+    parser.add_argument('--state-cache', type=str, default=None,
+                        help='directory of cached post-initialization FMU states')
+    parser.add_argument('--action-repeat', type=int, default=1,
+                        help='co-simulation intervals per env step, the action is held over all of them')
+    parser.add_argument('--async-eval', type=int, default=False,
+                        help='run the end-of-epoch test episode in a background process')
+    parser.add_argument('--checkpoint', type=int, default=False,
+                        help='checkpoint the whole run (buffer, optimizers, RNG) after every epoch')
+    parser.add_argument('--resume', type=int, default=False,
+                        help='continue from the last checkpoint of the run, if there is one')
+    parser.add_argument('--stop-window', type=int, default=10,
+                        help='evaluations in the moving average of the convergence tests')
+    parser.add_argument('--stop-patience', type=int, default=0,
+                        help='stop after this many evaluations without improvement, 0 to disable')
+    parser.add_argument('--stop-min-delta', type=float, default=0.,
+                        help='smallest improvement of the moving average that resets the patience')
+    parser.add_argument('--stop-ci', type=float, default=0.,
+                        help='stop when the last window is not better than the one before at this z value, 0 to disable')
+    parser.add_argument('--stop-target', type=float, default=None,
+                        help='stop once the mean test reward reaches this value')
+    parser.add_argument('--stop-min-epochs', type=int, default=0,
+                        help='no plateau or confidence interval stop before this epoch')
+    parser.add_argument('--log-level', type=int, default=0,
+                        help='log level of the building env')
+    parser.add_argument('--event-log', type=str, default=None,
+                        help='directory of the binary event records, read them with python -m drl_hpc.event_log')
     return parser.parse_args()
 
-def make_building_env(args):
-    weather_file_path = "./USA_CA_Riverside.Muni.AP.722869_TMY3.epw"
-    mass_flow_nor = [0.75]
+def make_building_env(args, weather_file=None, start_day=None, mass_flow_nor=None):
+    if surrogate.use_surrogate(args):
+        return surrogate.SurrogateBuildingEnv.load(args.surrogate, args)
+    fmu_file = "./SingleZoneVAV.fmu"
+    weather_file_path = weather_file or "./USA_CA_Riverside.Muni.AP.722869_TMY3.epw"
+    mass_flow_nor = [mass_flow_nor if mass_flow_nor is not None else 0.75]
     npre_step = 3
     simulation_start_time = 212*24*3600.0
+    start_days = [start_day] if start_day is not None else args.start_days
+    if start_days:
+        simulation_start_time = start_days[0]*24*3600.0
+    start_times = [d*24*3600.0 for d in start_days] if start_days else [simulation_start_time]
     simulation_end_time = simulation_start_time + args.step_per_epoch*args.time_step
-    log_level = 0
+    log_level = args.log_level
     alpha = 1
-
-    def rw_func(cost, penalty):
-        if ( not hasattr(rw_func,'x')  ):
-            rw_func.x = 0
-            rw_func.y = 0
-
-        cost = cost[0]
-        penalty = penalty[0]
-
-        if rw_func.x > cost:
-            rw_func.x = cost
-        if rw_func.y > penalty:
-            rw_func.y = penalty
-
-        #print("rw_func-cost-min=", rw_func.x, ". penalty-min=", rw_func.y)
-
-        res = penalty * 500.0 + cost*5e4
-        
-        return res
-
-    env = gym.make(args.task,
-                   mass_flow_nor = mass_flow_nor,
-                   weather_file = weather_file_path,
-                   npre_step = npre_step,
-                   simulation_start_time = simulation_start_time,
-                   simulation_end_time = simulation_end_time,
-                   time_step = args.time_step,
-                   log_level = log_level,
-                   alpha = alpha,
-                   rf = rw_func)
+    weight_energy = args.weight_energy #5.e4
+    weight_temp = args.weight_temp #500.
+
+    # reward = weight_temp * penalty + weight_energy * cost, min/max kept in rw_func.stats()
+    rw_func = RewardEngine(weight_energy, weight_temp)
+
+    env_kwargs = dict(mass_flow_nor = mass_flow_nor,
+                      weather_file = weather_file_path,
+                      npre_step = npre_step,
+                      simulation_start_time = simulation_start_time,
+                      simulation_end_time = simulation_end_time,
+                      time_step = args.time_step,
+                      log_level = log_level,
+                      alpha = alpha)
+
+    def make_env():
+        if args.weather_cache:
+            # forecasts become slices of the memory-mapped weather array shared by all workers
+            env = weather_cache.make_env(args.task, weather_file_path, args.time_step,
+                                         rf = rw_func, **env_kwargs)
+        else:
+            env = gym.make(args.task, rf = rw_func, **env_kwargs)
+        if args.action_repeat > 1:
+            # one step of the wrapper simulates action_repeat intervals inside the worker
+            env = ActionRepeatWrapper(env, args.action_repeat, rw_func)
+        return env
+
+    # rw_func depends on the reward weights, so they are part of the pool key
+    pool_kwargs = dict(env_kwargs, weight_energy = weight_energy, weight_temp = weight_temp,
+                       action_repeat = args.action_repeat)
+    if not args.fmu_pool:
+        env = make_env()
+    else:
+        # one initialized FMU per worker, resets restore the snapshot of their start day in place
+        snapshot_kwargs = dict(start_times = start_times,
+                               episode_length = args.step_per_epoch*args.time_step)
+        if args.state_cache:
+            snapshot_kwargs['store'] = StartStateCache(args.state_cache, fmu_file, weather_file_path,
+                                                       mass_flow_nor, args.time_step,
+                                                       snapshot_kwargs['episode_length'],
+                                                       npre_step, args.task)
+        env = fmu_pool.pooled_env(args.task, pool_kwargs, make_env, **snapshot_kwargs)
     return env
 
 import time
@@ -144,6 +227,9 @@ def onpolicy_trainer1(
     logger: BaseLogger = LazyLogger(),
     verbose: bool = True,
     test_in_train: bool = True,
+    evaluator: Optional[AsyncEvaluator] = None,
+    checkpointer: Optional[Checkpointer] = None,
+    monitor: Optional[ConvergenceMonitor] = None,
 ) -> Dict[str, Union[float, str]]:
     """A wrapper for on-policy trainer procedure.
     The "step" in trainer means an environment step (a.k.a. transition).
@@ -199,23 +285,55 @@ def onpolicy_trainer1(
     start_epoch, env_step, gradient_step = 0, 0, 0
     if resume_from_log:
         start_epoch, env_step, gradient_step = logger.restore_data()
+    if checkpointer is not None and checkpointer.resumed:
+        start_epoch, env_step, gradient_step = checkpointer.counters()
+    # background evaluations the checkpointed run was still waiting for, run again
+    rerun = checkpointer.pending_evals() if checkpointer is not None and evaluator is not None else []
     last_rew, last_len = 0.0, 0
     stat: Dict[str, MovAvg] = defaultdict(MovAvg)
     start_time = time.time()
     train_collector.reset_stat()
-    test_collector.reset_stat()
-    test_in_train = test_in_train and train_collector.policy == policy
-    test_result = test_episode(
-        policy, test_collector, test_fn, start_epoch, episode_per_test, logger,
-        env_step, reward_metric
-    )
+    if test_collector is not None:
+        test_collector.reset_stat()
+    test_in_train = test_in_train and test_collector is not None \
+        and train_collector.policy == policy
     best_epoch = start_epoch
-    best_reward, best_reward_std = test_result["rew"], test_result["rew_std"]
+    if test_collector is not None:
+        test_result = test_episode(
+            policy, test_collector, test_fn, start_epoch, episode_per_test, logger,
+            env_step, reward_metric
+        )
+        best_reward, best_reward_std = test_result["rew"], test_result["rew_std"]
+
+    # test trajectories of every epoch, streamed to the his_*.npy files
+    recorder = EvalRecorder(policy, test_envs, macro_steps(args), max_epoch,
+                            folder=args.save_buffer_name,
+                            resume_epoch=start_epoch if start_epoch else None,
+                            rerun_epochs=[e for e, _, _ in rerun])
+
+    def record_test(epoch, step, result, traj=None):
+        rew = result["rews"].mean()
+        recorder.add(traj if traj is not None else recorder.trajectory(),
+                     epoch=epoch, env_step=step, n_ep=int(result["n/ep"]), rew=float(rew))
+        if monitor is not None:
+            monitor.update(epoch, step, result)
+        if result["n/ep"] > 0:
+            logger.log_test_data(result, step)
+        event_log.record('test', step, rew, result["rews"].std(), result["n/ep"])
+        print(f'Mean reward (over {result["n/ep"]} episodes): {rew}')
 
-    acts=[]
-    obss=[]
-    rews=[]
+    if checkpointer is not None and checkpointer.resumed:
+        # the envs of the interrupted run are gone, seed the new ones for the resumed epoch
+        train_collector.env.seed(args.seed + start_epoch)
+        train_collector.reset_env()
+        checkpointer.restore_rng()
+        for eval_epoch, eval_step, state_dict in rerun:
+            if monitor is not None:
+                monitor.snapshot(eval_epoch, state_dict)
+            evaluator.resubmit(eval_epoch, eval_step, state_dict)
     for epoch in range(1 + start_epoch, 1 + max_epoch):
+        event_log.flush()
+        event_log.set_epoch(epoch)
         # train
         policy.train()
         with tqdm.tqdm(
@@ -232,6 +350,8 @@ def onpolicy_trainer1(
                 env_step += int(result["n/st"])
                 t.update(result["n/st"])
                 logger.log_train_data(result, env_step)
+                event_log.record('train', env_step, result["n/st"], result["n/ep"],
+                                 result["rews"].mean() if result["n/ep"] > 0 else np.nan)
                 last_rew = result['rew'] if 'rew' in result else last_rew
                 last_len = result['len'] if 'len' in result else last_len
                 data = {
@@ -283,54 +403,62 @@ def onpolicy_trainer1(
         if save_fn:
             save_fn(policy) 
 
-        # watch for each episode to save data
-        print("Setup test envs ...")
-        policy.eval()
-        #policy.set_eps(args.eps_test)
-        test_envs.seed(args.seed)
-
-        print("Testing agent ...")
-        buffer = VectorReplayBuffer(args.step_per_epoch+1, len(test_envs))
-
-        collector = Collector(policy, test_envs, buffer, exploration_noise=False)
-        result = collector.collect(n_step=args.step_per_epoch)
-
-        #buffer.save_hdf5(args.save_buffer_name)
-        act=buffer._meta.__dict__['act']
-        obs=buffer._meta.__dict__['obs']
-        rew=buffer._meta.__dict__['rew']
-        acts.append(act)
-        obss.append(obs)
-        rews.append(rew)
-        #print(buffer._meta.__dict__.keys())
-        rew = result["rews"].mean()
-        print(f'Mean reward (over {result["n/ep"]} episodes): {rew}')
-
-    np.save(args.save_buffer_name+'/his_act.npy', np.array(acts))
-    np.save(args.save_buffer_name+'/his_obs.npy', np.array(obss))
-    np.save(args.save_buffer_name+'/his_rew.npy', np.array(rews))
+        if evaluator is not None:
+            # the test episode runs in the evaluation process while the next epoch trains
+            if monitor is not None:
+                # the best weights are saved when the result comes back
+                monitor.snapshot(epoch, policy)
+            evaluator.submit(epoch, env_step, policy)
+            for eval_epoch, eval_step, result, traj in evaluator.poll():
+                record_test(eval_epoch, eval_step, result, traj)
+        else:
+            # watch for each episode to save data
+            print("Setup test envs ...")
+            policy.eval()
+            #policy.set_eps(args.eps_test)
+            test_envs.seed(args.seed)
+
+            print("Testing agent ...")
+            result = recorder.collect()
+            record_test(epoch, env_step, result)
+
+        if checkpointer is not None:
+            # with the pending evaluations, their rows are not lost on a resume
+            checkpointer.save(epoch, env_step, gradient_step,
+                              evaluator.pending_evals() if evaluator is not None else ())
+        if monitor is not None and monitor.stopped:
+            break
+
+    if evaluator is not None:
+        for eval_epoch, eval_step, result, traj in evaluator.drain():
+            record_test(eval_epoch, eval_step, result, traj)
+
+    if monitor is not None:
+        monitor.finish(env_step)
+
+    recorder.save(args.save_buffer_name)
 
     return 1
 
 def test_ppo(args):
+    # agent steps of one episode of step_per_epoch intervals, action_repeat intervals per step
+    episode_steps = macro_steps(args)
+    if args.event_log:
+        # per-worker binary event records instead of prints on every step
+        event_log.configure(args.event_log)
     env = make_building_env(args)
     args.state_shape = env.observation_space.shape or env.observation_space.n
     args.action_shape = env.action_space.shape or env.action_space.n
     args.max_action = env.action_space.high[0]
     print("Observations shape:", args.state_shape)
     print("Actions shape:", args.action_shape)
+
     print("Action range:", np.min(env.action_space.low),
           np.max(env.action_space.high))
 
-    train_envs = SubprocVectorEnv([lambda: make_building_env(args) for _ in range(args.training_num)])
-    #test_envs = make_building_env(args)
-    test_envs = SubprocVectorEnv([lambda: make_building_env(args) for _ in range(args.test_num)])
-
     # seed
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
-    train_envs.seed(args.seed)
-    test_envs.seed(args.seed)
     # model
     net_a = Net(args.state_shape, hidden_sizes=args.hidden_sizes,
                 activation=nn.Tanh, device=args.device)
@@ -358,7 +486,7 @@ def test_ppo(args):
     lr_scheduler = None
     if args.lr_decay:
         # decay learning rate to 0 linearly
-        max_update_num = np.ceil(args.step_per_epoch / args.step_per_collect) * args.epoch
+        max_update_num = np.ceil(episode_steps / args.step_per_collect) * args.epoch
         lr_scheduler = LambdaLR(optim, lr_lambda=lambda epoch: 1 - epoch / max_update_num)
 
     def dist(*logits):
@@ -379,13 +507,41 @@ def test_ppo(args):
         policy.load_state_dict(torch.load(args.resume_path, map_location=args.device))
         print("Loaded agent from: ", args.resume_path)
 
+    if args.surrogate_fit:
+        # his_act holds the raw policy outputs, the env stepped with their mapped values
+        surrogate.fit_from_files(args.save_buffer_name, env.observation_space, env.action_space,
+                                 episode_steps, args.surrogate, buffer_num=args.test_num,
+                                 map_action=policy.map_action,
+                                 epochs=args.surrogate_epochs, device=args.device)
+        return
+    if args.surrogate_check:
+        policy.eval()
+        report = surrogate.fidelity_check(policy, make_building_env(surrogate.fmu_args(args)),
+                                          make_building_env(args), episode_steps)
+        with open(os.path.join(args.save_buffer_name, 'surrogate_check.json'), 'w') as fp:
+            json.dump(report, fp)
+        return
+
+    train_envs = make_vector_env(lambda **zone: make_building_env(args, **zone), args.training_num, args,
+                                 env.observation_space, wait_num=args.wait_num)
+    def make_test_envs():
+        return make_vector_env(lambda **zone: make_building_env(args, **zone), args.test_num, args,
+                               env.observation_space)
+    # with --async-eval the test episodes run in the evaluation process and its own test envs
+    async_eval = uses_async_eval(args)
+    test_envs = None if async_eval else make_test_envs()
+    train_envs.seed(args.seed)
+    if test_envs is not None:
+        test_envs.seed(args.seed)
+
     # collector
     if args.training_num > 1:
         buffer = VectorReplayBuffer(args.buffer_size, len(train_envs))
     else:
         buffer = ReplayBuffer(args.buffer_size)
-    train_collector = Collector(policy, train_envs, buffer, exploration_noise=True)
-    test_collector = Collector(policy, test_envs)
+    train_collector_cls = AsyncCollector if train_envs.is_async else Collector
+    train_collector = train_collector_cls(policy, train_envs, buffer, exploration_noise=True)
+    test_collector = Collector(policy, test_envs) if test_envs is not None else None
     # log
     t0 = datetime.datetime.now().strftime("%m%d_%H%M%S")
     log_file = f'seed_{args.seed}_{t0}-{args.task.replace("-", "_")}_ppo'
@@ -398,12 +554,26 @@ def test_ppo(args):
         torch.save(policy.state_dict(), os.path.join(log_path, 'policy.pth'))
 
     if not args.watch:
+        checkpointer = None
+        if args.checkpoint or args.resume:
+            # the on-policy buffer is emptied after every update, it is not checkpointed
+            checkpointer = Checkpointer(os.path.join(args.logdir, args.task, 'ppo', 'checkpoint'), policy)
+            if args.resume:
+                checkpointer.load()
         # cutomized trainer
+        evaluator = None
+        if async_eval:
+            # test episodes run in a background process with its own test envs
+            evaluator = AsyncEvaluator(
+                policy, make_test_envs, episode_steps, args.seed)
         result = onpolicy_trainer1(args, test_envs,
-            policy, train_collector, test_collector, args.epoch, args.step_per_epoch,
+            policy, train_collector, test_collector, args.epoch, episode_steps,
             args.repeat_per_collect, args.test_num, args.batch_size,
             step_per_collect=args.step_per_collect, save_fn=save_fn, logger=logger,
-            test_in_train=False)
+            test_in_train=False, evaluator=evaluator, checkpointer=checkpointer,
+            monitor=make_monitor(policy, log_path, args))
+        if evaluator is not None:
+            evaluator.close()
         # trainer
         #result = onpolicy_trainer(
         #    policy, train_collector, test_collector, args.epoch, args.step_per_epoch,
@@ -418,10 +588,10 @@ def test_ppo(args):
         test_envs.seed(args.seed)
 
         print("Testing agent ...")
-        buffer = VectorReplayBuffer(args.step_per_epoch+1, len(test_envs))
+        buffer = VectorReplayBuffer(episode_steps+1, len(test_envs))
 
         collector = Collector(policy, test_envs, buffer, exploration_noise=False)
-        result = collector.collect(n_step=args.step_per_epoch)
+        result = collector.collect(n_step=episode_steps)
         
         np.save(args.save_buffer_name+'/his_act_final.npy', buffer._meta.__dict__['act'])
         np.save(args.save_buffer_name+'/his_obs_final.npy', buffer._meta.__dict__['obs'])
@@ -432,6 +602,11 @@ def test_ppo(args):
 
     #watch()
 
+    # the workers exit cleanly and flush their event logs
+    train_envs.close()
+    if test_envs is not None:
+        test_envs.close()
+
 
 if __name__ == '__main__':
     
@@ -0,0 +1,59 @@
+import gym
+import numpy as np
+
+STATE_NBYTES = 1000
+
+
+class FakeFMU(object):
+    """Just enough of a pyfmi model for FMU state snapshots."""
+
+    def __init__(self):
+        self.x = 0.
+        self.freed = 0
+        self.fail_restore = False
+
+    def get_capability_flags(self):
+        return {'canGetAndSetFMUstate': True, 'canSerializeFMUstate': True}
+
+    def get_fmu_state(self):
+        return [self.x]
+
+    def set_fmu_state(self, state):
+        if self.fail_restore:
+            raise RuntimeError("fmi2SetFMUstate failed")
+        self.x = state[0]
+
+    def free_fmu_state(self, state):
+        self.freed += 1
+
+    def serialize_fmu_state(self, state):
+        return bytes(STATE_NBYTES)
+
+
+class FakeBuildingEnv(gym.Env):
+    """A building env with the modelicagym bookkeeping; ``start`` is the simulation time."""
+
+    def __init__(self, action_space=None):
+        self.model = FakeFMU()
+        self.action_space = action_space or gym.spaces.Discrete(3)
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, shape=(2,))
+        self.simulation_start_time = 0.
+        self.simulation_end_time = 50.
+        self.start = 0.
+        self.steps = 0
+        self.resets = 0
+
+    def _obs(self):
+        return np.array([self.model.x, self.start])
+
+    def reset(self, x0=0.):
+        self.resets += 1
+        self.model.x = x0
+        self.start = self.simulation_start_time
+        return self._obs()
+
+    def step(self, action):
+        self.steps += 1
+        self.model.x = 0.5 * self.model.x + float(action) + 1.
+        self.start += 1.
+        return self._obs(), -self.model.x, self.start >= self.simulation_end_time, {'x': self.model.x}
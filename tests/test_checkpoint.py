@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from tianshou.data import Batch, VectorReplayBuffer
+from tianshou.policy import DQNPolicy
+from tianshou.utils.net.common import Net
+
+from drl_hpc import checkpoint
+from drl_hpc.checkpoint import Checkpointer
+
+
+def make_policy():
+    net = Net(3, 2, hidden_sizes=[8])
+    optim = torch.optim.Adam(net.parameters(), lr=1e-3)
+    return DQNPolicy(net, optim, 0.99, 1, target_update_freq=10)
+
+
+def fill(buffer, n, start=0):
+    for i in range(start, start + n):
+        buffer.add(Batch(obs=np.full((2, 3), i, dtype=np.float32), act=np.array([0, 1]),
+                         rew=np.array([i, -i], dtype=np.float32), done=np.array([False, False]),
+                         obs_next=np.full((2, 3), i + 1, dtype=np.float32), info={}))
+
+
+def train_step(policy, buffer):
+    policy.update(4, buffer)
+
+
+@pytest.fixture
+def run(tmp_path):
+    torch.manual_seed(0)
+    policy = make_policy()
+    buffer = VectorReplayBuffer(64, 2)
+    fill(buffer, 20)
+    train_step(policy, buffer)
+    policy.set_eps(0.3)
+    return str(tmp_path / 'ckpt'), policy, buffer
+
+
+def test_round_trip(run):
+    folder, policy, buffer = run
+    Checkpointer(folder, policy, buffer, segment=8).save(3, 40, 1)
+    expected_rng = torch.rand(3)
+
+    other, other_buffer = make_policy(), VectorReplayBuffer(64, 2)
+    ckpt = Checkpointer(folder, other, other_buffer, segment=8)
+    assert ckpt.load()
+    assert ckpt.counters() == (3, 40, 1)
+    ckpt.restore_rng()
+    assert torch.equal(torch.rand(3), expected_rng)
+    for k, v in policy.state_dict().items():
+        assert torch.equal(v, other.state_dict()[k])
+    assert other.eps == 0.3
+    assert other._iter == policy._iter
+    assert other.optim.state_dict()['state'].keys() == policy.optim.state_dict()['state'].keys()
+    assert len(other_buffer) == len(buffer)
+    np.testing.assert_array_equal(other_buffer.obs, buffer.obs)
+    np.testing.assert_array_equal(other_buffer.rew, buffer.rew)
+    np.testing.assert_array_equal(other_buffer.sample_index(0), buffer.sample_index(0))
+    # the sub-buffers continue where they stopped
+    fill(buffer, 1, start=20)
+    fill(other_buffer, 1, start=20)
+    np.testing.assert_array_equal(other_buffer.obs, buffer.obs)
+
+
+def test_unchanged_segments_are_linked(run):
+    folder, policy, buffer = run
+    ckpt = Checkpointer(folder, policy, buffer, segment=8)
+    ckpt.save(1, 20, 1)
+
+    def inodes(generation):
+        gen = os.path.join(folder, 'buffer', str(generation))
+        return {f: os.stat(os.path.join(gen, f)).st_ino for f in os.listdir(gen)}
+    before = inodes(1)
+    fill(buffer, 2, start=20)
+    ckpt.save(2, 22, 1)
+    assert os.listdir(os.path.join(folder, 'buffer')) == ['2']
+    after = inodes(2)
+    assert before.keys() == after.keys()
+    # the new rows are 20, 21 of the first sub-buffer and 52, 53 of the second;
+    # act 0 and done False were already there in the first one
+    changed = {f for f in after if after[f] != before[f]}
+    assert changed == {'obs.16.npy', 'obs.48.npy', 'obs_next.16.npy', 'obs_next.48.npy',
+                       'rew.16.npy', 'rew.48.npy', 'act.48.npy'}
+
+
+def test_interrupted_save_keeps_last_checkpoint(run, monkeypatch):
+    folder, policy, buffer = run
+    Checkpointer(folder, policy, buffer, segment=8).save(1, 20, 1)
+    saved_obs = buffer.obs.copy()
+    fill(buffer, 10, start=20)
+
+    def killed(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(checkpoint.torch, 'save', killed)
+    with pytest.raises(KeyboardInterrupt):
+        Checkpointer(folder, policy, buffer, segment=8).save(2, 30, 1)
+    monkeypatch.undo()
+
+    other_buffer = VectorReplayBuffer(64, 2)
+    ckpt = Checkpointer(folder, make_policy(), other_buffer, segment=8)
+    assert ckpt.load()
+    assert ckpt.counters() == (1, 20, 1)
+    np.testing.assert_array_equal(other_buffer.obs, saved_obs)
+
+
+def test_pending_evaluations_are_kept(run):
+    folder, policy, buffer = run
+    weights = {k: v.clone() for k, v in policy.state_dict().items()}
+    Checkpointer(folder, policy, buffer, segment=8).save(4, 50, 2, [(3, 40, weights)])
+
+    ckpt = Checkpointer(folder, make_policy(), VectorReplayBuffer(64, 2), segment=8)
+    assert ckpt.pending_evals() == []
+    assert ckpt.load()
+    [(epoch, env_step, saved)] = ckpt.pending_evals()
+    assert (epoch, env_step) == (3, 40)
+    for k, v in weights.items():
+        assert torch.equal(saved[k], v)
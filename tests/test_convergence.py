@@ -0,0 +1,88 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from drl_hpc.convergence import BEST_FILE, REASON_FILE, ConvergenceMonitor
+
+# episode rewards of the three test envs around the mean test reward
+SPREAD = np.array([-1., 0., 1.])
+RISING = [0., 1., 2., 3., 4., 5., 6., 7., 8., 9.]
+FLAT = [1., 2., 3., 3., 3., 3., 3., 3., 3., 3.]
+
+# monitor kwargs, mean test reward per epoch, reason, epoch of the stop
+CASES = [
+    ('target', dict(target=5.), RISING, 'target', 6),
+    ('target_before_min_epochs', dict(target=2., min_epochs=8), RISING, 'target', 3),
+    ('plateau', dict(window=2, patience=3), FLAT, 'plateau', 7),
+    ('plateau_min_delta', dict(window=2, patience=1, min_delta=1.5), RISING, 'plateau', 3),
+    ('plateau_min_epochs', dict(window=2, patience=3, min_epochs=9), FLAT, 'plateau', 9),
+    ('ci', dict(window=3, ci_z=1.), FLAT, 'ci', 7),
+    ('ci_min_epochs', dict(window=3, ci_z=1., min_epochs=9), FLAT, 'ci', 9),
+    ('improving', dict(window=2, patience=3, ci_z=1., target=100.), RISING, 'max_epoch', None),
+]
+
+
+def make_policy():
+    return torch.nn.Linear(1, 1)
+
+
+def evaluate(monitor, policy, means):
+    """Feed the evaluations of ``means``, one per epoch; return the epoch of the stop."""
+    stop = None
+    for epoch, mean in enumerate(means, 1):
+        # the weights of epoch n are all n
+        policy.weight.data.fill_(epoch)
+        if monitor.update(epoch, 10 * epoch, {'rews': mean + SPREAD}) and stop is None:
+            stop = epoch
+    monitor.finish(10 * len(means))
+    return stop
+
+
+@pytest.mark.parametrize('kwargs, means, reason, epoch', [c[1:] for c in CASES],
+                         ids=[c[0] for c in CASES])
+def test_stop_rules(tmp_path, kwargs, means, reason, epoch):
+    folder = str(tmp_path)
+    policy = make_policy()
+    monitor = ConvergenceMonitor(policy, folder, **kwargs)
+    assert evaluate(monitor, policy, means) == epoch
+    assert monitor.reason == reason
+
+    with open(os.path.join(folder, REASON_FILE)) as fp:
+        info = json.load(fp)
+    assert info['reason'] == reason
+    assert info['epoch'] == (epoch or len(means))
+    assert info['env_step'] == 10 * info['epoch']
+    # the best evaluation up to the stop
+    seen = means[:info['epoch']]
+    assert (info['best_epoch'], info['best_reward']) == (int(np.argmax(seen)) + 1, max(seen))
+    # the best weights also follow the evaluations that come back after the stop
+    best = torch.load(os.path.join(folder, BEST_FILE))
+    assert torch.all(best['weight'] == int(np.argmax(means)) + 1)
+
+
+def test_best_weights_of_background_evaluations(tmp_path):
+    folder = str(tmp_path)
+    policy = make_policy()
+    monitor = ConvergenceMonitor(policy, folder, target=10.)
+    policy.weight.data.fill_(1.)
+    monitor.snapshot(1, policy)
+    # a checkpoint's pending evaluation hands its saved weights
+    monitor.snapshot(2, {k: torch.full_like(v, 2.) for k, v in policy.state_dict().items()})
+    # training goes on while both are evaluated
+    policy.weight.data.fill_(3.)
+    monitor.update(1, 10, {'rews': 1. + SPREAD})
+    assert torch.all(torch.load(os.path.join(folder, BEST_FILE))['weight'] == 1.)
+    monitor.update(2, 20, {'rews': 2. + SPREAD})
+    assert torch.all(torch.load(os.path.join(folder, BEST_FILE))['weight'] == 2.)
+    assert not monitor.weights
+
+
+def test_no_stop_file_without_evaluations(tmp_path):
+    monitor = ConvergenceMonitor(make_policy(), str(tmp_path), target=1.)
+    monitor.update(1, 10, {'rews': np.array([])})
+    monitor.finish(10)
+    assert monitor.reason is None
+    assert not os.path.exists(os.path.join(str(tmp_path), REASON_FILE))
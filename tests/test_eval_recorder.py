@@ -0,0 +1,102 @@
+import json
+import os
+
+import numpy as np
+from tianshou.data import Batch
+from tianshou.env import DummyVectorEnv
+from tianshou.policy import BasePolicy
+
+from drl_hpc.eval_recorder import EvalRecorder, load_meta, load_trajectories, traj_path
+
+from conftest import FakeBuildingEnv
+
+STEPS = 5
+
+
+class ConstantPolicy(BasePolicy):
+    """Always takes action ``act``."""
+
+    def __init__(self, act):
+        super().__init__()
+        self.act = act
+
+    def forward(self, batch, state=None, **kwargs):
+        return Batch(act=np.full(len(batch.obs), self.act))
+
+    def learn(self, batch, **kwargs):
+        return {}
+
+
+def make_recorder(folder, epochs, act=1, **kwargs):
+    envs = DummyVectorEnv([FakeBuildingEnv for _ in range(2)])
+    return EvalRecorder(ConstantPolicy(act), envs, STEPS, epochs, folder=folder, **kwargs)
+
+
+def record(recorder, epoch):
+    recorder.policy.act = epoch % 3
+    recorder.collect()
+    recorder.add(recorder.trajectory(), epoch=epoch)
+
+
+def test_files_have_a_row_per_epoch_until_save(tmp_path):
+    folder = str(tmp_path)
+    recorder = make_recorder(folder, epochs=10)
+    for epoch in (1, 2, 3):
+        record(recorder, epoch)
+    rew = np.load(traj_path(folder, 'rew'))
+    assert rew.shape[0] == 10
+    np.testing.assert_array_equal(rew[3:], 0.)
+    # the rows of a running job are readable from the meta
+    data, meta = load_trajectories(folder)
+    assert [m['epoch'] for m in meta] == [1, 2, 3] and len(data['obs']) == 3
+
+    recorder.save(folder)
+    for k in ('act', 'obs', 'rew'):
+        saved = np.load(traj_path(folder, k))
+        assert len(saved) == 3
+        np.testing.assert_array_equal(saved, recorder.get(k))
+    # the actions of epoch 2 were all 2, over both test envs
+    np.testing.assert_array_equal(recorder.get('act')[1, :STEPS], 2)
+
+
+def test_resume_drops_later_epochs_and_grows_the_files(tmp_path):
+    folder = str(tmp_path)
+    recorder = make_recorder(folder, epochs=10)
+    for epoch in (1, 2, 3):
+        record(recorder, epoch)
+    recorder.save(folder)
+    kept = recorder.get('act')[:2].copy()
+
+    # the run was checkpointed at epoch 2 and continues with more epochs
+    resumed = make_recorder(folder, epochs=12, resume_epoch=2)
+    assert resumed.size == 2
+    assert [m['epoch'] for m in load_meta(folder)] == [1, 2]
+    assert np.load(traj_path(folder, 'act'), mmap_mode='r').shape[0] == 12
+    np.testing.assert_array_equal(resumed.get('act'), kept)
+    record(resumed, 3)
+    with open(os.path.join(folder, 'his_meta.jsonl')) as fp:
+        assert [json.loads(line)['row'] for line in fp] == [0, 1, 2]
+    resumed.save(folder)
+    data, meta = load_trajectories(folder, mmap=False)
+    assert len(data['act']) == 3
+    np.testing.assert_array_equal(data['act'][:2], kept)
+
+
+def test_new_run_starts_a_new_record(tmp_path):
+    folder = str(tmp_path)
+    recorder = make_recorder(folder, epochs=4)
+    record(recorder, 1)
+    make_recorder(folder, epochs=4)
+    assert load_meta(folder) is None
+
+
+def test_resume_drops_the_rows_of_repeated_evaluations(tmp_path):
+    folder = str(tmp_path)
+    recorder = make_recorder(folder, epochs=10)
+    for epoch in (1, 2, 3):
+        record(recorder, epoch)
+    # checkpointed at epoch 3 while the evaluation of epoch 3 was still running
+    resumed = make_recorder(folder, epochs=10, resume_epoch=3, rerun_epochs=[3])
+    assert resumed.size == 2
+    record(resumed, 3)
+    assert [m['epoch'] for m in load_meta(folder)] == [1, 2, 3]
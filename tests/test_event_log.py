@@ -0,0 +1,37 @@
+import pytest
+
+from drl_hpc import event_log
+from drl_hpc.event_log import read_events
+
+
+@pytest.fixture
+def log_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(event_log, '_CONFIG', dict(event_log._CONFIG))
+    monkeypatch.setattr(event_log, '_LOGS', {})
+    event_log.configure(str(tmp_path), flush_interval=30.)
+    event_log.set_epoch(1)
+    return str(tmp_path)
+
+
+def test_flush_at_epoch_change(log_dir):
+    event_log.record('reward', 0, 1., 2., 3.)
+    event_log.record('reward', 1, 1., 2., 3.)
+    assert len(read_events(log_dir)) == 0
+    event_log.set_epoch(2)
+    event_log.record('reward', 2, 1., 2., 3.)
+    events = read_events(log_dir)
+    assert list(events['step']) == [0, 1] and set(events['epoch']) == {1}
+    event_log.flush()
+    assert list(read_events(log_dir, epoch=2)['step']) == [2]
+
+
+def test_flush_after_interval(log_dir, monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(event_log.time, 'time', lambda: now[0])
+    event_log.record('eps', 0, 0.5)
+    now[0] += 10.
+    event_log.record('eps', 1, 0.4)
+    assert len(read_events(log_dir)) == 0
+    now[0] += 25.
+    event_log.record('eps', 2, 0.3)
+    assert list(read_events(log_dir, kind='eps')['step']) == [0, 1]
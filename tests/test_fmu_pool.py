@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+import pytest
+
+from drl_hpc import fmu_pool
+from drl_hpc.fmu_pool import SnapshotResetWrapper, pooled_env
+
+from conftest import FakeBuildingEnv
+
+DAY = 86400.
+
+
+def run_episode(env, actions=(0, 1, 2)):
+    obs = env.reset()
+    for a in actions:
+        env.step(a)
+    return obs
+
+
+def test_reset_restores_the_snapshot():
+    env = FakeBuildingEnv()
+    wrapper = SnapshotResetWrapper(env)
+    first = run_episode(wrapper)
+    assert env.model.x != 0. and env.start == 3.
+    second = run_episode(wrapper)
+    # initialized once, later resets only restore the FMU state and the bookkeeping
+    assert env.resets == 1
+    np.testing.assert_array_equal(first, second)
+    wrapper.reset()
+    assert (env.model.x, env.start) == (0., 0.)
+
+
+def test_random_start_days():
+    env = FakeBuildingEnv()
+    start_times = [0., DAY, 2 * DAY]
+    wrapper = SnapshotResetWrapper(env, start_times=start_times, episode_length=7 * DAY, seed=0)
+    starts = []
+    for _ in range(20):
+        obs = run_episode(wrapper)
+        starts.append(obs[1])
+        assert env.simulation_end_time == obs[1] + 7 * DAY
+    assert set(starts) == set(start_times)
+    # one initialization per start day
+    assert env.resets == 3 and set(wrapper.snapshots) == set(start_times)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(fmu_pool, '_POOL', {})
+    made = []
+
+    def make_fn():
+        made.append(FakeBuildingEnv())
+        return made[-1]
+    return make_fn, made
+
+
+def test_pool_reuses_closed_envs_per_pid(pool, monkeypatch):
+    make_fn, made = pool
+    env = pooled_env('Fake-v0', {'weather': 'a'}, make_fn)
+    env.reset()
+    env.close()
+    again = pooled_env('Fake-v0', {'weather': 'a'}, make_fn)
+    assert again is env and len(made) == 1
+    # the reused env still resets from its snapshot
+    again.reset()
+    assert made[0].resets == 1
+    # other env kwargs get another env
+    other = pooled_env('Fake-v0', {'weather': 'b'}, make_fn)
+    assert other is not env and len(made) == 2
+    again.close()
+
+    # a forked child does not reuse the envs of its parent
+    key = fmu_pool.pool_key('Fake-v0', {'weather': 'a'})
+    pid = os.getpid()
+    monkeypatch.setattr(fmu_pool.os, 'getpid', lambda: pid + 1)
+    child = pooled_env('Fake-v0', {'weather': 'a'}, make_fn)
+    assert child is not env and len(made) == 3
+    child.close()
+    # and closes only its own envs
+    fmu_pool.close_pool()
+    assert list(fmu_pool._POOL) == [key]
+
+
+def test_failed_restore_falls_back_to_reset():
+    env = FakeBuildingEnv()
+    wrapper = SnapshotResetWrapper(env)
+    run_episode(wrapper)
+    env.model.fail_restore = True
+    obs = wrapper.reset()
+    assert env.resets == 2 and env.model.freed == 1
+    np.testing.assert_array_equal(obs, [0., 0.])
+    # the snapshot of the new initialization is used once restoring works again
+    env.model.fail_restore = False
+    run_episode(wrapper)
+    wrapper.reset()
+    assert env.resets == 2
+
+
+class SnapshotStore(object):
+    """In-memory stand-in for a StartStateCache shared by two envs."""
+
+    def __init__(self):
+        self.snapshots = {}
+
+    def load(self, env, start_time):
+        return self.snapshots.get(start_time)
+
+    def save(self, env, start_time, snapshot):
+        self.snapshots[start_time] = snapshot
+
+
+def test_stored_snapshot_gets_the_episode_length_of_the_run():
+    store = SnapshotStore()
+    SnapshotResetWrapper(FakeBuildingEnv(), start_times=[DAY], episode_length=DAY, store=store).reset()
+    env = FakeBuildingEnv()
+    SnapshotResetWrapper(env, start_times=[DAY], episode_length=7 * DAY, store=store).reset()
+    assert env.resets == 0
+    assert (env.simulation_start_time, env.simulation_end_time) == (DAY, 8 * DAY)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import torch
+from tianshou.data import Batch, PrioritizedVectorReplayBuffer, VectorReplayBuffer
+from tianshou.policy import DQNPolicy
+from tianshou.utils.net.common import Net
+
+from drl_hpc.fused_update import FusedUpdater
+
+BATCH_SIZE = 8
+N_UPDATES = 6
+
+
+class NullLogger(object):
+    def log_update_data(self, losses, step):
+        pass
+
+
+def make_policy():
+    torch.manual_seed(0)
+    net = Net(3, 4, hidden_sizes=[16])
+    optim = torch.optim.Adam(net.parameters(), lr=1e-2)
+    return DQNPolicy(net, optim, 0.9, 2, target_update_freq=3)
+
+
+def make_buffer(prioritized):
+    if prioritized:
+        buffer = PrioritizedVectorReplayBuffer(64, 2, alpha=0.6, beta=0.4)
+    else:
+        buffer = VectorReplayBuffer(64, 2)
+    rng = np.random.RandomState(0)
+    for i in range(30):
+        buffer.add(Batch(obs=rng.normal(size=(2, 3)), act=rng.randint(4, size=2),
+                         rew=rng.normal(size=2), done=np.array([i % 7 == 6, i % 11 == 10]),
+                         obs_next=rng.normal(size=(2, 3)), info={}))
+    return buffer
+
+
+def replay_indices(buffer, indices):
+    """Make ``buffer`` hand out ``indices`` in order, whatever the sample size."""
+    queue = list(indices)
+
+    def sample_index(size):
+        taken = queue[:size]
+        del queue[:size]
+        return np.array(taken)
+    buffer.sample_index = sample_index
+
+
+@pytest.mark.parametrize('prioritized', [False, True])
+def test_fused_updates_match_sequential_updates(prioritized):
+    np.random.seed(1)
+    indices = make_buffer(prioritized).sample_index(BATCH_SIZE * N_UPDATES)
+
+    sequential, seq_buffer = make_policy(), make_buffer(prioritized)
+    replay_indices(seq_buffer, indices)
+    for _ in range(N_UPDATES):
+        sequential.update(BATCH_SIZE, seq_buffer)
+
+    fused, fused_buffer = make_policy(), make_buffer(prioritized)
+    replay_indices(fused_buffer, indices)
+    updater = FusedUpdater(fused, BATCH_SIZE, N_UPDATES, N_UPDATES, NullLogger())
+    step, losses = updater.step(N_UPDATES - 1, fused_buffer, 0)
+    assert step == 0 and losses is None
+    step, losses = updater.step(1, fused_buffer, step)
+    assert step == N_UPDATES and set(losses) == {'loss'}
+
+    assert fused._iter == sequential._iter == N_UPDATES
+    for k, v in sequential.state_dict().items():
+        assert torch.equal(v, fused.state_dict()[k]), k
+    if prioritized:
+        initial = make_buffer(prioritized).weight
+        sampled = np.unique(indices)
+        assert not np.allclose(fused_buffer.weight[sampled], initial[sampled])
+        np.testing.assert_array_equal(fused_buffer.weight, seq_buffer.weight)
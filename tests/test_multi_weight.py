@@ -0,0 +1,67 @@
+import numpy as np
+import torch
+from tianshou.data import Batch, VectorReplayBuffer
+from tianshou.policy import DQNPolicy
+from tianshou.utils.net.common import Net
+
+from drl_hpc.multi_weight import MultiWeightPolicy, RelabeledBuffer
+from drl_hpc.replay import relabel
+
+WEIGHTS = [(1., 10.), (100., 10.)]
+
+
+def make_buffer(n=40):
+    buffer = VectorReplayBuffer(64, 2)
+    rng = np.random.RandomState(0)
+    for i in range(n):
+        cost, penalty = rng.uniform(size=2), rng.uniform(size=2)
+        buffer.add(Batch(obs=rng.normal(size=(2, 3)), act=rng.randint(2, size=2),
+                         rew=-(cost + penalty), done=np.array([i % 7 == 6, i % 9 == 8]),
+                         obs_next=rng.normal(size=(2, 3)),
+                         info=Batch(cost=cost, penalty=penalty)))
+    return buffer
+
+
+def make_head():
+    net = Net(3, 2, hidden_sizes=[8])
+    return DQNPolicy(net, torch.optim.Adam(net.parameters(), lr=1e-3), 0.9, estimation_step=3)
+
+
+def test_relabel_rows():
+    buffer = make_buffer()
+    stored = buffer.rew.copy()
+    rows = np.array([0, 5, 33])
+    rew = relabel(buffer, 2., 3., index=rows)
+    np.testing.assert_allclose(rew, 2. * buffer.info.cost[rows] + 3. * buffer.info.penalty[rows])
+    np.testing.assert_allclose(relabel(buffer, 2., 3.)[rows], rew)
+    np.testing.assert_array_equal(buffer.rew, stored)
+
+
+def test_nstep_returns_use_the_head_weights():
+    buffer = make_buffer()
+    stored = buffer.rew.copy()
+    head = make_head()
+    view = RelabeledBuffer(buffer, *WEIGHTS[1], 3, np.zeros(len(buffer.rew)))
+    np.random.seed(1)
+    batch, indices = view.sample(16)
+    returns = head.process_fn(batch, view, indices).returns
+
+    # the same sample from a copy whose rewards were all relabeled
+    full = make_buffer()
+    full.rew[:] = relabel(full, *WEIGHTS[1])
+    np.random.seed(1)
+    batch, full_indices = full.sample(16)
+    np.testing.assert_array_equal(indices, full_indices)
+    np.testing.assert_allclose(batch.rew, view.rew[indices])
+    expected = head.process_fn(batch, full, full_indices).returns
+    torch.testing.assert_close(returns, expected)
+    np.testing.assert_array_equal(buffer.rew, stored)
+
+
+def test_update_leaves_stored_rewards():
+    buffer = make_buffer()
+    stored = buffer.rew.copy()
+    policy = MultiWeightPolicy([make_head() for _ in WEIGHTS], WEIGHTS)
+    losses = policy.update(8, buffer)
+    assert set(losses) == {'loss/0', 'loss/1'}
+    np.testing.assert_array_equal(buffer.rew, stored)
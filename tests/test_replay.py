@@ -0,0 +1,53 @@
+import gym
+import numpy as np
+from tianshou.data import Batch
+
+from drl_hpc.replay import CompactVectorReplayBuffer, CompactPrioritizedVectorReplayBuffer
+
+OBS_SPACE = gym.spaces.Box(np.array([-10., 0., 5.]), np.array([40., 1., 5.]))
+ACT_SPACE = gym.spaces.Discrete(51)
+
+
+def fill(buffer, n, seed=0):
+    rng = np.random.RandomState(seed)
+    obs = rng.uniform(OBS_SPACE.low, OBS_SPACE.high, size=(n, 2, 3)).astype(np.float32)
+    act = rng.randint(ACT_SPACE.n, size=(n, 2))
+    rew = rng.normal(size=(n, 2))
+    for i in range(n):
+        buffer.add(Batch(obs=obs[i], act=act[i], rew=rew[i], done=np.array([i % 5 == 4] * 2),
+                         obs_next=np.clip(obs[i] + 0.5, OBS_SPACE.low, OBS_SPACE.high), info={}))
+    return obs, act, rew
+
+
+def test_uint16_storage_round_trip():
+    buffer = CompactVectorReplayBuffer(32, 2, observation_space=OBS_SPACE, action_space=ACT_SPACE)
+    obs, act, rew = fill(buffer, 10)
+    meta = buffer._meta
+    assert meta.obs.dtype == np.uint16 and meta.obs_next.dtype == np.uint16
+    assert meta.act.dtype == np.uint8 and meta.rew.dtype == np.float32
+    assert meta.done.dtype == bool
+    # the first row of the first sub-buffer holds the first transition of env 0
+    batch = buffer[np.array([0, 16])]
+    assert batch.obs.dtype == np.float32 and batch.act.dtype == np.int64
+    scale = (OBS_SPACE.high - OBS_SPACE.low) / 65535.
+    assert np.all(np.abs(batch.obs - obs[0]) <= scale / 2 + 1e-5)
+    np.testing.assert_array_equal(batch.act, act[0])
+    np.testing.assert_allclose(batch.rew, rew[0], rtol=1e-6)
+    # the constant feature decodes exactly
+    np.testing.assert_array_equal(batch.obs[:, 2], 5.)
+    obs_next = np.clip(obs[:1, 0] + 0.5, OBS_SPACE.low, OBS_SPACE.high)
+    np.testing.assert_allclose(buffer.get(np.array([0]), 'obs_next'), obs_next, atol=scale.max())
+
+
+def test_float16_storage_and_prioritized_sampling():
+    buffer = CompactPrioritizedVectorReplayBuffer(32, 2, alpha=0.6, beta=0.4, obs_dtype='float16',
+                                                  observation_space=OBS_SPACE,
+                                                  action_space=ACT_SPACE)
+    obs, _, _ = fill(buffer, 10)
+    assert buffer._meta.obs.dtype == np.float16
+    batch, indices = buffer.sample(8)
+    assert batch.obs.dtype == np.float32 and batch.act.dtype == np.int64
+    assert batch.weight.shape == (8,)
+    stored = np.concatenate([obs[:, 0], obs[:, 1]])
+    for o in batch.obs:
+        assert np.abs(stored - o).max(axis=1).min() <= 40 * 2 ** -10
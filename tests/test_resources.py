@@ -0,0 +1,61 @@
+import os
+import json
+import argparse
+
+import pytest
+
+from drl_hpc import resources
+from drl_hpc.resources import CoreSlots, plan, trial_footprint
+
+
+def make_args(**kwargs):
+    args = dict(torch_threads=0, training_num=4, test_num=2, async_eval=False,
+                vector_env='subproc', envs_per_proc=1, apex_actors=0, test_only=False,
+                watch=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_footprint_counts_env_processes():
+    footprint = trial_footprint(make_args(), fmu_mb=100.)
+    assert footprint['cpus'] == 2 + 6
+    assert footprint['memory_mb'] == resources.LEARNER_MB + 6 * 100.
+    assert trial_footprint(make_args(async_eval=True))['env_processes'] == 4 + 1 + 2
+    # Ape-X tests in the learner process, --async-eval does not apply
+    assert trial_footprint(make_args(async_eval=True, apex_actors=3))['env_processes'] == 6 + 3
+    assert trial_footprint(make_args(vector_env='multizone', envs_per_proc=4))['env_processes'] == 2
+    assert trial_footprint(make_args(vector_env='service'))['env_processes'] == 0
+
+
+def test_plan_cpu_and_memory_bound():
+    assert plan({'cpus': 7.5, 'memory_mb': 1000.}, 72, memory_mb=72000.) == (8, 9)
+    # 10% of the memory is 10% of the CPUs
+    assert plan({'cpus': 2., 'memory_mb': 7200.}, 72, memory_mb=72000.) == (8, 9)
+    # never more than the node
+    assert plan({'cpus': 100., 'memory_mb': 1000.}, 72, memory_mb=72000.) == (72, 1)
+
+
+@pytest.fixture
+def slots(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(8)))
+    return CoreSlots(str(tmp_path / 'slots.json'))
+
+
+def test_claim_skips_cores_of_live_trials(slots):
+    dead = 2 ** 22 + 1  # above the default pid_max
+    with open(slots.path, 'w') as fp:
+        json.dump({str(os.getppid()): [0, 1], str(dead): [2, 3]}, fp)
+    # the cores of the dead trial are free again
+    assert slots.claim(3) == [2, 3, 4]
+    with open(slots.path) as fp:
+        assert set(json.load(fp)) == {str(os.getppid()), str(os.getpid())}
+
+
+def test_claim_nothing_when_full_and_release(slots):
+    with open(slots.path, 'w') as fp:
+        json.dump({str(os.getppid()): list(range(6))}, fp)
+    assert slots.claim(3) == []
+    assert slots.claim(2) == [6, 7]
+    slots.release()
+    with open(slots.path) as fp:
+        assert list(json.load(fp)) == [str(os.getppid())]
@@ -0,0 +1,76 @@
+import gym
+import numpy as np
+
+from drl_hpc.rollout_cache import RolloutCacheWrapper
+
+from conftest import STATE_NBYTES, FakeBuildingEnv
+
+
+def rollout(env, actions, **reset_kwargs):
+    env.reset(**reset_kwargs)
+    return [env.step(a) for a in actions]
+
+
+def test_repeated_rollout_served_from_cache():
+    env = FakeBuildingEnv()
+    cache = RolloutCacheWrapper(env, 1 << 30, snapshot_interval=4)
+    actions = [0, 1, 2, 1, 0, 2, 2, 1, 0, 1]
+    first = rollout(cache, actions)
+    steps = env.steps
+    second = rollout(cache, actions)
+    assert env.steps == steps
+    assert cache.hits == len(actions)
+    for (o1, r1, d1, i1), (o2, r2, d2, i2) in zip(first, second):
+        np.testing.assert_array_equal(o1, o2)
+        assert (r1, d1, i1) == (r2, d2, i2)
+
+
+def test_new_action_resumes_from_cached_state():
+    cache = RolloutCacheWrapper(FakeBuildingEnv(), 1 << 30, snapshot_interval=4)
+    rollout(cache, [0, 1, 2, 1, 0, 2, 2])
+    cached = rollout(cache, [0, 1, 2, 1, 0, 2, 0, 1])
+    fresh = rollout(FakeBuildingEnv(), [0, 1, 2, 1, 0, 2, 0, 1])
+    for (o1, r1, _, _), (o2, r2, _, _) in zip(cached, fresh):
+        np.testing.assert_array_equal(o1, o2)
+        assert r1 == r2
+
+
+def test_memory_cap_counts_roots():
+    env = FakeBuildingEnv()
+    # room for about two roots with their snapshot and a few outputs
+    max_bytes = 2 * (STATE_NBYTES + 200)
+    cache = RolloutCacheWrapper(env, max_bytes, snapshot_interval=100)
+    for x0 in range(5):
+        rollout(cache, [0, 1, 2], x0=float(x0))
+        assert cache.nbytes <= max_bytes
+    assert len(cache.roots) < 5
+    assert env.model.freed > 0
+    # the most recent start state is still cached
+    steps = env.steps
+    rollout(cache, [0, 1, 2], x0=4.)
+    assert env.steps == steps
+
+
+def test_least_recently_used_rollout_evicted_first():
+    env = FakeBuildingEnv()
+    cache = RolloutCacheWrapper(env, 1 << 30, snapshot_interval=100)
+    rollout(cache, [0, 0, 0])
+    rollout(cache, [1, 1, 1])
+    rollout(cache, [0, 0, 0])
+    # drop everything above the root and one full rollout
+    cache.max_bytes = cache.nbytes - 3 * (np.zeros(2).nbytes + 64)
+    cache._evict()
+    steps = env.steps
+    rollout(cache, [0, 0, 0])
+    assert env.steps == steps
+    rollout(cache, [1, 1, 1])
+    assert env.steps == steps + 3
+
+
+def test_disabled_for_continuous_actions():
+    env = FakeBuildingEnv(gym.spaces.Box(-1., 1., shape=(1,)))
+    cache = RolloutCacheWrapper(env, 1 << 30)
+    assert not cache.enabled
+    rollout(cache, [0.5, 0.5])
+    rollout(cache, [0.5, 0.5])
+    assert env.steps == 4
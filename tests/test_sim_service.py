@@ -0,0 +1,94 @@
+import os
+import time
+import multiprocessing as mp
+
+import gym
+import numpy as np
+import pytest
+from multiprocessing.connection import Client
+
+from drl_hpc import sim_service
+from drl_hpc.sim_service import ServiceVectorEnv, SimService, service_alive
+
+OBS_SPACE = gym.spaces.Box(-np.inf, np.inf, shape=(2,))
+
+
+class CountEnv(gym.Env):
+    """Counts the actions; action -1 kills the process it runs in."""
+
+    observation_space = OBS_SPACE
+    action_space = gym.spaces.Discrete(3)
+
+    def reset(self):
+        self.t = 0
+        return np.array([0., os.getpid()])
+
+    def step(self, action):
+        if action == -1:
+            os._exit(3)
+        self.t += 1
+        return np.array([self.t, os.getpid()]), float(action), self.t >= 10, {}
+
+
+def broken_env():
+    raise ValueError("no FMU here")
+
+
+@pytest.fixture
+def address(tmp_path):
+    address = str(tmp_path / 'sim.sock')
+    service = mp.get_context('fork').Process(
+        target=lambda: SimService(address, workers=2, idle_timeout=30.).serve())
+    service.start()
+    start = time.time()
+    while not service_alive(address):
+        assert time.time() - start < 10, "the service did not start"
+        time.sleep(0.05)
+    yield address
+    service.terminate()
+    service.join()
+
+
+def test_step_through_service(address):
+    envs = ServiceVectorEnv([CountEnv] * 3, OBS_SPACE, address)
+    obs = envs.reset()
+    # spread over both workers
+    assert len(set(obs[:, 1])) == 2
+    obs, rew, done, info = envs.step(np.array([0, 1, 2]))
+    np.testing.assert_array_equal(obs[:, 0], 1.)
+    np.testing.assert_array_equal(rew, [0., 1., 2.])
+    assert not done.any() and len(info) == 3
+    envs.close()
+
+
+def test_dead_worker_fails_its_clients_and_is_replaced(address):
+    envs = ServiceVectorEnv([CountEnv] * 2, OBS_SPACE, address)
+    pids = envs.reset()[:, 1]
+    with pytest.raises(RuntimeError, match="exited with code 3"):
+        envs.step(np.array([-1, 0]))
+    # the client stays failed, closing it is fine
+    with pytest.raises(RuntimeError, match="exited with code 3"):
+        envs.step(np.array([0, 0]))
+    envs.close()
+
+    others = ServiceVectorEnv([CountEnv] * 2, OBS_SPACE, address)
+    new_pids = others.reset()[:, 1]
+    assert pids[0] not in new_pids and pids[1] in new_pids
+    obs, _, _, _ = others.step(np.array([1, 1]))
+    np.testing.assert_array_equal(obs[:, 0], 1.)
+    others.close()
+
+
+def test_failed_make_closes_the_connection(address, monkeypatch):
+    conns = []
+
+    def client(*args, **kwargs):
+        conns.append(Client(*args, **kwargs))
+        return conns[-1]
+    monkeypatch.setattr(sim_service, 'Client', client)
+    with pytest.raises(RuntimeError, match="no FMU here"):
+        ServiceVectorEnv([CountEnv, broken_env], OBS_SPACE, address)
+    assert conns[0].closed
+    envs = ServiceVectorEnv([CountEnv] * 2, OBS_SPACE, address)
+    assert envs.reset().shape == (2, 2)
+    envs.close()